@@ -0,0 +1 @@
+'''Benchmarks for s3po'''
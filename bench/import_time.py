@@ -0,0 +1,64 @@
+#! /usr/bin/env python
+'''How long `import s3po` takes in a fresh interpreter.
+
+Each run happens in its own process, so nothing is already cached in
+sys.modules. Exits non-zero if any of the heavy backend dependencies were
+loaded, or if the median import time exceeds --max-ms.'''
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+# Modules that only the backends (or batches) need
+HEAVY = ('boto3', 'botocore', 's3transfer', 'swiftclient', 'gevent')
+
+SCRIPT = '''
+import json, sys, time
+start = time.time()
+import s3po
+elapsed = time.time() - start
+heavy = sorted(set(
+    name.split('.')[0] for name in sys.modules) & set(%r))
+print(json.dumps({'seconds': elapsed, 'heavy': heavy}))
+''' % (HEAVY,)
+
+
+def measure():
+    '''Import s3po in a fresh interpreter'''
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.check_output([sys.executable, '-c', SCRIPT], cwd=root)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=10,
+        help='How many interpreters to time')
+    parser.add_argument('--max-ms', type=float, default=None,
+        help='Fail if the median import takes longer than this')
+    args = parser.parse_args(argv)
+
+    results = [measure() for _ in range(args.runs)]
+    times = sorted(result['seconds'] * 1000 for result in results)
+    median = times[len(times) // 2]
+    heavy = sorted(set(name for result in results for name in result['heavy']))
+    print('import s3po: median %.1fms, min %.1fms over %i runs' % (
+        median, times[0], len(times)))
+
+    failed = False
+    if heavy:
+        print('Loaded heavy modules: %s' % ', '.join(heavy))
+        failed = True
+    if args.max_ms is not None and median > args.max_ms:
+        print('Median exceeds %.1fms' % args.max_ms)
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
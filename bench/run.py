@@ -0,0 +1,277 @@
+#! /usr/bin/env python
+'''Benchmarks of Connection and Batch throughput and latency.
+
+Runs against the Memory backend, or against the local stand-in server
+(s3po.stub) through the real S3 or Swift backend. Results are written as
+JSON, and can be compared against a saved baseline:
+
+    python -m bench.run --backend s3 --output results.json
+    python -m bench.run --backend s3 --baseline results.json
+
+Every run uses the same keys, sizes and fault seed, so that runs on the same
+machine are comparable.'''
+
+from __future__ import print_function
+
+# Monkey-patch before anything imports ssl
+import s3po.batch
+
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import time
+
+from six import BytesIO
+
+from s3po import Connection
+from s3po.stub import Server
+
+from .import_time import measure
+
+try:
+    import tracemalloc
+except ImportError:  # pragma: no cover
+    tracemalloc = None
+
+
+# What each benchmark measures, and whether bigger is better. Anything else
+# (like the batch benchmarks) is in operations per second.
+UNITS = {
+    'small_upload': ('ops/s', True),
+    'small_download': ('ops/s', True),
+    'large_upload': ('MB/s', True),
+    'large_download': ('MB/s', True),
+    'list': ('keys/s', True),
+    'memory_per_op': ('KB', False),
+    'import': ('ms', False),
+}
+
+
+class Bench(object):
+    '''Runs the benchmarks against one backend'''
+
+    def __init__(self, conn, small_count=200, small_size=1024,
+                 large_size=16 * 1024 * 1024, list_count=1000,
+                 poolsizes=(1, 5, 20, 50), repeat=3, import_runs=5):
+        self.conn = conn
+        self.import_runs = import_runs
+        self.small_count = small_count
+        self.small_size = small_size
+        self.large_size = large_size
+        self.list_count = list_count
+        self.poolsizes = poolsizes
+        self.repeat = repeat
+        self.small = b'x' * small_size
+        self.large = os.urandom(large_size)
+
+    def best(self, func):
+        '''The shortest of repeat runs of func, in seconds'''
+        times = []
+        for _ in range(self.repeat):
+            gc.collect()
+            start = time.time()
+            func()
+            times.append(time.time() - start)
+        return min(times)
+
+    def small_keys(self):
+        '''The keys of our small objects'''
+        return ['small/%06i' % i for i in range(self.small_count)]
+
+    def small_upload(self):
+        '''Sequential uploads of small objects'''
+        def func():
+            for key in self.small_keys():
+                self.conn.upload('bench', key, BytesIO(self.small))
+        return self.small_count / self.best(func)
+
+    def small_download(self):
+        '''Sequential downloads of small objects'''
+        def func():
+            for key in self.small_keys():
+                self.conn.download('bench', key, BytesIO())
+        return self.small_count / self.best(func)
+
+    def large_upload(self):
+        '''Upload of one large object'''
+        megabytes = self.large_size / (1024.0 * 1024)
+        return megabytes / self.best(
+            lambda: self.conn.upload('bench', 'large', BytesIO(self.large)))
+
+    def large_download(self):
+        '''Download of one large object'''
+        megabytes = self.large_size / (1024.0 * 1024)
+        return megabytes / self.best(
+            lambda: self.conn.download('bench', 'large', BytesIO()))
+
+    def listing(self):
+        '''Listing many keys'''
+        with self.conn.batch(50) as batch:
+            for i in range(self.list_count):
+                batch.upload('bench', 'list/%06i' % i, BytesIO(b''))
+        return self.list_count / self.best(
+            lambda: list(self.conn.list('bench', 'list/')))
+
+    def batch_download(self, poolsize):
+        '''Downloads of small objects through a batch'''
+        def func():
+            with self.conn.batch(poolsize) as batch:
+                for key in self.small_keys():
+                    batch.download('bench', key, BytesIO())
+            if not batch.success():
+                raise RuntimeError('Batch download failed')
+        return self.small_count / self.best(func)
+
+    def memory_per_op(self):
+        '''The peak memory of a batch of in-flight downloads, per download'''
+        if tracemalloc is None:  # pragma: no cover
+            return None
+        gc.collect()
+        tracemalloc.start()
+        try:
+            with self.conn.batch(self.small_count) as batch:
+                for key in self.small_keys():
+                    batch.download('bench', key, BytesIO())
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return peak / 1024.0 / self.small_count
+
+    def import_time(self):
+        '''The median time to import s3po in a fresh interpreter'''
+        if not self.import_runs:
+            return None
+        times = sorted(
+            measure()['seconds'] * 1000 for _ in range(self.import_runs))
+        return times[len(times) // 2]
+
+    def run(self):
+        '''Run everything, returning a dictionary of name to result'''
+        results = {}
+
+        def record(name, value):
+            '''Keep a result, and report it as we go'''
+            if value is None:
+                return
+            unit, higher = UNITS.get(name, ('ops/s', True))
+            results[name] = {
+                'value': value, 'unit': unit, 'higher_is_better': higher}
+            print('%-24s %12.2f %s' % (name, value, unit), file=sys.stderr)
+
+        record('small_upload', self.small_upload())
+        record('small_download', self.small_download())
+        record('large_upload', self.large_upload())
+        record('large_download', self.large_download())
+        record('list', self.listing())
+        for poolsize in self.poolsizes:
+            record('batch_download_%i' % poolsize, self.batch_download(poolsize))
+        record('memory_per_op', self.memory_per_op())
+        record('import', self.import_time())
+        return results
+
+
+def compare(results, baseline, tolerance):
+    '''Compare results to a baseline, returning a list of (name, old, new,
+    change) for anything that got worse by more than tolerance (a fraction).'''
+    regressions = []
+    for name, result in sorted(results.items()):
+        old = baseline.get(name)
+        if not old or not old['value']:
+            continue
+        change = (result['value'] - old['value']) / float(old['value'])
+        worse = -change if result['higher_is_better'] else change
+        print('%-24s %12.2f -> %12.2f %s (%+.1f%%)' % (
+            name, old['value'], result['value'], result['unit'], change * 100),
+            file=sys.stderr)
+        if worse > tolerance:
+            regressions.append((name, old['value'], result['value'], change))
+    return regressions
+
+
+def connect(backend, server):
+    '''A connection to a backend, using the server for S3 and Swift'''
+    if backend == 'memory':
+        return Connection.memory()
+    if backend == 's3':
+        return Connection.s3(**server.s3_kwargs())
+    return Connection.swift(**server.swift_kwargs())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark s3po.')
+    parser.add_argument('--backend', choices=('memory', 's3', 'swift'),
+        default='memory')
+    parser.add_argument('--output', help='Write results to this JSON file')
+    parser.add_argument('--baseline', help='Compare with this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+        help='How much worse than the baseline is a regression')
+    parser.add_argument('--repeat', type=int, default=3,
+        help='Take the best of this many runs')
+    parser.add_argument('--small-count', type=int, default=200)
+    parser.add_argument('--small-size', type=int, default=1024)
+    parser.add_argument('--large-size', type=int, default=16 * 1024 * 1024)
+    parser.add_argument('--list-count', type=int, default=1000)
+    parser.add_argument('--import-runs', type=int, default=5,
+        help='How many interpreters to time importing s3po in')
+    parser.add_argument('--poolsizes', default='1,5,20,50',
+        help='Comma-separated pool sizes for the batch benchmarks')
+    parser.add_argument('--latency', type=float, default=0.005,
+        help='Per-request latency of the stand-in server')
+    parser.add_argument('--bandwidth', type=float, default=None,
+        help='Bandwidth cap of the stand-in server, in bytes per second')
+    parser.add_argument('--error-rate', type=float, default=0,
+        help='Fraction of requests the stand-in server fails')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    server = None
+    if args.backend != 'memory':
+        server = Server(
+            latency=args.latency, bandwidth=args.bandwidth,
+            error_rate=args.error_rate, seed=args.seed).start()
+    try:
+        bench = Bench(
+            connect(args.backend, server), small_count=args.small_count,
+            small_size=args.small_size, large_size=args.large_size,
+            list_count=args.list_count,
+            poolsizes=[int(size) for size in args.poolsizes.split(',')],
+            repeat=args.repeat, import_runs=args.import_runs)
+        results = bench.run()
+    finally:
+        if server is not None:
+            server.stop()
+
+    output = {
+        'meta': {
+            'backend': args.backend,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.time(),
+            'args': vars(args),
+        },
+        'results': results,
+    }
+    if server is not None:
+        output['meta']['requests'] = dict(server.stats)
+    if args.output:
+        with open(args.output, 'w') as fout:
+            json.dump(output, fout, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(output, indent=2, sort_keys=True))
+
+    if args.baseline:
+        with open(args.baseline) as fin:
+            baseline = json.load(fin)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for name, old, new, change in regressions:
+            print('Regression in %s: %.2f -> %.2f (%+.1f%%)' % (
+                name, old, new, change * 100), file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,27 +1,98 @@
 '''An in-memory backend'''
 
 import collections
+import hashlib
+import time
+import uuid
 
-from ..exceptions import DownloadException, DeleteException
+from six import text_type
+
+from ..exceptions import DownloadException, DeleteException, UploadException
+from ..util import is_text
+
+
+def as_bytes(data):
+    '''The stored data as bytes'''
+    if isinstance(data, text_type):
+        return data.encode('utf-8')
+    return data
 
 
 class Memory(object):
     '''An in-memory backend'''
+    # Size of parts for resumable uploads
+    multipart_chunk_size = 5 * 1024 * 1024
 
     def __init__(self):
         self.buckets = collections.defaultdict(dict)
+        # The etag, modification time and headers of each key
+        self.metadata = collections.defaultdict(dict)
+        # In-progress multipart uploads, by (bucket, key) and upload id
+        self.uploads = collections.defaultdict(dict)
+
+    def _store(self, bucket, key, data, etag=None, headers=None, part_size=None):
+        '''Store data at bucket/key'''
+        self.buckets[bucket][key] = data
+        self.metadata[bucket][key] = {
+            'etag': etag or hashlib.md5(as_bytes(data)).hexdigest(),
+            'modified': time.time(),
+            'headers': dict((k.lower(), v) for k, v in (headers or {}).items()),
+            'part_size': part_size
+        }
 
     def download(self, bucket, key, fobj, retries, headers=None):
-        '''Download the contents of bucket/key to fobj'''
+        '''Download the contents of bucket/key to fobj. If fobj has an
+        on_response method, it's told the object's metadata first. Like the
+        other backends, bytes are written unless fobj takes text.'''
         obj = self.buckets[bucket].get(key)
         if not obj:
             raise DownloadException('%s / %s not found' % (bucket, key))
         else:
-            fobj.write(obj)
+            on_response = getattr(fobj, 'on_response', None)
+            if on_response:
+                on_response(self._meta(bucket, key))
+            fobj.write(obj if is_text(fobj) else as_bytes(obj))
 
     def upload(self, bucket, key, fobj, retries, headers=None, extra=None):
         '''Upload the contents of fobj to bucket/key with headers'''
-        self.buckets[bucket][key] = fobj.read()
+        self._store(bucket, key, fobj.read(), headers=headers)
+
+    def head(self, bucket, key, retries=None, headers=None):
+        '''Get the size, etag and modification time of bucket/key'''
+        if key not in self.buckets[bucket]:
+            raise DownloadException('%s / %s not found' % (bucket, key))
+        return self._meta(bucket, key)
+
+    def _meta(self, bucket, key):
+        '''The metadata of bucket/key, as head and download report it'''
+        meta = self.metadata[bucket][key]
+        return {
+            'key': key,
+            'size': len(as_bytes(self.buckets[bucket][key])),
+            'etag': meta['etag'],
+            'modified': meta['modified'],
+            'headers': dict(meta['headers'])
+        }
+
+    def part_size(self, bucket, key, retries=None):
+        '''The size of the first part of bucket/key, if it was uploaded in
+        parts'''
+        meta = self.metadata[bucket].get(key)
+        return meta and meta['part_size']
+
+    def read_range(self, bucket, key, offset, length, retries=None, headers=None):
+        '''Read length bytes of bucket/key from offset. With no offset, read
+        the last length bytes. Like S3 and Swift, a range that starts at or
+        beyond the end isn't satisfiable.'''
+        if key not in self.buckets[bucket]:
+            raise DownloadException('%s / %s not found' % (bucket, key))
+        data = as_bytes(self.buckets[bucket][key])
+        if offset is None:
+            return data[-length:] if length else b''
+        if offset >= len(data):
+            raise DownloadException('Range %i-%i of %s / %s not satisfiable' % (
+                offset, offset + length - 1, bucket, key))
+        return data[offset:offset + length]
 
     def list(self, bucket, prefix=None, delimiter=None, retries=None, headers=None):
         '''List the contents of a bucket.'''
@@ -33,9 +104,72 @@ class Memory(object):
         else:
             return keys
 
+    def list_metadata(self, bucket, prefix=None, retries=None, headers=None):
+        '''List the contents of a bucket, with the size, etag and modification
+        time of each key.'''
+        for key in list(self.list(bucket, prefix)):
+            meta = self.head(bucket, key)
+            del meta['headers']
+            yield meta
+
+    def multipart_start(self, bucket, key, retries=None, headers=None, extra=None):
+        '''Begin a multipart upload to bucket/key, returning its id. Headers
+        are applied on completion.'''
+        upload_id = uuid.uuid4().hex
+        self.uploads[(bucket, key)][upload_id] = {
+            'initiated': time.time(),
+            'parts': {}
+        }
+        return upload_id
+
+    def _upload(self, bucket, key, upload_id):
+        '''Get an in-progress upload'''
+        upload = self.uploads[(bucket, key)].get(upload_id)
+        if upload is None:
+            raise UploadException('No such upload %s for %s / %s' % (
+                upload_id, bucket, key))
+        return upload
+
+    def multipart_part(self, bucket, key, upload_id, number, data, retries=None,
+                       md5=None):
+        '''Upload part number of an upload, returning its etag. If provided,
+        the hex md5 is checked against the data.'''
+        if md5 and md5 != hashlib.md5(data).hexdigest():
+            raise UploadException('Bad digest for part %i of %s / %s' % (
+                number, bucket, key))
+        self._upload(bucket, key, upload_id)['parts'][number] = data
+        return hashlib.md5(data).hexdigest()
+
+    def multipart_complete(self, bucket, key, upload_id, parts, retries=None,
+                           headers=None, extra=None):
+        '''Assemble the (number, etag) parts of an upload into bucket/key with
+        headers'''
+        upload = self._upload(bucket, key, upload_id)
+        try:
+            data = b''.join(upload['parts'][number] for number, _ in parts)
+        except KeyError as exc:
+            raise UploadException('Missing part %s of %s / %s' % (exc, bucket, key))
+        digests = b''.join(
+            hashlib.md5(upload['parts'][number]).digest() for number, _ in parts)
+        self._store(bucket, key, data, etag='%s-%i' % (
+            hashlib.md5(digests).hexdigest(), len(parts)), headers=headers,
+            part_size=len(upload['parts'][parts[0][0]]) if parts else None)
+        del self.uploads[(bucket, key)][upload_id]
+
+    def multipart_abort(self, bucket, key, upload_id, retries=None):
+        '''Abandon an upload, discarding its parts'''
+        self.uploads[(bucket, key)].pop(upload_id, None)
+
+    def multipart_list(self, bucket, key, retries=None):
+        '''List the (upload id, initiation time) of uploads to bucket/key'''
+        return [
+            (upload_id, upload['initiated'])
+            for upload_id, upload in self.uploads[(bucket, key)].items()]
+
     def delete(self, bucket, key, retries, headers=None):
         '''Delete bucket/key with headers'''
         if key in self.buckets[bucket]:
             del self.buckets[bucket][key]
+            self.metadata[bucket].pop(key, None)
         else:
             raise DeleteException('Failed to delete %s/%s' % (bucket, key))
@@ -0,0 +1,420 @@
+'''Replicate objects across several backends.
+
+Writes go to every replica in parallel, and succeed as soon as write_quorum
+of them have (by default, a majority). Reads go to the replica with the lowest
+recent latency (an exponentially-weighted moving average), failing over to the
+others on errors. Replicas that miss a write, or fail to produce an object
+that another one has, are repaired in the background by copying the object
+over from one that has it.
+
+    conn = Connection.replicated(
+        [Connection.s3(...), Connection.swift(...)], write_quorum=1)
+    conn.upload('bucket', 'key', 'content')
+    conn.backend.wait()     # Wait for stragglers and repairs'''
+
+import itertools
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from six import BytesIO, StringIO, reraise
+from six.moves.queue import Queue
+
+from .. import trace
+from ..exceptions import DeleteException, DownloadException, UploadException
+from ..util import logger, new_pool
+
+
+# Headers that are carried over when copying an object to repair a replica
+REPAIR_HEADERS = (
+    'Content-Type', 'Content-Encoding', 'Content-Language', 'Content-Disposition')
+
+
+class SpoolReader(object):
+    '''Reads a spool shared with other readers, from its own position'''
+    def __init__(self, spool, lock):
+        self.spool = spool
+        self.lock = lock
+        self.position = 0
+
+    def read(self, size=-1):
+        '''Read up to size from our position'''
+        with self.lock:
+            self.spool.seek(self.position)
+            data = self.spool.read(-1 if size is None else size)
+            self.position = self.spool.tell()
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        '''Move our position'''
+        with self.lock:
+            if whence == os.SEEK_CUR:
+                self.spool.seek(self.position)
+            self.spool.seek(offset, whence)
+            self.position = self.spool.tell()
+        return self.position
+
+    def tell(self):
+        '''Our position'''
+        return self.position
+
+
+class Replicated(object):
+    '''A backend that replicates across several backends'''
+    # Uploads are copied in chunks of this many bytes to a spool that's kept
+    # in memory up to spool_size bytes
+    chunk_size = 1024 * 1024
+    spool_size = 8 * 1024 * 1024
+
+    def __init__(self, backends, write_quorum=None, decay=0.2, penalty=1.0,
+                 repair=True, repair_poolsize=5):
+        if not backends:
+            raise ValueError('At least one backend is required')
+        self.backends = list(backends)
+        self.write_quorum = write_quorum or len(self.backends) // 2 + 1
+        if not 0 < self.write_quorum <= len(self.backends):
+            raise ValueError('Write quorum must be between 1 and %i' % len(
+                self.backends))
+        # Weight given to the newest latency sample, and the seconds added to
+        # the sample of a failed read
+        self.decay = decay
+        self.penalty = penalty
+        # The recent latency of each replica, or None if it hasn't been read
+        self.latency = [None] * len(self.backends)
+        self.repair = repair
+        # Writes that are still finishing after reaching quorum
+        self.pool = new_pool()
+        self.repairs = new_pool(repair_poolsize)
+
+    @property
+    def multipart_chunk_size(self):
+        '''Parts must be big enough for every replica'''
+        return max(backend.multipart_chunk_size for backend in self.backends)
+
+    def wait(self):
+        '''Wait for writes that are still finishing, and for repairs'''
+        self.pool.join()
+        self.repairs.join()
+
+    def order(self):
+        '''The indexes of the replicas, fastest first. Replicas that haven't
+        been read from yet come first, so that they get measured.'''
+        return sorted(
+            range(len(self.backends)),
+            key=lambda index: (self.latency[index] is not None, self.latency[index]))
+
+    def observe(self, index, seconds):
+        '''Fold a latency sample into a replica's moving average'''
+        previous = self.latency[index]
+        if previous is None:
+            self.latency[index] = seconds
+        else:
+            self.latency[index] = self.decay * seconds + (1 - self.decay) * previous
+
+    def _read(self, name, func, bucket, key=None, retries=3):
+        '''Return func(backend) from the fastest replica that succeeds. If a
+        key is provided, replicas that failed before one succeeded are
+        repaired from it.'''
+        failed = []
+        error = None
+        for index in self.order():
+            start = time.time()
+            try:
+                with trace.span(name, 'replica', replica=index):
+                    result = func(self.backends[index])
+            except Exception as exc:
+                error = sys.exc_info()
+                self.observe(index, time.time() - start + self.penalty)
+                failed.append(index)
+                logger.warning('Failed to %s %s / %s on replica %i: %s',
+                    name, bucket, key, index, exc)
+                continue
+            self.observe(index, time.time() - start)
+            if failed and key is not None and self.repair:
+                self.repairs.spawn(self._guard, self._copy,
+                    bucket, key, index, failed, retries)
+            return result
+        reraise(*error)
+
+    def _write(self, name, exception, func, quorum=None, repair=None):
+        '''Call func(index) for every replica in parallel, returning a
+        dictionary of index to result once quorum of them have succeeded. The others carry on in the background.
+        If repair is provided, it's the (bucket, key, retries) that any of them
+        that fail are brought in line with a replica that succeeded on.'''
+        quorum = quorum or self.write_quorum
+        outcomes = Queue()
+
+        def run(index):
+            '''Write to one replica, reporting how it went'''
+            try:
+                with trace.span(name, 'replica', replica=index):
+                    outcomes.put((index, func(index), None))
+            except Exception as exc:
+                outcomes.put((index, None, exc))
+
+        for index in range(len(self.backends)):
+            self.pool.spawn(run, index)
+
+        results = {}
+        succeeded = []
+        failed = []
+        while len(succeeded) < quorum and len(failed) <= len(self.backends) - quorum:
+            index, result, exc = outcomes.get()
+            if exc is None:
+                results[index] = result
+                succeeded.append(index)
+            else:
+                logger.warning('Failed to %s on replica %i: %s', name, index, exc)
+                failed.append(index)
+
+        if len(succeeded) < quorum:
+            raise exception('Failed to %s on %i of %i replicas, needing %i: %s' % (
+                name, len(failed), len(self.backends), quorum, exc))
+        if repair and self.repair:
+            bucket, key, retries = repair
+            deleted = name == 'delete'
+            for index in failed:
+                self.repairs.spawn(self._guard, self._copy,
+                    bucket, key, succeeded[0], [index], retries, deleted)
+            remaining = len(self.backends) - len(succeeded) - len(failed)
+            if remaining:
+                self.pool.spawn(self._stragglers, name, outcomes, remaining,
+                    bucket, key, succeeded[0], retries, deleted)
+        return results
+
+    def _stragglers(self, name, outcomes, remaining, bucket, key, source,
+                    retries, deleted):
+        '''Wait for the writes that were still running after quorum, and
+        repair those that fail from the source replica'''
+        for _ in range(remaining):
+            index, _, exc = outcomes.get()
+            if exc is not None:
+                logger.warning('Failed to %s on replica %i: %s', name, index, exc)
+                self.repairs.spawn(self._guard, self._copy,
+                    bucket, key, source, [index], retries, deleted)
+
+    def _guard(self, func, *args):
+        '''Run a repair, logging rather than raising any failure'''
+        try:
+            func(*args)
+        except Exception:
+            logger.exception('Failed to repair replica')
+
+    def _head(self, index, bucket, key, retries):
+        '''The metadata of bucket/key on a replica, or None if it's missing'''
+        try:
+            return self.backends[index].head(bucket, key, retries)
+        except DownloadException:
+            return None
+
+    def _copy(self, bucket, key, source, targets, retries, deleted=False):
+        '''Bring bucket/key on each of the targets in line with the source
+        replica, copying it over unless it's already the same. Repairs use the
+        source's current state rather than replaying a write, so that they
+        can't undo a later one. If the object was deleted and is still missing
+        from the source, it's deleted from the targets.'''
+        meta = self._head(source, bucket, key, retries)
+        if meta is None and not deleted:
+            raise DownloadException('Cannot repair %s / %s, missing from replica %i' % (
+                bucket, key, source))
+        data = None
+        for target in targets:
+            other = self._head(target, bucket, key, retries)
+            if meta is None:
+                if other is not None:
+                    logger.info('Repairing deletion of %s / %s on replica %i',
+                        bucket, key, target)
+                    with trace.span('repair', 'replica', replica=target):
+                        self.backends[target].delete(bucket, key, retries)
+                continue
+            if other and (other['size'], other['etag']) == (meta['size'], meta['etag']):
+                continue
+            if data is None:
+                data = BytesIO()
+                self.backends[source].download(bucket, key, data, retries)
+            data.seek(0)
+            headers = dict(
+                (header, meta['headers'][header.lower()])
+                for header in REPAIR_HEADERS if header.lower() in meta['headers'])
+            logger.info('Repairing %s / %s on replica %i from replica %i',
+                bucket, key, target, source)
+            with trace.span('repair', 'replica', replica=target):
+                if headers:
+                    self.backends[target].upload(
+                        bucket, key, data, retries, headers=headers)
+                else:
+                    self.backends[target].upload(bucket, key, data, retries)
+
+    def download(self, bucket, key, fobj, retries, headers=None):
+        '''Download bucket/key to fobj from the fastest replica that has it'''
+        start = fobj.tell()
+
+        def func(backend):
+            '''Discard anything written by a replica that failed'''
+            if fobj.tell() != start:
+                fobj.seek(start)
+                fobj.truncate()
+            return backend.download(bucket, key, fobj, retries, headers)
+        return self._read('download', func, bucket, key, retries)
+
+    @staticmethod
+    def _opts(headers, extra):
+        '''The headers and extra arguments to pass along, if any'''
+        opts = {}
+        if headers:
+            opts['headers'] = headers
+        if extra:
+            opts['extra'] = extra
+        return opts
+
+    def upload(self, bucket, key, fobj, retries, headers=None, extra=None):
+        '''Upload the contents of fobj to bucket/key on every replica. The
+        contents are copied to a spool (in memory up to spool_size bytes, and
+        on disk beyond that) that each replica reads at its own pace. Text is
+        kept in memory.'''
+        chunk = fobj.read(self.chunk_size)
+        if isinstance(chunk, bytes):
+            spool = tempfile.SpooledTemporaryFile(self.spool_size)
+        else:
+            spool = StringIO()
+        while chunk:
+            spool.write(chunk)
+            chunk = fobj.read(self.chunk_size)
+        # Replicas that finish after quorum still need the spool, so it's
+        # left to be closed once they're done with it
+        lock = sys.modules.get('threading', threading).Lock()
+        opts = self._opts(headers, extra)
+
+        def func(index):
+            '''Upload a copy of the data'''
+            source = SpoolReader(spool, lock)
+            return self.backends[index].upload(bucket, key, source, retries, **opts)
+        results = self._write(
+            'upload', UploadException, func, repair=(bucket, key, retries))
+        return list(results.values())[0]
+
+    def head(self, bucket, key, retries=3, headers=None):
+        '''Get the size, etag and modification time of bucket/key'''
+        return self._read(
+            'head', lambda backend: backend.head(bucket, key, retries, headers),
+            bucket, key, retries)
+
+    def part_size(self, bucket, key, retries=3):
+        '''The size of the first part of bucket/key, if the replica read from
+        can tell'''
+        def func(backend):
+            '''Ask one replica'''
+            part_size = getattr(backend, 'part_size', None)
+            return part_size and part_size(bucket, key, retries)
+        return self._read('part_size', func, bucket, key, retries)
+
+    def read_range(self, bucket, key, offset, length, retries=3, headers=None):
+        '''Read length bytes of bucket/key from offset. With no offset, read
+        the last length bytes.'''
+        return self._read(
+            'read_range', lambda backend: backend.read_range(
+                bucket, key, offset, length, retries, headers),
+            bucket, key, retries)
+
+    @staticmethod
+    def _started(keys):
+        '''Fail now, rather than part way through iterating, if a listing
+        can't be started'''
+        keys = iter(keys)
+        for key in keys:
+            return itertools.chain([key], keys)
+        return iter([])
+
+    def list(self, bucket, prefix=None, delimiter=None, retries=3, headers=None):
+        '''List the contents of a bucket on the fastest replica'''
+        return self._read('list', lambda backend: self._started(
+            backend.list(bucket, prefix, delimiter, retries, headers)), bucket)
+
+    def list_metadata(self, bucket, prefix=None, retries=3, headers=None):
+        '''List the contents of a bucket on the fastest replica, with the size,
+        etag and modification time of each key.'''
+        return self._read('list_metadata', lambda backend: self._started(
+            backend.list_metadata(bucket, prefix, retries, headers)), bucket)
+
+    def delete(self, bucket, key, retries, headers=None):
+        '''Delete bucket/key from every replica'''
+        def func(index):
+            '''Delete from one replica'''
+            return self.backends[index].delete(bucket, key, retries, headers)
+        self._write(
+            'delete', DeleteException, func, repair=(bucket, key, retries))
+
+    # Multipart uploads must reach every replica, and their ids are the JSON
+    # list of the id on each. The replicas list their uploads independently,
+    # so each is listed by an id that only has its own replica's part, with
+    # None for the others; multipart_ids gives the ids that an upload is
+    # listed by.
+
+    def multipart_ids(self, upload_id):
+        '''The ids that multipart_list reports the parts of upload_id as'''
+        ids = json.loads(upload_id)
+        return [
+            self._replica_id(index, ids[index])
+            for index in range(len(self.backends)) if ids[index] is not None]
+
+    def _replica_id(self, index, replica_id):
+        '''The id of just replica index's upload replica_id'''
+        ids = [None] * len(self.backends)
+        ids[index] = replica_id
+        return json.dumps(ids)
+
+    def multipart_start(self, bucket, key, retries=3, headers=None, extra=None):
+        '''Begin a multipart upload to bucket/key on every replica'''
+        opts = self._opts(headers, extra)
+        ids = self._write('multipart_start', UploadException,
+            lambda index: self.backends[index].multipart_start(
+                bucket, key, retries, **opts),
+            quorum=len(self.backends))
+        return json.dumps([ids[index] for index in range(len(self.backends))])
+
+    def multipart_part(self, bucket, key, upload_id, number, data, retries=3,
+                       md5=None):
+        '''Upload part number of an upload to every replica, returning its
+        etag on the first'''
+        ids = json.loads(upload_id)
+        etags = self._write('multipart_part', UploadException,
+            lambda index: self.backends[index].multipart_part(
+                bucket, key, ids[index], number, data, retries, md5=md5),
+            quorum=len(self.backends))
+        return etags[0]
+
+    def multipart_complete(self, bucket, key, upload_id, parts, retries=3,
+                           headers=None, extra=None):
+        '''Assemble the (number, etag) parts of an upload on every replica'''
+        ids = json.loads(upload_id)
+        opts = self._opts(headers, extra)
+        self._write('multipart_complete', UploadException,
+            lambda index: self.backends[index].multipart_complete(
+                bucket, key, ids[index], parts, retries, **opts),
+            quorum=len(self.backends))
+
+    def multipart_abort(self, bucket, key, upload_id, retries=3):
+        '''Abandon an upload on every replica that it has a part on'''
+        ids = json.loads(upload_id)
+
+        def func(index):
+            '''Abort on one replica'''
+            if ids[index] is not None:
+                self.backends[index].multipart_abort(
+                    bucket, key, ids[index], retries)
+        self._write('multipart_abort', UploadException, func,
+            quorum=len(self.backends))
+
+    def multipart_list(self, bucket, key, retries=3):
+        '''List the (upload id, initiation time) of uploads to bucket/key on
+        every replica, by the ids of each replica's part'''
+        listings = self._write('multipart_list', UploadException,
+            lambda index: self.backends[index].multipart_list(bucket, key, retries),
+            quorum=len(self.backends))
+        return [
+            (self._replica_id(index, replica_id), initiated)
+            for index in range(len(self.backends))
+            for replica_id, initiated in listings[index]]
@@ -1,14 +1,49 @@
 '''Deal with S3.'''
 
+import base64
+import binascii
+import calendar
 
 import boto3
 from boto3.s3.transfer import TransferConfig
 from boto3.exceptions import Boto3Error
 from botocore.exceptions import BotoCoreError, ClientError
 
+from .. import trace
 from ..util import retry
 from ..exceptions import DeleteException, DownloadException, UploadException
 
+try:
+    from botocore.compat import HAS_CRT
+except ImportError:
+    # Older botocore knows nothing of the CRT, or of checksums
+    HAS_CRT = False
+
+
+# Standard headers that we can translate into ExtraArgs
+HEADER_ARGS = {
+    'cache-control': 'CacheControl',
+    'content-disposition': 'ContentDisposition',
+    'content-encoding': 'ContentEncoding',
+    'content-language': 'ContentLanguage',
+    'content-type': 'ContentType',
+}
+
+
+def header_args(headers, extra=None):
+    '''Merge headers into ExtraArgs. Standard headers map onto their argument,
+    and x-amz-meta-* headers become Metadata.'''
+    extra = dict(extra or {})
+    for header, value in (headers or {}).items():
+        header = header.lower()
+        if header in HEADER_ARGS:
+            extra[HEADER_ARGS[header]] = value
+        elif header.startswith('x-amz-meta-'):
+            extra.setdefault('Metadata', {})[header[len('x-amz-meta-'):]] = value
+        else:
+            raise ValueError('Unsupported header for S3 uploads: %s' % header)
+    return extra or None
+
 
 class S3(object):
     '''Our connection to S3'''
@@ -19,11 +54,100 @@ class S3(object):
 
     def __init__(self, *args, **kwargs):
         self.conn = boto3.resource('s3', *args, **kwargs)
+        # When each greenlet started signing and sending its current request
+        self._phases = {}
+        self._instrumented = False
+        # The key and on_response of each greenlet's download in progress
+        self._downloads = {}
+        self.client.meta.events.register(
+            'after-call.s3.GetObject', self._get_object)
+        # The parameters of the operations that we send optional ones to
+        model = self.client.meta.service_model
+        self._parameters = dict(
+            (operation, set(model.operation_model(operation).input_shape.members))
+            for operation in ('HeadObject', 'PutObject'))
+
+    def _supports(self, operation, parameter):
+        '''Whether the installed botocore's model of an operation has a
+        parameter, as older ones lack those for checksums'''
+        return parameter in self._parameters.get(operation, ())
+
+    def instrument(self):
+        '''Hook into botocore's events to trace signing and time to first
+        byte. The hooks do nothing unless a tracer is active.'''
+        if self._instrumented:
+            return
+        events = self.client.meta.events
+        events.register('before-sign.s3', self._before_sign)
+        events.register('before-send.s3', self._before_send)
+        events.register('needs-retry.s3', self._response)
+        self._instrumented = True
+
+    @staticmethod
+    def _operation(event_name):
+        '''The operation from an event name like before-sign.s3.GetObject'''
+        return event_name.rsplit('.', 1)[-1]
+
+    def _before_sign(self, event_name=None, **kwargs):
+        if trace.current() is not None:
+            self._phases[trace.thread_id()] = {'sign': trace.clock()}
+
+    def _before_send(self, event_name=None, **kwargs):
+        phases = self._phases.get(trace.thread_id())
+        if phases is not None and 'sign' in phases:
+            phases['send'] = trace.clock()
+            trace.record('sign', 's3', phases['sign'], phases['send'],
+                operation=self._operation(event_name))
+
+    def _response(self, event_name=None, attempts=None, **kwargs):
+        phases = self._phases.pop(trace.thread_id(), None)
+        if phases is not None and 'send' in phases:
+            trace.record('first_byte', 's3', phases['send'], trace.clock(),
+                operation=self._operation(event_name), attempt=attempts)
+
+    def _get_object(self, parsed=None, **kwargs):
+        '''Tell the destination of a download about the object it's getting'''
+        download = self._downloads.get(trace.thread_id())
+        if download is not None and parsed and 'ETag' in parsed:
+            key, on_response = download
+            on_response(self._meta(key, parsed))
+
+    @staticmethod
+    def _meta(key, response):
+        '''The size, etag, modification time and headers of a response'''
+        size = response['ContentLength']
+        if response.get('ContentRange'):
+            # Of the whole object, rather than of this range of it
+            size = int(response['ContentRange'].rsplit('/', 1)[1])
+        return {
+            'key': key,
+            'size': size,
+            'etag': response['ETag'].strip('"'),
+            'modified': calendar.timegm(response['LastModified'].utctimetuple()),
+            'headers': response['ResponseMetadata'].get('HTTPHeaders', {})
+        }
 
     def get_bucket(self, bucket):
         return self.conn.Bucket(bucket)
 
+    @property
+    def client(self):
+        '''The low-level client underlying our resource'''
+        return self.conn.meta.client
+
     def download(self, bucket, key, destination, retries, extra=None):
+        '''Download the contents of bucket/key to destination. If destination
+        has an on_response method, it's told the object's metadata before the
+        body is written.'''
+        on_response = getattr(destination, 'on_response', None)
+        if on_response:
+            self._downloads[trace.thread_id()] = (key, on_response)
+        try:
+            self._download(bucket, key, destination, retries, extra)
+        finally:
+            self._downloads.pop(trace.thread_id(), None)
+
+    def _download(self, bucket, key, destination, retries, extra=None):
         '''Download the contents of bucket/key to destination'''
         bucket = self.get_bucket(bucket)
 
@@ -35,14 +159,20 @@ class S3(object):
             num_download_attempts=retries)
 
         try:
-            key.download_fileobj(destination, Config=config, ExtraArgs=extra)
+            with trace.span('body', 's3'):
+                key.download_fileobj(destination, Config=config, ExtraArgs=extra)
         except (ClientError, BotoCoreError, Boto3Error) as exc:
             raise DownloadException('Failed to download s3://{}/{}: {}'.format(
                 bucket, key, exc))
 
-    def upload(self, bucket, key, source, retries, extra=None):
+    def upload(self, bucket, key, source, retries, extra=None, headers=None):
         '''Upload the contents of source to bucket/key'''
         bucket = self.get_bucket(bucket)
+        extra = header_args(headers, extra)
+        if (HAS_CRT and not (extra and 'ChecksumAlgorithm' in extra) and
+                self._supports('PutObject', 'ChecksumAlgorithm')):
+            # Have S3 store a CRC32C that downloads can be verified against
+            extra = dict(extra or {}, ChecksumAlgorithm='CRC32C')
 
         key = bucket.Object(key)
         config = TransferConfig(
@@ -51,12 +181,169 @@ class S3(object):
             use_threads=False,
             num_download_attempts=retries)
         try:
-            key.upload_fileobj(source, Config=config, ExtraArgs=extra)
+            with trace.span('put', 's3'):
+                key.upload_fileobj(source, Config=config, ExtraArgs=extra)
             return True
         except (ClientError, BotoCoreError, Boto3Error) as ex:
             raise UploadException('Failed to upload s3://{}/{}: {}'.format(
                 bucket, key, ex))
 
+    def head(self, bucket, key, retries=3, extra=None):
+        '''Get the size, etag and modification time of bucket/key'''
+        extra = dict(extra or {})
+        if self._supports('HeadObject', 'ChecksumMode'):
+            # Have S3 include any x-amz-checksum-crc32c the object has
+            extra.setdefault('ChecksumMode', 'ENABLED')
+
+        @retry(retries)
+        def func():
+            '''The bit that we want to retry'''
+            try:
+                return self.client.head_object(Bucket=bucket, Key=key, **extra)
+            except (ClientError, BotoCoreError, Boto3Error) as exc:
+                raise DownloadException('Failed to head s3://{}/{}: {}'.format(
+                    bucket, key, exc))
+
+        return self._meta(key, func())
+
+    def part_size(self, bucket, key, retries=3):
+        '''The size of the first part of bucket/key, if it was uploaded in
+        parts. None if that can't be told.'''
+        if not self._supports('HeadObject', 'PartNumber'):
+            return None
+
+        @retry(retries)
+        def func():
+            '''The bit that we want to retry'''
+            try:
+                response = self.client.head_object(
+                    Bucket=bucket, Key=key, PartNumber=1)
+            except (ClientError, BotoCoreError, Boto3Error) as exc:
+                raise DownloadException('Failed to head s3://{}/{}: {}'.format(
+                    bucket, key, exc))
+            if response.get('PartsCount'):
+                return response['ContentLength']
+            return None
+
+        try:
+            return func()
+        except DownloadException:
+            return None
+
+    def read_range(self, bucket, key, offset, length, retries=3, extra=None):
+        '''Read length bytes of bucket/key from offset. With no offset, read
+        the last length bytes.'''
+        if offset is None:
+            byte_range = 'bytes=-%i' % length
+        else:
+            byte_range = 'bytes=%i-%i' % (offset, offset + length - 1)
+
+        @retry(retries)
+        def func():
+            '''The bit that we want to retry'''
+            try:
+                body = self.client.get_object(
+                    Bucket=bucket, Key=key, Range=byte_range,
+                    **(extra or {}))['Body']
+                with trace.span('body', 's3'):
+                    return body.read()
+            except (ClientError, BotoCoreError, Boto3Error) as exc:
+                raise DownloadException('Failed to read s3://{}/{} {}: {}'.format(
+                    bucket, key, byte_range, exc))
+
+        return func()
+
+    def multipart_start(self, bucket, key, retries=3, extra=None, headers=None):
+        '''Begin a multipart upload to bucket/key with headers, returning its
+        id'''
+        extra = header_args(headers, extra) or {}
+
+        @retry(retries)
+        def func():
+            '''The bit that we want to retry'''
+            try:
+                return self.client.create_multipart_upload(
+                    Bucket=bucket, Key=key, **extra)['UploadId']
+            except (ClientError, BotoCoreError, Boto3Error) as exc:
+                raise UploadException('Failed to start s3://{}/{}: {}'.format(
+                    bucket, key, exc))
+
+        return func()
+
+    def multipart_part(self, bucket, key, upload_id, number, data, retries=3,
+                       md5=None):
+        '''Upload part number of an upload, returning its etag. If provided,
+        the hex md5 is sent as Content-MD5 for S3 to check.'''
+        opts = {}
+        if md5:
+            opts['ContentMD5'] = base64.b64encode(
+                binascii.unhexlify(md5)).decode('ascii')
+
+        @retry(retries)
+        def func():
+            '''The bit that we want to retry'''
+            try:
+                return self.client.upload_part(
+                    Bucket=bucket, Key=key, UploadId=upload_id,
+                    PartNumber=number, Body=data, **opts)['ETag'].strip('"')
+            except (ClientError, BotoCoreError, Boto3Error) as exc:
+                raise UploadException('Failed part {} of s3://{}/{}: {}'.format(
+                    number, bucket, key, exc))
+
+        return func()
+
+    def multipart_complete(self, bucket, key, upload_id, parts, retries=3,
+                           extra=None, headers=None):
+        '''Assemble the (number, etag) parts of an upload into bucket/key. Its
+        headers were given when the upload started.'''
+        @retry(retries)
+        def func():
+            '''The bit that we want to retry'''
+            try:
+                self.client.complete_multipart_upload(
+                    Bucket=bucket, Key=key, UploadId=upload_id,
+                    MultipartUpload={'Parts': [
+                        {'PartNumber': number, 'ETag': '"%s"' % etag}
+                        for number, etag in parts]})
+            except (ClientError, BotoCoreError, Boto3Error) as exc:
+                raise UploadException('Failed to complete s3://{}/{}: {}'.format(
+                    bucket, key, exc))
+
+        func()
+
+    def multipart_abort(self, bucket, key, upload_id, retries=3):
+        '''Abandon an upload, discarding its parts'''
+        @retry(retries)
+        def func():
+            '''The bit that we want to retry'''
+            try:
+                self.client.abort_multipart_upload(
+                    Bucket=bucket, Key=key, UploadId=upload_id)
+            except (ClientError, BotoCoreError, Boto3Error) as exc:
+                raise UploadException('Failed to abort s3://{}/{}: {}'.format(
+                    bucket, key, exc))
+
+        func()
+
+    def multipart_list(self, bucket, key, retries=3):
+        '''List the (upload id, initiation time) of uploads to bucket/key'''
+        @retry(retries)
+        def func():
+            '''The bit that we want to retry'''
+            try:
+                paginator = self.client.get_paginator('list_multipart_uploads')
+                return [
+                    (upload['UploadId'],
+                        calendar.timegm(upload['Initiated'].utctimetuple()))
+                    for page in paginator.paginate(Bucket=bucket, Prefix=key)
+                    for upload in page.get('Uploads', [])
+                    if upload['Key'] == key]
+            except (ClientError, BotoCoreError, Boto3Error) as exc:
+                raise UploadException('Failed to list uploads s3://{}/{}: {}'.format(
+                    bucket, key, exc))
+
+        return func()
+
     def _list_retry(self, retries, bucket, **kwargs):
         @retry(retries)
         def func():
@@ -78,7 +365,24 @@ class S3(object):
             key.key for key in self._list_retry(retries, bucket, **opts)
         )
 
-    def delete(self, bucket, key, retries):
+    def list_metadata(self, bucket, prefix=None, retries=3, extra=None):
+        '''List the bucket with the size, etag and modification time of each
+        key, possibly limiting the search with a prefix.'''
+        bucket = self.get_bucket(bucket)
+        opts = {}
+        if prefix:
+            opts['Prefix'] = prefix
+        if extra:
+            opts['ExtraArgs'] = extra
+        for obj in self._list_retry(retries, bucket, **opts):
+            yield {
+                'key': obj.key,
+                'size': obj.size,
+                'etag': obj.e_tag.strip('"'),
+                'modified': calendar.timegm(obj.last_modified.utctimetuple())
+            }
+
+    def delete(self, bucket, key, retries, extra=None):
         '''Delete bucket/key'''
         bucket = self.get_bucket(bucket)
         key = bucket.Object(key)
@@ -87,7 +391,7 @@ class S3(object):
         def func():
             '''The bit that we want to retry'''
             try:
-                key.delete()
+                key.delete(**(extra or {}))
             except (ClientError, BotoCoreError, Boto3Error) as exc:
                 raise DeleteException(
                     'Failed to delete %s/%s: %s(%s)' %
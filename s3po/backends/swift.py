@@ -1,24 +1,51 @@
 '''Deal with Swift.'''
 
+import calendar
+import datetime
+import email.utils
+import json
+import re
+import time
+import uuid
+
 import swiftclient.client
 from swiftclient.exceptions import ClientException
 
+from .. import trace
 from ..util import CountFile, retry, logger
 from ..exceptions import UploadException, DownloadException, DeleteException
 
 
+# The ids that multipart_start makes
+UPLOAD_ID = re.compile(r'^\d+\.[0-9a-f]+$')
+
+
+class Connection(swiftclient.client.Connection):
+    '''A swiftclient connection whose authentication shows up in traces'''
+    def get_auth(self):
+        with trace.span('auth', 'swift'):
+            return swiftclient.client.Connection.get_auth(self)
+
+
 class Swift(object):
     '''Our connection to S3'''
     # The size of the chunk to download / upload
     chunk_size = 1024 * 1024
+    # Size of segments for resumable uploads
+    multipart_chunk_size = 50 * 1024 * 1024
+    # Segments of resumable uploads are kept in a container with this suffix
+    segments_suffix = '_segments'
 
     def __init__(self, *args, **kwargs):
         # We explicitly disable retries so that we can manage that directly
         kwargs['retries'] = 0
-        self.conn = swiftclient.client.Connection(*args, **kwargs)
+        self.conn = Connection(*args, **kwargs)
 
     def download(self, bucket, key, fobj, retries, headers=None):
-        '''Download the contents of bucket/key to fobj'''
+        '''Download the contents of bucket/key to fobj. If fobj has an
+        on_response method, it's told the object's metadata before the body
+        is written.'''
+        on_response = getattr(fobj, 'on_response', None)
         # Make a file that we'll write into
         fobj = CountFile(fobj)
 
@@ -29,12 +56,16 @@ class Swift(object):
         def func():
             '''The bit that we want to retry'''
             try:
-                resp_headers, response = self.conn.get_object(
-                    bucket, key, resp_chunk_size=self.chunk_size, headers=headers)
+                with trace.span('first_byte', 'swift'):
+                    resp_headers, response = self.conn.get_object(
+                        bucket, key, resp_chunk_size=self.chunk_size, headers=headers)
 
                 fobj.seek(offset)
-                for chunk in response:
-                    fobj.write(chunk)
+                if on_response:
+                    on_response(self._meta(key, resp_headers))
+                with trace.span('body', 'swift'):
+                    for chunk in response:
+                        fobj.write(chunk)
 
                 length = resp_headers.get('content-length')
                 if not length:
@@ -57,13 +88,212 @@ class Swift(object):
         @retry(retries)
         def func():
             try:
-                self.conn.put_object(
-                    bucket, key, fobj, chunk_size=self.chunk_size, headers=headers)
+                with trace.span('put', 'swift'):
+                    self.conn.put_object(
+                        bucket, key, fobj, chunk_size=self.chunk_size, headers=headers)
             except ClientException:
                 raise UploadException('Failed to upload %s' % key)
 
         func()
 
+    def head(self, bucket, key, retries=3, headers=None):
+        '''Get the size, etag and modification time of bucket/key'''
+        @retry(retries)
+        def func():
+            '''The bit that we want to retry'''
+            try:
+                return self.conn.head_object(bucket, key, headers=headers)
+            except ClientException as exc:
+                raise DownloadException('Failed to head %s/%s: %s' % (
+                    bucket, key, exc))
+
+        return self._meta(key, func())
+
+    @staticmethod
+    def _meta(key, resp_headers):
+        '''The size, etag, modification time and headers of a response'''
+        resp_headers = dict((k.lower(), v) for k, v in resp_headers.items())
+        modified = resp_headers.get('last-modified')
+        size = int(resp_headers.get('content-length', 0))
+        if resp_headers.get('content-range'):
+            # Of the whole object, rather than of this range of it
+            size = int(resp_headers['content-range'].rsplit('/', 1)[1])
+        return {
+            'key': key,
+            'size': size,
+            'etag': resp_headers.get('etag', '').strip('"'),
+            'modified': modified and email.utils.mktime_tz(
+                email.utils.parsedate_tz(modified)),
+            'headers': resp_headers
+        }
+
+    def part_size(self, bucket, key, retries=3):
+        '''The size of the first segment of bucket/key, if it's a static large
+        object. None if that can't be told.'''
+        @retry(retries)
+        def func():
+            '''The bit that we want to retry'''
+            try:
+                headers, body = self.conn.get_object(
+                    bucket, key, query_string='multipart-manifest=get')
+            except ClientException as exc:
+                raise DownloadException('Failed to get manifest %s/%s: %s' % (
+                    bucket, key, exc))
+            if headers.get('x-static-large-object', '').lower() != 'true':
+                return None
+            segments = json.loads(body)
+            return segments[0]['bytes'] if segments else None
+
+        try:
+            return func()
+        except DownloadException:
+            return None
+
+    def read_range(self, bucket, key, offset, length, retries=3, headers=None):
+        '''Read length bytes of bucket/key from offset. With no offset, read
+        the last length bytes.'''
+        headers = dict(headers or {})
+        if offset is None:
+            headers['Range'] = 'bytes=-%i' % length
+        else:
+            headers['Range'] = 'bytes=%i-%i' % (offset, offset + length - 1)
+
+        @retry(retries)
+        def func():
+            '''The bit that we want to retry'''
+            try:
+                with trace.span('get', 'swift'):
+                    return self.conn.get_object(bucket, key, headers=headers)[1]
+            except ClientException as exc:
+                raise DownloadException('Failed to read %s/%s %s: %s' % (
+                    bucket, key, headers['Range'], exc))
+
+        return func()
+
+    def _segment_prefix(self, key, upload_id):
+        '''Where the segments of an upload live in the segments container'''
+        return '%s/%s/' % (key, upload_id)
+
+    def multipart_start(self, bucket, key, retries=3, headers=None):
+        '''Begin a segmented upload to bucket/key, returning its id. The id
+        begins with the time, so that stale uploads can be recognized. Headers
+        are only applied on completion, when the object is written.'''
+        @retry(retries)
+        def func():
+            '''The bit that we want to retry'''
+            try:
+                self.conn.put_container(bucket + self.segments_suffix)
+            except ClientException:
+                raise UploadException('Failed to start %s/%s' % (bucket, key))
+
+        func()
+        return '%i.%s' % (time.time(), uuid.uuid4().hex)
+
+    def multipart_part(self, bucket, key, upload_id, number, data, retries=3,
+                       md5=None):
+        '''Upload segment number of an upload, returning its etag. If provided,
+        the hex md5 is sent as the ETag for Swift to check.'''
+        opts = {'etag': md5} if md5 else {}
+
+        @retry(retries)
+        def func():
+            '''The bit that we want to retry'''
+            try:
+                return self.conn.put_object(
+                    bucket + self.segments_suffix,
+                    self._segment_prefix(key, upload_id) + '%08i' % number,
+                    data, **opts)
+            except ClientException:
+                raise UploadException('Failed segment %i of %s/%s' % (
+                    number, bucket, key))
+
+        return func()
+
+    def multipart_complete(self, bucket, key, upload_id, parts, retries=3,
+                           headers=None):
+        '''Write a static large object manifest for the (number, etag) parts
+        of an upload to bucket/key, with headers. Unlike a dynamic one, it has
+        the real size and etag of the whole in listings.'''
+        container = bucket + self.segments_suffix
+        prefix = self._segment_prefix(key, upload_id)
+        sizes = dict(
+            (result['name'], result['bytes']) for result in self._iter_container(
+                container, retries, 1000, prefix=prefix))
+        manifest = []
+        for number, etag in parts:
+            name = prefix + '%08i' % number
+            if name not in sizes:
+                raise UploadException('Missing segment %i of %s/%s' % (
+                    number, bucket, key))
+            manifest.append({
+                'path': '/%s/%s' % (container, name),
+                'etag': etag,
+                'size_bytes': sizes[name]})
+
+        @retry(retries)
+        def func():
+            '''The bit that we want to retry'''
+            try:
+                self.conn.put_object(
+                    bucket, key, json.dumps(manifest), headers=headers,
+                    query_string='multipart-manifest=put')
+            except ClientException:
+                raise UploadException('Failed to complete %s/%s' % (bucket, key))
+
+        func()
+
+    def multipart_abort(self, bucket, key, upload_id, retries=3):
+        '''Abandon an upload, deleting its segments'''
+        container = bucket + self.segments_suffix
+        for segment in list(self.list(
+                container, self._segment_prefix(key, upload_id), retries=retries)):
+            self.delete(container, segment, retries)
+
+    def _current_upload(self, bucket, key, retries=3):
+        '''The id of the upload whose segments the object at bucket/key is
+        made of, if any'''
+        @retry(retries)
+        def func():
+            '''The bit that we want to retry'''
+            try:
+                headers = self.conn.head_object(bucket, key)
+                manifest = headers.get('x-object-manifest')
+                if manifest:
+                    # A dynamic large object refers to its segments' prefix
+                    return manifest.rstrip('/').rsplit('/', 1)[-1]
+                if headers.get('x-static-large-object', '').lower() != 'true':
+                    return None
+                segments = json.loads(self.conn.get_object(
+                    bucket, key, query_string='multipart-manifest=get')[1])
+                return segments and segments[0]['name'].rsplit('/', 2)[-2]
+            except ClientException as exc:
+                # Only a missing object means that no segments are in use
+                if exc.http_status == 404:
+                    return None
+                raise UploadException('Failed to list uploads %s/%s: %s' % (
+                    bucket, key, exc))
+
+        return func()
+
+    def multipart_list(self, bucket, key, retries=3):
+        '''List the (upload id, initiation time) of uploads to bucket/key
+        whose segments are not referenced by the current object.'''
+        current = self._current_upload(bucket, key, retries)
+        try:
+            self.conn.head_container(bucket + self.segments_suffix)
+        except ClientException:
+            # No segments container means no uploads
+            return []
+        results = []
+        for result in self._iter_container(
+                bucket + self.segments_suffix, retries, 100,
+                prefix=key + '/', delimiter='/'):
+            upload_id = result.get('subdir', '')[len(key) + 1:].rstrip('/')
+            # Skip the segments of other keys that key is a prefix of
+            if UPLOAD_ID.match(upload_id) and upload_id != current:
+                results.append((upload_id, int(upload_id.split('.')[0])))
+        return results
+
     def _get_container_retry(self, retries, *args, **kwargs):
         '''Wrap Swift's get_container with retries.'''
         @retry(retries)
@@ -71,25 +301,45 @@ class Swift(object):
             return self.conn.get_container(*args, **kwargs)
         return func()
 
-    def list(self, bucket, prefix=None, delimiter=None, retries=3,
-                   headers=None, chunksize=100):
-        '''List the bucket, possibly limiting the search with a prefix.'''
-        listing =  self._get_container_retry(retries,
-                                           bucket,
-                                           prefix=prefix,
-                                           delimiter=delimiter,
-                                           limit=chunksize)[1]
+    def _iter_container(self, bucket, retries, chunksize, **kwargs):
+        '''Page through the listing of a container, yielding each result.'''
+        listing = self._get_container_retry(
+            retries, bucket, limit=chunksize, **kwargs)[1]
         while listing:
             for result in listing:
-                yield result['name']
+                yield result
             # out of results in current listing, get more starting at the end
-            marker = listing[-1]['name']
-            listing = self._get_container_retry(retries,
-                                              bucket,
-                                              prefix=prefix,
-                                              delimiter=delimiter,
-                                              marker=marker,
-                                              limit=chunksize)[1]
+            marker = listing[-1].get('name', listing[-1].get('subdir'))
+            listing = self._get_container_retry(
+                retries, bucket, marker=marker, limit=chunksize, **kwargs)[1]
+
+    def list(self, bucket, prefix=None, delimiter=None, retries=3,
+                   headers=None, chunksize=100):
+        '''List the bucket, possibly limiting the search with a prefix.'''
+        for result in self._iter_container(
+                bucket, retries, chunksize, prefix=prefix, delimiter=delimiter):
+            # With a delimiter, common prefixes come back as subdirs
+            yield result.get('name', result.get('subdir'))
+
+    def list_metadata(self, bucket, prefix=None, retries=3, headers=None,
+                      chunksize=100):
+        '''List the bucket with the size, etag and modification time of each
+        key, possibly limiting the search with a prefix. Static large objects
+        are marked as a manifest, since their etags are made from those of
+        their segments rather than their content.'''
+        for result in self._iter_container(
+                bucket, retries, chunksize, prefix=prefix):
+            modified = datetime.datetime.strptime(
+                result['last_modified'].split('.')[0], '%Y-%m-%dT%H:%M:%S')
+            meta = {
+                'key': result['name'],
+                'size': result['bytes'],
+                'etag': result['hash'],
+                'modified': calendar.timegm(modified.utctimetuple())
+            }
+            if 'slo_etag' in result:
+                meta['manifest'] = True
+            yield meta
 
     def delete(self, bucket, key, retries, headers=None):
         '''Delete bucket/key with headers'''
@@ -1,18 +1,89 @@
 '''Batching with gevent'''
 
+import collections
 import sys
-from six import reraise
+from six import reraise, string_types
 if 'threading' in sys.modules:
     del sys.modules['threading']
 from gevent import monkey
 monkey.patch_all()
+from gevent.event import Event
 from gevent.pool import Pool
 
+from . import trace
+
+
+class Scheduler(object):
+    '''Decides which of the queued greenlets to start when a slot in the pool
+    frees up. Greenlets are taken from the first of the priority classes that
+    has work queued and is under its concurrency limit. Within a class, flows
+    (like buckets) take turns, and each flow's greenlets run in order.'''
+
+    def __init__(self, pool, priorities, limits=None):
+        self.pool = pool
+        self.priorities = list(priorities)
+        self.limits = limits or {}
+        # The queued greenlets of each class, by flow, in turn order
+        self.queues = dict(
+            (cls, collections.OrderedDict()) for cls in self.priorities)
+        self.running = collections.Counter()
+        self.queued = 0
+        self.idle = Event()
+        self.idle.set()
+
+    def submit(self, cls, flow, greenlet):
+        '''Queue an unstarted greenlet in a class and flow'''
+        self.queues[cls].setdefault(flow, collections.deque()).append(greenlet)
+        self.queued += 1
+        self.idle.clear()
+        self.dispatch()
+
+    def next(self):
+        '''Dequeue the next greenlet to start, and its class, if any may start'''
+        for cls in self.priorities:
+            flows = self.queues[cls]
+            limit = self.limits.get(cls)
+            if not flows or (limit is not None and self.running[cls] >= limit):
+                continue
+            flow, queue = next(iter(flows.items()))
+            greenlet = queue.popleft()
+            # Send this flow to the back of the line
+            del flows[flow]
+            if queue:
+                flows[flow] = queue
+            self.queued -= 1
+            return cls, greenlet
+        return None, None
+
+    def dispatch(self):
+        '''Start greenlets while there's room for them'''
+        while self.pool.free_count() > 0:
+            cls, greenlet = self.next()
+            if greenlet is None:
+                break
+            self.running[cls] += 1
+            self.pool.start(greenlet)
+            # Linked after the pool's own link, so the pool has made room by
+            # the time this is called
+            greenlet.rawlink(lambda _, cls=cls: self.done(cls))
+
+    def done(self, cls):
+        '''A greenlet of class cls finished'''
+        self.running[cls] -= 1
+        self.dispatch()
+        if not self.queued and not sum(self.running.values()):
+            self.idle.set()
+
+    def join(self):
+        '''Wait until everything submitted has finished'''
+        self.idle.wait()
+
 
 class Proxy(object):
     '''A proxy that will run a function on a new connection in a gevent pool'''
-    def __init__(self, pool, func):
-        self.pool = pool
+    def __init__(self, batch, func):
+        self.batch = batch
+        self.pool = batch.pool
         self.func = func
         self._greenlet = None
 
@@ -20,11 +91,32 @@ class Proxy(object):
         '''Invoke our function with arguments'''
         callback = kwargs.pop('callback', None)
         if callback:
-            return callback(self.func(*args, **kwargs))
+            result = self.func(*args, **kwargs)
+            with trace.span('callback', 'batch'):
+                return callback(result)
         return self.func(*args, **kwargs)
 
+    def _queued(self, cls, queued, args, kwargs):
+        '''Record how long we waited in the queue, and then run'''
+        now = trace.clock()
+        self.batch.waited(cls, now - queued)
+        trace.record('queue', 'batch', queued, now, priority=cls)
+        return self.run(*args, **kwargs)
+
     def __call__(self, *args, **kwargs):
-        self._greenlet = self.pool.spawn(self.run, *args, **kwargs)
+        cls = kwargs.pop('priority', self.batch.default)
+        if cls not in self.batch.priorities:
+            self.batch.proxies.remove(self)
+            raise ValueError('Unknown priority class %r' % (cls,))
+        queued = trace.clock()
+        scheduler = self.batch.scheduler
+        if scheduler is None:
+            self._greenlet = self.pool.spawn(
+                self._queued, cls, queued, args, kwargs)
+        else:
+            self._greenlet = self.pool.greenlet_class(
+                self._queued, cls, queued, args, kwargs)
+            scheduler.submit(cls, self.batch.flow(*args, **kwargs), self._greenlet)
         return self._greenlet
 
     def __getattr__(self, attr):
@@ -34,17 +126,37 @@ class Proxy(object):
 class Batch(object):
     '''For uploading batches of objects in parallel. Implements the same
     interface as Connection, but just does it all in parallel. Can be used as a
-    ContextManager'''
+    ContextManager.
 
-    def __init__(self, connection, poolsize):
+    By default, requests start in the order they're made, and making one
+    waits for room in the pool. Requests may instead be scheduled: each may be
+    given a priority class (one of priorities, most important first) with a
+    priority keyword argument, classes may be limited in how many of their
+    requests run at once, and requests within a class may take turns by
+    bucket or prefix (fair). Scheduled requests are queued without waiting.'''
+    # The class of requests that don't name one
+    default = 'default'
+
+    def __init__(self, connection, poolsize, priorities=None, limits=None,
+                 fair=None):
         # Save a copy of connection, and the pool size
         self.conn = connection
         self.pool = Pool(poolsize)
         self.proxies = []
+        self.priorities = list(priorities or [self.default])
+        if self.default not in self.priorities:
+            self.priorities.append(self.default)
+        self.fair = fair
+        self.scheduler = None
+        if priorities or limits or fair:
+            self.scheduler = Scheduler(self.pool, self.priorities, limits)
+        # The count, total and maximum queue wait of each class
+        self.waits = dict(
+            (cls, {'count': 0, 'total': 0.0, 'max': 0.0}) for cls in self.priorities)
 
     def __getattr__(self, attr):
         # Return a proxy object that will perform the same action in a pool
-        proxy = Proxy(self.pool, getattr(self.conn, attr))
+        proxy = Proxy(self, getattr(self.conn, attr))
         self.proxies.append(proxy)
         return proxy
 
@@ -57,8 +169,37 @@ class Batch(object):
         if typ:   # pragma: no cover
             reraise(typ, val, trace)
 
+    def flow(self, bucket=None, key=None, *args, **kwargs):
+        '''The flow that a request takes turns within its class as part of.
+        With fair as 'bucket', by bucket, and as 'prefix', by the bucket and
+        the key up to its first '/'. It may also be a function of the
+        request's arguments.'''
+        if not self.fair:
+            return None
+        if callable(self.fair):
+            return self.fair(bucket, key, *args, **kwargs)
+        if self.fair == 'prefix' and isinstance(key, string_types) and '/' in key:
+            return (bucket, key.split('/', 1)[0])
+        return bucket
+
+    def waited(self, cls, seconds):
+        '''Record that a request of class cls waited seconds to start'''
+        waits = self.waits[cls]
+        waits['count'] += 1
+        waits['total'] += seconds
+        waits['max'] = max(waits['max'], seconds)
+
+    def queue_waits(self):
+        '''The count, total, mean and maximum seconds that requests of each
+        class waited before starting'''
+        return dict(
+            (cls, dict(waits, mean=waits['total'] / waits['count'] if waits['count'] else 0.0))
+            for cls, waits in self.waits.items())
+
     def wait(self):
         '''Wait until all our jobs are done'''
+        if self.scheduler is not None:
+            self.scheduler.join()
         self.pool.join()
 
     def success(self):
@@ -0,0 +1,216 @@
+'''Integrity checksums computed while data streams past'''
+
+import base64
+import binascii
+import hashlib
+import re
+import struct
+
+from six import text_type
+
+try:
+    import crc32c as _crc32c
+except ImportError:  # pragma: no cover
+    _crc32c = None
+
+
+def _crc32c_table():
+    '''The lookup table for the Castagnoli polynomial'''
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82F63B78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+_TABLE = _crc32c_table()
+
+
+def crc32c(data, crc=0):
+    '''Extend the CRC32C of some previous data with data. Uses the crc32c
+    package when it's available, and a (slow) pure-python version otherwise.'''
+    if _crc32c is not None:
+        return _crc32c.crc32c(data, crc)
+    crc ^= 0xFFFFFFFF
+    for byte in bytearray(data):
+        crc = _TABLE[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+    return crc ^ 0xFFFFFFFF
+
+
+def is_md5(etag):
+    '''Whether an etag looks like a plain hex md5'''
+    return bool(re.match(r'^[0-9a-f]{32}$', (etag or '').strip('"')))
+
+
+def multipart_etags(part_etags):
+    '''The etags that a multipart object made of parts with the provided (hex
+    md5) etags may have: S3's md5 of the part digests, with the part count,
+    and Swift's md5 of the concatenated part etags for manifests.'''
+    digests = b''.join(binascii.unhexlify(etag) for etag in part_etags)
+    return (
+        '%s-%i' % (hashlib.md5(digests).hexdigest(), len(part_etags)),
+        hashlib.md5(''.join(part_etags).encode('ascii')).hexdigest()
+    )
+
+
+def matches(backend, bucket, key, checksum, meta, retries=3):
+    '''Whether checksum matches the object with metadata meta, as
+    Checksum.matches. If that can't be told without the object's part size,
+    it's asked of backends that can say.'''
+    result = checksum.matches(meta['etag'], meta['headers'])
+    part_size = getattr(backend, 'part_size', None)
+    if result is None and part_size and checksum.part_size:
+        result = checksum.matches(
+            meta['etag'], meta['headers'], part_size(bucket, key, retries))
+    return result
+
+
+class Checksum(object):
+    '''Computes the MD5 of a stream, and of each part_size part of it, in one
+    pass. The CRC32C is computed too, if crc is set.'''
+
+    def __init__(self, part_size=None, crc=None):
+        if crc is None:
+            # Only when it won't slow us down
+            crc = _crc32c is not None
+        self.part_size = part_size
+        self.crc = 0 if crc else None
+        self.size = 0
+        self._md5 = hashlib.md5()
+        self._part = hashlib.md5()
+        self._part_size = 0
+        self._parts = []
+
+    def update(self, data):
+        '''Account for more of the stream'''
+        if isinstance(data, text_type):
+            data = data.encode('utf-8')
+        self.size += len(data)
+        self._md5.update(data)
+        if self.crc is not None:
+            self.crc = crc32c(data, self.crc)
+        if not self.part_size:
+            return
+        while data:
+            take = self.part_size - self._part_size
+            self._part.update(data[:take])
+            self._part_size += len(data[:take])
+            data = data[take:]
+            if self._part_size == self.part_size:
+                self._parts.append(self._part.hexdigest())
+                self._part, self._part_size = hashlib.md5(), 0
+
+    @property
+    def md5(self):
+        '''The hex md5 of everything so far'''
+        return self._md5.hexdigest()
+
+    @property
+    def content_md5(self):
+        '''The md5 as for a Content-MD5 header'''
+        return base64.b64encode(self._md5.digest()).decode('ascii')
+
+    @property
+    def crc32c(self):
+        '''The CRC32C as for an x-amz-checksum-crc32c header'''
+        return base64.b64encode(struct.pack('>I', self.crc)).decode('ascii')
+
+    @property
+    def parts(self):
+        '''The hex md5 of each part so far'''
+        if self._part_size:
+            return self._parts + [self._part.hexdigest()]
+        return list(self._parts)
+
+    def matches(self, etag, headers=None, part_size=None):
+        '''Whether or not the stream matches an etag and any checksum headers.
+        The etags of multipart uploads and Swift manifests are made from the
+        md5s of parts, so they can only be found not to match if the object's
+        part_size is known to be ours. Returns None if the etag can't be
+        checked.'''
+        headers = headers or {}
+        crc = headers.get('x-amz-checksum-crc32c')
+        if self.crc is not None and crc and '-' not in crc:
+            if crc != self.crc32c:
+                return False
+            checked = True
+        else:
+            checked = None
+
+        # Etags aren't md5s of objects encrypted with KMS or customer keys
+        if (headers.get('x-amz-server-side-encryption') == 'aws:kms' or
+                headers.get('x-amz-server-side-encryption-customer-algorithm')):
+            return checked
+
+        etag = (etag or '').strip('"')
+        if etag == self.md5:
+            return True
+        if self.part_size and self.parts and etag in multipart_etags(self.parts):
+            return True
+        manifest = ('x-object-manifest' in headers or
+            headers.get('x-static-large-object', '').lower() == 'true')
+        if '-' not in etag and not manifest:
+            return False
+        if part_size and part_size == self.part_size:
+            return False
+        return checked
+
+
+class HashingReader(object):
+    '''A file-like object that checksums what's read from another'''
+
+    def __init__(self, fobj, checksum):
+        self._fobj = fobj
+        self.checksum = checksum
+
+    def read(self, *args):
+        data = self._fobj.read(*args)
+        self.checksum.update(data)
+        return data
+
+    def seekable(self):
+        # Seeking would make the checksum meaningless
+        return False
+
+    def __getattr__(self, attr):
+        return getattr(self._fobj, attr)
+
+
+class HashingWriter(object):
+    '''A file-like object that checksums what's written to another. Seeking
+    back to where we started (as to retry a download) starts over. Backends
+    tell it the metadata of the object they're downloading, so that it can be
+    checked against that rather than a separate (and possibly stale) head.'''
+
+    def __init__(self, fobj, checksum_factory):
+        self._fobj = fobj
+        self._factory = checksum_factory
+        self._start = fobj.tell()
+        self.checksum = checksum_factory()
+        self.meta = None
+
+    def on_response(self, meta):
+        '''Remember the metadata of the object being downloaded'''
+        self.meta = meta
+        on_response = getattr(self._fobj, 'on_response', None)
+        if on_response:
+            on_response(meta)
+
+    def write(self, data):
+        self.checksum.update(data)
+        return self._fobj.write(data)
+
+    def seekable(self):
+        return False
+
+    def seek(self, offset, whence=0):
+        if (offset, whence) != (self._start, 0):
+            raise IOError('Can only seek back to the start of the stream')
+        self.checksum = self._factory()
+        self.meta = None
+        return self._fobj.seek(offset)
+
+    def __getattr__(self, attr):
+        return getattr(self._fobj, attr)
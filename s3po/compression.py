@@ -0,0 +1,184 @@
+'''Streaming compression of uploads and decompression of downloads'''
+
+import functools
+import zlib
+
+from six import text_type
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+
+# The Content-Encodings we know how to produce and consume
+ENCODINGS = ('gzip', 'zstd')
+
+
+def _check(encoding):
+    '''Make sure we can handle encoding'''
+    if encoding not in ENCODINGS:
+        raise ValueError('Unsupported encoding %r' % encoding)
+    if encoding == 'zstd' and zstandard is None:
+        raise ValueError('zstd encoding requires the zstandard package')
+
+
+def compressor(encoding, level=None):
+    '''An object with compress and flush methods that produces one gzip member
+    or zstd frame.'''
+    _check(encoding)
+    if encoding == 'gzip':
+        # Offsetting wbits by 16 gives us a gzip header and trailer
+        return zlib.compressobj(
+            6 if level is None else level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return zstandard.ZstdCompressor(level=3 if level is None else level).compressobj()
+
+
+def decompressor(encoding):
+    '''An object with a decompress method that consumes one gzip member or
+    zstd frame, leaving anything after it in unused_data.'''
+    _check(encoding)
+    if encoding == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def compress_block(encoding, data, level=None):
+    '''Compress data into a complete, standalone gzip member or zstd frame.
+    Concatenated blocks are themselves valid, which is what lets us compress
+    blocks independently in other processes.'''
+    obj = compressor(encoding, level)
+    return obj.compress(data) + obj.flush()
+
+
+class CompressingReader(object):
+    '''A file-like object that compresses the contents of another as it's
+    read. If a pool (anything with a map method, like multiprocessing.Pool or
+    concurrent.futures.ProcessPoolExecutor) is provided, window blocks at a
+    time are compressed independently in parallel.'''
+    # How much of the source to compress at a time
+    block_size = 1024 * 1024
+
+    def __init__(self, fobj, encoding, level=None, pool=None, window=8):
+        _check(encoding)
+        self._fobj = fobj
+        self._encoding = encoding
+        self._level = level
+        self._pool = pool
+        self._window = window
+        self._compressor = None if pool else compressor(encoding, level)
+        self._buffer = b''
+        self._offset = 0
+        self._done = False
+        self.raw = 0
+        self.compressed = 0
+
+    def _read_block(self):
+        '''Read a block of the source as bytes'''
+        block = self._fobj.read(self.block_size)
+        if isinstance(block, text_type):
+            block = block.encode('utf-8')
+        self.raw += len(block)
+        return block
+
+    def _fill(self):
+        '''Compress more of the source into our buffer'''
+        # Drop what has already been read
+        self._buffer, self._offset = self._buffer[self._offset:], 0
+        if self._pool is None:
+            block = self._read_block()
+            if block:
+                self._buffer += self._compressor.compress(block)
+            else:
+                self._buffer += self._compressor.flush()
+                self._done = True
+            return
+
+        blocks = []
+        for _ in range(self._window):
+            block = self._read_block()
+            if not block:
+                self._done = True
+                break
+            blocks.append(block)
+        func = functools.partial(compress_block, self._encoding, level=self._level)
+        self._buffer += b''.join(self._pool.map(func, blocks))
+        if self._done and not self.raw:
+            # An empty source still makes for a valid (empty) stream
+            self._buffer += compress_block(self._encoding, b'', self._level)
+
+    def read(self, size=-1):
+        '''Read up to size bytes of compressed data'''
+        if size is None or size < 0:
+            while not self._done:
+                self._fill()
+            size = len(self._buffer) - self._offset
+        while not self._done and len(self._buffer) - self._offset < size:
+            self._fill()
+        result = self._buffer[self._offset:self._offset + size]
+        self._offset += len(result)
+        self.compressed += len(result)
+        return result
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+
+class DecompressingWriter(object):
+    '''A file-like object that decompresses what's written to it into another.
+    Handles streams of several concatenated gzip members or zstd frames. Its
+    position is measured in compressed bytes, so that checks against the
+    content-length of the compressed object still hold. Without an encoding,
+    it's taken from the Content-Encoding of the response that backends tell
+    it about, and anything not compressed with one we know passes through.'''
+
+    def __init__(self, fobj, encoding=None):
+        self._fobj = fobj
+        self._encoding = encoding
+        self._decompressor = encoding and decompressor(encoding)
+        self._start = fobj.tell()
+        self._written = 0
+
+    def on_response(self, meta):
+        '''Decompress according to the response's Content-Encoding'''
+        encoding = meta['headers'].get('content-encoding')
+        self._encoding = encoding if encoding in ENCODINGS else None
+        self._decompressor = self._encoding and decompressor(self._encoding)
+        on_response = getattr(self._fobj, 'on_response', None)
+        if on_response:
+            on_response(meta)
+
+    def write(self, data):
+        '''Decompress data into our file object'''
+        self._written += len(data)
+        if not self._decompressor:
+            self._fobj.write(data)
+            return
+        while data:
+            self._fobj.write(self._decompressor.decompress(data))
+            if not self._decompressor.eof:
+                break
+            # Anything left over is the start of the next member or frame
+            data = self._decompressor.unused_data
+            self._decompressor = decompressor(self._encoding)
+
+    def tell(self):
+        return self._start + self._written
+
+    def seekable(self):
+        return False
+
+    def seek(self, offset, whence=0):
+        '''We can only go back to the start (as to retry a download), which
+        starts a fresh stream.'''
+        if (offset, whence) != (self._start, 0):
+            raise IOError('Can only seek back to the start of the stream')
+        self._decompressor = self._encoding and decompressor(self._encoding)
+        self._written = 0
+        return self._fobj.seek(self._start)
+
+    def __getattr__(self, attr):
+        return getattr(self._fobj, attr)
@@ -1,14 +1,18 @@
 '''Deal with object storage.'''
 
+import collections
 import contextlib
 import os
-from six import StringIO
+import sys
+import threading
+from six import BytesIO, StringIO
 from six import string_types
 
 # Internal imports
-from .util import logger
-from .backends.s3 import S3
-from .backends.swift import Swift
+from . import trace
+from .exceptions import ChecksumException, DownloadException
+from .trace import traced
+from .util import logger, new_pool, SingleFlight
 from .backends.memory import Memory
 
 
@@ -18,24 +22,51 @@ class Connection(object):
     @classmethod
     def s3(cls, *args, **kwargs):  # pragma: no cover
         '''Create a connection using S3.'''
+        # Imported here so that boto3 is only loaded when it's needed
+        from .backends.s3 import S3
         return cls(S3(*args, **kwargs))
 
     @classmethod
     def swift(cls, *args, **kwargs):  # pragma: no cover
         '''Create a connection using Swift.'''
+        from .backends.swift import Swift
         return cls(Swift(*args, **kwargs))
 
+    @classmethod
+    def replicated(cls, backends, **kwargs):
+        '''Create a connection that replicates across several backends (or
+        connections). See s3po.backends.replicated.'''
+        from .backends.replicated import Replicated
+        return cls(Replicated(
+            [getattr(backend, 'backend', backend) for backend in backends],
+            **kwargs))
+
     @classmethod
     def memory(cls):
         '''Create a connection using the in-memory backend.'''
         return cls(Memory())
 
-    def __init__(self, backend):
+    def __init__(self, backend, coalesce=True):
         self.backend = backend
+        # Concurrent downloads of the same key share a single fetch
+        self.inflight = SingleFlight() if coalesce else None
 
-    def batch(self, poolsize=20):
+    def batch(self, poolsize=20, priorities=None, limits=None, fair=None):
+        '''Run operations in parallel in a gevent pool. See s3po.batch.Batch
+        for scheduling them by priority, limits and fairness.'''
         from .batch import Batch
-        return Batch(self, poolsize)
+        return Batch(self, poolsize, priorities, limits, fair)
+
+    @contextlib.contextmanager
+    def trace(self, tracer=None):
+        '''Record spans of what every operation spends its time on while
+        active, yielding the Tracer. See s3po.trace.'''
+        tracer = tracer or trace.Tracer()
+        instrument = getattr(self.backend, 'instrument', None)
+        if instrument:
+            instrument()
+        with tracer:
+            yield tracer
 
     @contextlib.contextmanager
     def mock(self):
@@ -47,50 +78,321 @@ class Connection(object):
         finally:
             self.backend = original
 
-    def upload(self, bucket, key, obj_or_data, headers=None, extra=None, retries=3):
-        '''Upload the provided string or file object to bucket/key'''
+    @traced('upload')
+    def upload(self, bucket, key, obj_or_data, headers=None, extra=None, retries=3,
+               encoding=None, pool=None, verify=False):
+        '''Upload the provided string or file object to bucket/key. If an
+        encoding ('gzip' or 'zstd') is provided, the data is compressed as it
+        streams to the backend and its Content-Encoding set accordingly. A pool
+        with a map method can be provided to compress on several cores. With
+        verify, the MD5 of the data is computed as it streams, and compared to
+        the resulting object's etag, retrying on a mismatch if the source can
+        be rewound.'''
         logger.info('Uploading to %s / %s', bucket, key)
+        if isinstance(obj_or_data, string_types):
+            obj_or_data = StringIO(obj_or_data)
+        if encoding:
+            headers = dict(headers or {}, **{'Content-Encoding': encoding})
         opts = {}
         if extra:
             opts['extra'] = extra
         if headers:
             opts['headers'] = headers
-        if isinstance(obj_or_data, string_types):
-            return self.backend.upload(
-                bucket, key, StringIO(obj_or_data), retries=retries, **opts)
-        else:
+        if not verify:
             return self.backend.upload(
-                bucket, key, obj_or_data, retries=retries, **opts)
+                bucket, key, self._encode(obj_or_data, encoding, pool),
+                retries=retries, **opts)
+
+        from .checksum import Checksum, HashingReader, matches
+        start = obj_or_data.tell()
+        for attempt in range(retries + 1):
+            reader = HashingReader(
+                self._encode(obj_or_data, encoding, pool),
+                Checksum(self.backend.multipart_chunk_size))
+            result = self.backend.upload(
+                bucket, key, reader, retries=retries, **opts)
+            meta = self.backend.head(bucket, key, retries)
+            if matches(self.backend, bucket, key, reader.checksum, meta,
+                       retries) is not False:
+                return result
+            logger.warning('Checksum mismatch uploading %s / %s (attempt %i)',
+                bucket, key, attempt)
+            obj_or_data.seek(start)
+        raise ChecksumException('Checksum mismatch uploading %s / %s' % (bucket, key))
 
-    def upload_file(self, bucket, key, path, headers=None, extra=None, retries=3):
+    def _encode(self, obj, encoding, pool):
+        '''Wrap obj to be compressed with encoding, if provided'''
+        if not encoding:
+            return obj
+        from .compression import CompressingReader
+        return CompressingReader(obj, encoding, pool=pool)
+
+    @traced('upload_file')
+    def upload_file(self, bucket, key, path, headers=None, extra=None, retries=3,
+                    mode='r', checkpoint=None, encoding=None, pool=None,
+                    verify=False):
         '''Upload the file at path to bucket/key. This method is important for
         use in batch mode, so that the file object can be used with the right
-        context management'''
-        with open(os.path.abspath(path)) as fobj:
+        context management. If a checkpoint path is provided, the file is
+        uploaded in parts and progress is recorded there, so that repeating
+        the call after an interruption resumes the upload. Such uploads are of
+        the file's bytes as they are, so can't be compressed.'''
+        if checkpoint:
+            if encoding or mode not in ('r', 'rb'):
+                raise ValueError(
+                    'Resumable uploads are binary and uncompressed')
+            from . import resumable
+            logger.info('Resumably uploading to %s / %s', bucket, key)
+            return resumable.upload(
+                self.backend, bucket, key, os.path.abspath(path), checkpoint,
+                self.backend.multipart_chunk_size, retries=retries,
+                verify=verify, headers=headers, extra=extra)
+        with open(os.path.abspath(path), mode) as fobj:
             return self.upload(
                 bucket, key, fobj,
-                headers=headers, extra=extra, retries=retries)
+                headers=headers, extra=extra, retries=retries,
+                encoding=encoding, pool=pool, verify=verify)
 
-    def download(self, bucket, key, obj=None, headers=None, retries=3):
-        '''Download to either the object or return a string'''
+    @traced('download')
+    def download(self, bucket, key, obj=None, headers=None, retries=3,
+                 decompress=False, verify=False):
+        '''Download to either the object or return a string. When returning a
+        string, identical downloads already in flight are shared rather than
+        fetched again. With decompress, objects with a gzip or zstd
+        Content-Encoding are decompressed as they stream in (and bytes are
+        returned rather than a string). With verify, the MD5 (and CRC32C when
+        available) of the data is computed as it streams, and compared to the
+        object's etag and checksum headers, retrying on a mismatch.'''
         logger.info('Downloading %s / %s', bucket, key)
         if obj:
+            return self._download(
+                bucket, key, obj, headers, retries, decompress, verify)
+        if self.inflight is None:
+            return self._download_string(
+                bucket, key, headers, retries, decompress, verify)
+        flight = (
+            bucket, key, tuple(sorted((headers or {}).items())), decompress, verify)
+        return self.inflight.do(
+            flight, self._download_string, bucket, key, headers, retries,
+            decompress, verify)
+
+    def _download(self, bucket, key, obj, headers, retries, decompress, verify):
+        '''Download bucket/key into obj, decompressing and verifying if need be'''
+        if not (decompress or verify):
+            return self.backend.download(bucket, key, obj, retries, headers)
+
+        if decompress:
+            # Which decompression, if any, depends on the response
+            from .compression import DecompressingWriter
+            obj = DecompressingWriter(obj)
+        if not verify:
             return self.backend.download(bucket, key, obj, retries, headers)
-        obj = StringIO()
-        self.backend.download(bucket, key, obj, retries, headers)
+
+        # Checksum the data as stored, before any decompression
+        from .checksum import Checksum, HashingWriter, matches
+        part_size = self.backend.multipart_chunk_size
+        writer = HashingWriter(obj, lambda: Checksum(part_size))
+        start = writer.tell()
+        for attempt in range(retries + 1):
+            result = self.backend.download(bucket, key, writer, retries, headers)
+            # Compare with the object that was actually downloaded, if the
+            # backend said what it was
+            meta = writer.meta or self.backend.head(bucket, key, retries)
+            if matches(self.backend, bucket, key, writer.checksum, meta,
+                       retries) is not False:
+                return result
+            logger.warning('Checksum mismatch downloading %s / %s (attempt %i)',
+                bucket, key, attempt)
+            writer.seek(start)
+            writer.truncate()
+        raise ChecksumException('Checksum mismatch downloading %s / %s' % (
+            bucket, key))
+
+    def _download_string(self, bucket, key, headers, retries, decompress=False,
+                         verify=False):
+        '''Download bucket/key and return its contents'''
+        obj = BytesIO() if decompress else StringIO()
+        self._download(bucket, key, obj, headers, retries, decompress, verify)
         return obj.getvalue()
 
-    def download_file(self, bucket, key, path, headers=None, retries=3, mode='w'):
+    @traced('download_file')
+    def download_file(self, bucket, key, path, headers=None, retries=3, mode='w',
+                      checkpoint=None, decompress=False, verify=False):
         '''Download the item at bucket/key to a file at path. This method is
         important for us in batch mode so that the file object can be used with
-        the right context management'''
-        with open(os.path.abspath(path), mode) as fout:
-            return self.download(bucket, key, fout, headers, retries)
+        the right context management. If a checkpoint path is provided, the
+        object is downloaded in ranges and progress is recorded there, so that
+        repeating the call after an interruption resumes the download. Such
+        downloads are of the object's bytes as they are, so can't be
+        decompressed.'''
+        if checkpoint:
+            if decompress or mode not in ('w', 'wb'):
+                raise ValueError(
+                    'Resumable downloads are binary and not decompressed')
+            from . import resumable
+            logger.info('Resumably downloading %s / %s', bucket, key)
+            resumable.download(
+                self.backend, bucket, key, os.path.abspath(path), checkpoint,
+                self.backend.multipart_chunk_size, retries=retries,
+                verify=verify, headers=headers)
+            return
+        # Decompressed data is bytes
+        with open(os.path.abspath(path), 'wb' if decompress else mode) as fout:
+            return self.download(
+                bucket, key, fout, headers, retries,
+                decompress=decompress, verify=verify)
+
+    def prefetch(self, bucket, keys, depth=10, max_bytes=None, headers=None,
+                 retries=3):
+        '''Download each of keys, yielding (key, data) in the original order
+        while downloading up to depth objects ahead in a pool (see
+        s3po.util.new_pool). If max_bytes is provided, downloads are only
+        started while the sizes of those in flight or waiting to be consumed
+        add up to no more than that (though one is always allowed, however
+        big). Keys may be the metadata that list_metadata yields, whose sizes
+        are used as they are; the size of any other key is found with a head,
+        made ahead of time along with its download.'''
+        pool = new_pool(depth)
+        pending = collections.deque()
+        # Downloads reserve their size of the budget in the original order
+        budget = {'turn': 0, 'held': 0, 'holding': 0, 'closed': False}
+        condition = sys.modules.get('threading', threading).Condition()
+
+        def size_of(item):
+            '''The size of an item, if it matters'''
+            if isinstance(item, dict):
+                return item['size']
+            if max_bytes is None:
+                return 0
+            try:
+                return self.backend.head(bucket, item, retries, headers)['size']
+            except DownloadException:
+                # Let the download fail in its turn
+                return 0
+
+        def fetch(index, key, item):
+            '''Wait for room in the budget, and then download'''
+            size = size_of(item)
+            with condition:
+                while not budget['closed'] and (
+                        budget['turn'] != index or (
+                            max_bytes is not None and budget['holding'] and
+                            budget['held'] + size > max_bytes)):
+                    condition.wait()
+                if budget['closed']:
+                    return size, None
+                budget['turn'] += 1
+                budget['held'] += size
+                budget['holding'] += 1
+                condition.notify_all()
+            return size, self.download(
+                bucket, key, headers=headers, retries=retries)
+
+        def release(size):
+            '''Give back the budget of an item that's been consumed'''
+            with condition:
+                budget['held'] -= size
+                budget['holding'] -= 1
+                condition.notify_all()
+
+        try:
+            for index, item in enumerate(keys):
+                key = item['key'] if isinstance(item, dict) else item
+                pending.append((key, pool.spawn(fetch, index, key, item)))
+                while len(pending) >= depth:
+                    key, task = pending.popleft()
+                    size, data = task.get()
+                    yield key, data
+                    release(size)
+            while pending:
+                key, task = pending.popleft()
+                size, data = task.get()
+                yield key, data
+                release(size)
+        finally:
+            # If we're abandoned partway through, don't leave work running
+            with condition:
+                budget['closed'] = True
+                condition.notify_all()
+            pool.kill()
+
+    @traced('read_ranges')
+    def read_ranges(self, bucket, key, ranges, gap=64 * 1024, concurrency=10,
+                    headers=None, retries=3):
+        '''Read each of the (offset, length) ranges of bucket/key, returning
+        a memoryview of each in the original order. Ranges that are at most
+        gap bytes apart are merged into a single read, and up to concurrency
+        reads are made at once in a pool. The views share the memory
+        of the merged reads, so nothing is copied. Ranges that run past the
+        end of the object are cut short, but (as with read_range) one that
+        starts at or beyond the end raises DownloadException, unless it's
+        merged with others that don't.'''
+        from .util import coalesce
+        # Ranges may come as lists, as from JSON
+        ranges = [tuple(span) for span in ranges]
+        runs = coalesce(set(span for span in ranges if span[1]), gap)
+        logger.info('Reading %i ranges of %s / %s in %i requests',
+            len(ranges), bucket, key, len(runs))
+
+        def fetch(run):
+            '''Read one merged run'''
+            offset, length, _ = run
+            with trace.span('read_range', offset=offset, length=length):
+                return memoryview(self.backend.read_range(
+                    bucket, key, offset, length, retries, headers))
+
+        if len(runs) > 1:
+            chunks = new_pool(concurrency).map(fetch, runs)
+        else:
+            chunks = [fetch(run) for run in runs]
+
+        views = {}
+        for (start, _, members), chunk in zip(runs, chunks):
+            for offset, length in members:
+                views[(offset, length)] = chunk[offset - start:offset - start + length]
+        empty = memoryview(b'')
+        return [views.get(span, empty) for span in ranges]
+
+    def pack_writer(self, bucket, key, **kwargs):
+        '''Get a writer that packs many small values into the one object at
+        bucket/key. See s3po.pack.PackWriter for options.'''
+        from .pack import PackWriter
+        return PackWriter(self, bucket, key, **kwargs)
+
+    def pack_reader(self, bucket, key, **kwargs):
+        '''Get a reader for the values packed into bucket/key. See
+        s3po.pack.PackReader for options.'''
+        from .pack import PackReader
+        return PackReader(self, bucket, key, **kwargs)
 
     def list(self, bucket, prefix=None, delimiter=None, retries=3, headers=None):
         '''List the contents of the bucket, optionally specifying a prefix.'''
         return self.backend.list(bucket, prefix, delimiter, retries, headers)
 
+    def list_metadata(self, bucket, prefix=None, retries=3, headers=None):
+        '''List the contents of the bucket, optionally specifying a prefix,
+        as dictionaries of the key, size, etag and modification time.'''
+        return self.backend.list_metadata(bucket, prefix, retries, headers)
+
+    def sync_up(self, local_dir, bucket, prefix='', **kwargs):
+        '''Upload only the files in local_dir that are new or changed relative
+        to bucket/prefix. See s3po.sync.sync_up for options.'''
+        from .sync import sync_up
+        return sync_up(self, local_dir, bucket, prefix, **kwargs)
+
+    def sync_down(self, bucket, prefix, local_dir, **kwargs):
+        '''Download only the keys in bucket/prefix that are new or changed
+        relative to local_dir. See s3po.sync.sync_down for options.'''
+        from .sync import sync_down
+        return sync_down(self, bucket, prefix, local_dir, **kwargs)
+
+    def download_tree(self, bucket, prefix, dest_dir, **kwargs):
+        '''Download everything in bucket/prefix into dest_dir in parallel,
+        writing each file atomically. See s3po.sync.download_tree for options.'''
+        from .sync import download_tree
+        return download_tree(self, bucket, prefix, dest_dir, **kwargs)
+
+    @traced('delete')
     def delete(self, bucket, key, headers=None, retries=3):
         '''Delete the bucket/key'''
         logger.info('Deleting %s / %s', bucket, key)
@@ -19,3 +19,8 @@ class UploadException(S3POException):
 class DeleteException(S3POException):
     '''An error while deleting'''
     pass
+
+
+class ChecksumException(S3POException):
+    '''Data did not match its checksum'''
+    pass
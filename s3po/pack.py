@@ -0,0 +1,184 @@
+'''Packing many small objects into one, with a trailing index.
+
+A pack is the concatenated values, followed by a zlib-compressed index of
+(offset, length, key) for each of them, followed by a fixed-size footer with
+the index's length and a magic number:
+
+    [value][value]...[index][index length (8 bytes)][magic (8 bytes)]
+
+Readers fetch the index once with a suffix range, and then fetch values with
+Connection.read_ranges, which coalesces values stored near each other.'''
+
+import struct
+import tempfile
+import zlib
+
+from six import text_type
+
+from .exceptions import DownloadException
+from .util import logger
+
+
+MAGIC = b'S3POPAK1'
+FOOTER = struct.Struct('>Q8s')
+# Each index entry is the offset, length and key length, followed by the key
+ENTRY = struct.Struct('>QIH')
+
+
+def encode_index(entries):
+    '''Serialize (key, offset, length) entries into a compressed index'''
+    parts = []
+    for key, offset, length in entries:
+        name = key.encode('utf-8')
+        parts.append(ENTRY.pack(offset, length, len(name)))
+        parts.append(name)
+    return zlib.compress(b''.join(parts))
+
+
+def decode_index(data):
+    '''Deserialize a compressed index into a dictionary of key to (offset,
+    length)'''
+    data = zlib.decompress(data)
+    index = {}
+    position = 0
+    while position < len(data):
+        offset, length, size = ENTRY.unpack_from(data, position)
+        position += ENTRY.size
+        key = data[position:position + size].decode('utf-8')
+        position += size
+        index[key] = (offset, length)
+    return index
+
+
+class PackWriter(object):
+    '''Appends values to a pack, which is uploaded to bucket/key when closed.
+    Values are spooled to a temporary file once they exceed max_memory.
+    Can be used as a ContextManager, which uploads on a clean exit.'''
+
+    def __init__(self, connection, bucket, key, retries=3, max_memory=16 * 1024 * 1024):
+        self.conn = connection
+        self.bucket = bucket
+        self.key = key
+        self.retries = retries
+        self._fobj = tempfile.SpooledTemporaryFile(max_size=max_memory)
+        self._entries = []
+        self._keys = set()
+        self._offset = 0
+        self.closed = False
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, key, data):
+        '''Append data to the pack as key'''
+        if self.closed:
+            raise ValueError('Cannot add to a closed pack')
+        if key in self._keys:
+            raise ValueError('Duplicate key %r in pack' % key)
+        if isinstance(data, text_type):
+            data = data.encode('utf-8')
+        self._fobj.write(data)
+        self._entries.append((key, self._offset, len(data)))
+        self._keys.add(key)
+        self._offset += len(data)
+
+    def close(self):
+        '''Write the index and upload the pack'''
+        if self.closed:
+            return
+        index = encode_index(self._entries)
+        self._fobj.write(index)
+        self._fobj.write(FOOTER.pack(len(index), MAGIC))
+        self._fobj.seek(0)
+        logger.info('Uploading pack of %i values to %s / %s',
+            len(self._entries), self.bucket, self.key)
+        try:
+            self.conn.upload(self.bucket, self.key, self._fobj, retries=self.retries)
+        finally:
+            self._fobj.close()
+            self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, val, trace):
+        if typ is None:
+            self.close()
+        else:
+            self._fobj.close()
+            self.closed = True
+
+
+class PackReader(object):
+    '''Serves values out of the pack at bucket/key with ranged reads. The
+    index is fetched on first use, speculatively reading the last
+    index_guess bytes of the pack to get it in a single request. Values
+    fewer than gap bytes apart are fetched with a single read, and up to
+    concurrency reads are made at once.'''
+
+    def __init__(self, connection, bucket, key, retries=3, gap=64 * 1024,
+                 index_guess=64 * 1024, concurrency=10):
+        self.conn = connection
+        self.bucket = bucket
+        self.key = key
+        self.retries = retries
+        self.gap = gap
+        self.index_guess = index_guess
+        self.concurrency = concurrency
+        self._index = None
+
+    def _read(self, offset, length):
+        '''Read a range of the pack'''
+        return self.conn.backend.read_range(
+            self.bucket, self.key, offset, length, self.retries)
+
+    @property
+    def index(self):
+        '''A dictionary of key to (offset, length) within the pack'''
+        if self._index is None:
+            tail = self._read(None, max(self.index_guess, FOOTER.size))
+            if len(tail) < FOOTER.size:
+                raise DownloadException('%s / %s is not a pack' % (self.bucket, self.key))
+            size, magic = FOOTER.unpack(tail[-FOOTER.size:])
+            if magic != MAGIC:
+                raise DownloadException('%s / %s is not a pack' % (self.bucket, self.key))
+            needed = size + FOOTER.size
+            if len(tail) < needed:
+                # Our guess didn't get the whole index
+                tail = self._read(None, needed)
+            self._index = decode_index(tail[len(tail) - needed:-FOOTER.size])
+        return self._index
+
+    def keys(self):
+        '''The keys in the pack, in the order they were added'''
+        return sorted(self.index, key=self.index.get)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def _span(self, key):
+        '''The (offset, length) of a key'''
+        try:
+            return self.index[key]
+        except KeyError:
+            raise DownloadException('%s not in pack %s / %s' % (
+                key, self.bucket, self.key))
+
+    def get(self, key):
+        '''Get the value of key'''
+        offset, length = self._span(key)
+        if not length:
+            return b''
+        return self._read(offset, length)
+
+    def get_many(self, keys):
+        '''Get the values of several keys as a dictionary, coalescing reads of
+        values that are stored close together'''
+        keys = list(keys)
+        views = self.conn.read_ranges(
+            self.bucket, self.key, [self._span(key) for key in keys],
+            gap=self.gap, concurrency=self.concurrency, retries=self.retries)
+        return dict((key, view.tobytes()) for key, view in zip(keys, views))
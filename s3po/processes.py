@@ -0,0 +1,254 @@
+'''Batching across worker processes.
+
+A Batch runs every operation, and its callback, on greenlets in one process,
+so callbacks that do real work (decoding, decompressing, parsing) take turns on
+one core and stall everything else. A ProcessBatch shards operations across
+worker processes, each with its own connection and gevent pool, and runs the
+callbacks there too. Results (or what the callbacks return) come back in the
+order that the operations were made:
+
+    factory = functools.partial(Connection.s3, **kwargs)
+    with ProcessBatch(factory, processes=4, poolsize=20) as batch:
+        for key in keys:
+            batch.download('bucket', key, callback=json.loads)
+    documents = batch.results()
+
+Since they cross process boundaries, the factory, the arguments, the callbacks
+and whatever they return must all be picklable: module-level functions rather
+than lambdas, and paths rather than file objects.
+
+Workers are separate interpreters running this module, and talk to us with
+pickles over their stdin and stdout. The standard library's multiprocessing
+isn't used, since its pools rely on threads and locks that hang once gevent
+has monkey-patched them, and forking a process that's already running a gevent
+hub is asking for trouble. Like multiprocessing's spawn mode, workers load the
+main script as __mp_main__ so that functions defined in it can be used, which
+means that it must guard what it runs with `if __name__ == '__main__'`.'''
+
+import os
+import pickle
+import runpy
+import sys
+import types
+from multiprocessing import cpu_count
+
+# Importing batch makes sure that gevent has been monkey-patched
+from . import batch
+import gevent
+from gevent import subprocess
+from gevent.event import AsyncResult
+from gevent.fileobject import FileObject
+from gevent.lock import Semaphore
+
+from .exceptions import S3POException
+from .util import logger
+
+
+class WorkerException(S3POException):
+    '''A worker process failed, or an outcome couldn't be sent back'''
+    pass
+
+
+def dumps(seq, ok, value):
+    '''Pickle an outcome, replacing a value that can't be with an exception.
+    The value is pickled twice, so that one that can't be unpickled on the
+    other end fails alone.'''
+    try:
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    except Exception as exc:
+        ok, data = False, pickle.dumps(WorkerException(
+            'Could not send back %r: %s' % (value, exc)), pickle.HIGHEST_PROTOCOL)
+    return pickle.dumps((seq, ok, data), pickle.HIGHEST_PROTOCOL)
+
+
+def load_main(path):
+    '''Load the main script at path as __mp_main__, and make it our __main__,
+    so that what's pickled from the parent's __main__ can be found'''
+    if not path or not os.path.exists(path):
+        return
+    module = types.ModuleType('__mp_main__')
+    module.__dict__.update(runpy.run_path(path, run_name='__mp_main__'))
+    sys.modules['__main__'] = sys.modules['__mp_main__'] = module
+
+
+def serve(fin, fout):
+    '''Run a worker, reading the parent's main script, the connection factory
+    and pool size, and then calls from fin, and writing their outcomes to fout'''
+    load_main(pickle.load(fin))
+    factory, poolsize = pickle.load(fin)
+    conn = factory()
+    pool = batch.Pool(poolsize)
+    lock = Semaphore()
+
+    def run(seq, call):
+        '''Make one call, and send back how it went'''
+        try:
+            name, args, kwargs, callback = pickle.loads(call)
+            value = getattr(conn, name)(*args, **kwargs)
+            if callback:
+                value = callback(value)
+            data = dumps(seq, True, value)
+        except Exception as exc:
+            data = dumps(seq, False, exc)
+        with lock:
+            fout.write(data)
+            fout.flush()
+
+    while True:
+        try:
+            message = pickle.load(fin)
+        except EOFError:
+            break
+        if message is None:
+            break
+        pool.spawn(run, *message)
+    pool.join()
+
+
+def main():
+    '''The entry point of worker processes'''
+    # Keep stdout for our messages, and send anything printed to stderr
+    output = os.dup(1)
+    os.dup2(2, 1)
+    serve(FileObject(0, 'rb'), FileObject(output, 'wb'))
+
+
+class Worker(object):
+    '''A worker process, and the calls it has yet to finish'''
+    def __init__(self, factory, poolsize):
+        # Workers need to be able to import whatever we can
+        path = os.pathsep.join(entry or os.getcwd() for entry in sys.path)
+        self.process = subprocess.Popen(
+            [sys.executable, '-c', 'from s3po.processes import main; main()'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            env=dict(os.environ, PYTHONPATH=path))
+        self.lock = Semaphore()
+        self.pending = {}
+        main = getattr(sys.modules['__main__'], '__file__', None)
+        self.send(pickle.dumps(main and os.path.abspath(main)))
+        self.send(pickle.dumps((factory, poolsize), pickle.HIGHEST_PROTOCOL))
+
+    def send(self, data):
+        '''Send a pickled message'''
+        with self.lock:
+            self.process.stdin.write(data)
+            self.process.stdin.flush()
+
+    def alive(self):
+        '''Whether the worker process is still running'''
+        return self.process.poll() is None
+
+    def receive(self):
+        '''Settle the results of calls as their outcomes come back'''
+        try:
+            while True:
+                seq, ok, data = pickle.load(self.process.stdout)
+                result = self.pending.pop(seq)
+                try:
+                    value = pickle.loads(data)
+                except Exception as exc:
+                    ok, value = False, WorkerException(
+                        'Could not unpickle an outcome: %s' % exc)
+                if ok:
+                    result.set(value)
+                else:
+                    result.set_exception(value)
+        except EOFError:
+            pass
+        except Exception:
+            # We can't make sense of what it's sending, so give up on it
+            logger.exception('Bad message from worker %i', self.process.pid)
+            self.process.kill()
+        code = self.process.wait()
+        for result in self.pending.values():
+            result.set_exception(WorkerException(
+                'Worker %i exited with %i' % (self.process.pid, code)))
+        self.pending.clear()
+
+    def close(self):
+        '''Ask the worker to finish what it has, and exit'''
+        try:
+            self.send(pickle.dumps(None))
+            self.process.stdin.close()
+        except (IOError, OSError):  # pragma: no cover
+            logger.warning('Worker %i had already exited', self.process.pid)
+
+
+class Proxy(object):
+    '''A proxy that sends calls of an operation to a worker'''
+    def __init__(self, batch, name):
+        self.batch = batch
+        self.name = name
+
+    def __call__(self, *args, **kwargs):
+        callback = kwargs.pop('callback', None)
+        return self.batch.submit(self.name, args, kwargs, callback)
+
+
+class ProcessBatch(object):
+    '''For running batches of operations across processes. Implements the
+    same interface as Batch, with each operation returning an AsyncResult.
+    Can be used as a ContextManager.'''
+
+    def __init__(self, factory, processes=None, poolsize=20):
+        self.workers = [
+            Worker(factory, poolsize) for _ in range(processes or cpu_count())]
+        self.receivers = [gevent.spawn(worker.receive) for worker in self.workers]
+        self.calls = []
+
+    def __getattr__(self, attr):
+        # Return a proxy object that will perform the same action in a worker
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        return Proxy(self, attr)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, val, trace):
+        self.close()
+
+    def submit(self, name, args, kwargs, callback=None):
+        '''Send a call to the worker with the fewest calls in flight'''
+        seq = len(self.calls)
+        # Pickled twice, so that a call that can't be unpickled in the worker
+        # fails alone
+        data = pickle.dumps((seq, pickle.dumps(
+            (name, args, kwargs, callback), pickle.HIGHEST_PROTOCOL)),
+            pickle.HIGHEST_PROTOCOL)
+        result = AsyncResult()
+        self.calls.append(result)
+        workers = [worker for worker in self.workers if worker.alive()]
+        if not workers:
+            result.set_exception(WorkerException('No workers are running'))
+            return result
+        worker = min(workers, key=lambda worker: len(worker.pending))
+        worker.pending[seq] = result
+        try:
+            worker.send(data)
+        except (IOError, OSError) as exc:
+            # It exited since we checked, and may already have settled the rest
+            worker.pending.pop(seq, None)
+            result.set_exception(WorkerException(
+                'Could not send to worker %i: %s' % (worker.process.pid, exc)))
+        return result
+
+    def wait(self):
+        '''Wait until all our calls are done'''
+        gevent.wait(self.calls)
+
+    def close(self):
+        '''Wait until all our calls are done, and stop the workers'''
+        self.wait()
+        for worker in self.workers:
+            worker.close()
+        gevent.joinall(self.receivers)
+
+    def success(self):
+        '''Return whether or not everything finished successfully'''
+        return all(call.successful() for call in self.calls)
+
+    def results(self):
+        '''Get the results of each call, in original order'''
+        return [call.value for call in self.calls]
+
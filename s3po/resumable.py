@@ -0,0 +1,209 @@
+'''Resumable transfers, with progress checkpointed to disk'''
+
+import hashlib
+import json
+import os
+import time
+
+from .checksum import Checksum, is_md5, matches, multipart_etags
+from .exceptions import ChecksumException, DownloadException
+from .util import logger, retry
+
+
+class Checkpoint(object):
+    '''The progress of a transfer, persisted as JSON in a small file'''
+
+    def __init__(self, path):
+        self.path = path
+        self.state = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as fin:
+                    self.state = json.load(fin)
+            except ValueError:
+                logger.warning('Ignoring corrupt checkpoint %s', path)
+
+    def save(self, state=None):
+        '''Write out the state, atomically replacing the previous one'''
+        if state is not None:
+            self.state = state
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fout:
+            json.dump(self.state, fout)
+            fout.flush()
+            os.fsync(fout.fileno())
+        getattr(os, 'replace', os.rename)(tmp, self.path)
+
+    def clear(self):
+        '''The transfer is complete, so forget about it'''
+        self.state = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def part_size_for(size, part_size, max_parts=10000):
+    '''The part size to use for an upload of size bytes, given that there may
+    be at most max_parts parts.'''
+    return max(part_size, -(-size // max_parts))
+
+
+def upload_part(backend, bucket, key, upload_id, number, data, retries=3,
+                verify=False):
+    '''Upload one part, sending its md5 along for the backend to check. With
+    verify, the etag we get back is compared to the md5 too, when it looks
+    like one (part etags aren't md5s with SSE-KMS or SSE-C), retrying just
+    this part if they disagree.'''
+    md5 = hashlib.md5(data).hexdigest()
+
+    @retry(retries, exceptions=(ChecksumException,))
+    def func():
+        '''The bit that we want to retry'''
+        etag = backend.multipart_part(
+            bucket, key, upload_id, number, data, retries, md5=md5)
+        if verify and is_md5(etag) and etag != md5:
+            raise ChecksumException('Part %i of %s / %s has etag %s, not %s' % (
+                number, bucket, key, etag, md5))
+        return etag
+
+    return func()
+
+
+def upload(backend, bucket, key, path, checkpoint, part_size, retries=3,
+           stale_after=24 * 60 * 60, verify=False, headers=None, extra=None):
+    '''Upload the file at path to bucket/key in parts, recording each completed
+    part in the checkpoint file so that calling this again after an
+    interruption only uploads the remaining parts. The checkpoint is discarded
+    if the file has changed since. Any other incomplete upload to the same key
+    more than stale_after seconds old is aborted. Each part's md5 is sent for
+    the backend to check, and with verify, the etags of the parts and of the
+    final object are checked too. Headers and extra arguments are given to
+    both the start and the completion of the upload, for the backend to apply
+    to the object at whichever it can.'''
+    opts = {}
+    if headers:
+        opts['headers'] = headers
+    if extra:
+        opts['extra'] = extra
+    stat = os.stat(path)
+    source = {
+        'bucket': bucket,
+        'key': key,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime
+    }
+    checkpoint = Checkpoint(checkpoint)
+    state = checkpoint.state
+    upload_id = state.get('upload_id')
+
+    # Decide whether or not the checkpoint's upload is still usable. Some
+    # backends list the parts of an upload under several ids.
+    uploads = dict(backend.multipart_list(bucket, key, retries))
+    multipart_ids = getattr(backend, 'multipart_ids', lambda upload_id: [upload_id])
+    ids = multipart_ids(upload_id) if upload_id else []
+    live = [other for other in ids if other in uploads]
+    if upload_id and (state.get('source') != source or live != ids):
+        logger.info('Discarding checkpoint for upload %s to %s / %s',
+            upload_id, bucket, key)
+        for other in live:
+            backend.multipart_abort(bucket, key, other, retries)
+        upload_id = None
+
+    now = time.time()
+    for other, initiated in uploads.items():
+        if other not in ids and now - initiated > stale_after:
+            logger.info('Aborting stale upload %s to %s / %s', other, bucket, key)
+            backend.multipart_abort(bucket, key, other, retries)
+
+    if upload_id is None:
+        upload_id = backend.multipart_start(bucket, key, retries, **opts)
+        checkpoint.save({
+            'source': source,
+            'upload_id': upload_id,
+            'part_size': part_size_for(stat.st_size, part_size),
+            'parts': {}
+        })
+    else:
+        logger.info('Resuming upload %s to %s / %s with %i parts done',
+            upload_id, bucket, key, len(checkpoint.state['parts']))
+
+    part_size = checkpoint.state['part_size']
+    parts = checkpoint.state['parts']
+    count = max(1, -(-stat.st_size // part_size))
+    with open(path, 'rb') as fin:
+        for number in range(1, count + 1):
+            # JSON keys are always strings
+            if str(number) in parts:
+                continue
+            fin.seek((number - 1) * part_size)
+            data = fin.read(part_size)
+            parts[str(number)] = upload_part(
+                backend, bucket, key, upload_id, number, data, retries, verify)
+            checkpoint.save()
+
+    etags = [parts[str(number)] for number in range(1, count + 1)]
+    backend.multipart_complete(
+        bucket, key, upload_id, list(enumerate(etags, 1)), retries, **opts)
+    checkpoint.clear()
+    # Without md5 part etags, the object's etag can't be predicted
+    if verify and all(is_md5(etag) for etag in etags):
+        etag = backend.head(bucket, key, retries)['etag'].strip('"')
+        if etag not in multipart_etags(etags):
+            raise ChecksumException('Uploaded %s / %s has etag %s' % (
+                bucket, key, etag))
+    return True
+
+
+def download(backend, bucket, key, path, checkpoint, part_size, retries=3,
+             verify=False, headers=None):
+    '''Download bucket/key to the file at path in ranges, recording how many
+    bytes have been written in the checkpoint file so that calling this again
+    after an interruption continues where it left off. The checkpoint is
+    discarded if the object has changed since. With verify, the data is
+    checksummed and compared against the object's etag at the end, which means
+    re-reading any portion of the file that was downloaded by an earlier run.
+    Headers are sent with each request.'''
+    meta = backend.head(bucket, key, retries, headers)
+    source = {
+        'bucket': bucket,
+        'key': key,
+        'size': meta['size'],
+        'etag': meta['etag']
+    }
+    checkpoint = Checkpoint(checkpoint)
+    state = checkpoint.state
+    offset = 0
+    if state.get('source') == source and os.path.exists(path):
+        # Only trust as much as actually made it to the file
+        offset = min(state.get('offset', 0), os.path.getsize(path))
+        logger.info('Resuming download of %s / %s at byte %i', bucket, key, offset)
+    checkpoint.save({'source': source, 'offset': offset})
+
+    checksum = Checksum(backend.multipart_chunk_size)
+    with open(path, 'r+b' if offset else 'wb+') as fout:
+        if verify and offset:
+            for chunk in iter(lambda: fout.read(
+                    min(part_size, offset - fout.tell())), b''):
+                checksum.update(chunk)
+        fout.seek(offset)
+        fout.truncate()
+        while offset < meta['size']:
+            data = backend.read_range(
+                bucket, key, offset, min(part_size, meta['size'] - offset), retries,
+                headers)
+            if not data:
+                raise DownloadException('Read nothing from %s / %s at byte %i' % (
+                    bucket, key, offset))
+            fout.write(data)
+            if verify:
+                checksum.update(data)
+            fout.flush()
+            os.fsync(fout.fileno())
+            offset += len(data)
+            checkpoint.state['offset'] = offset
+            checkpoint.save()
+
+    checkpoint.clear()
+    if verify and matches(backend, bucket, key, checksum, meta, retries) is False:
+        raise ChecksumException('Downloaded %s / %s does not match etag %s' % (
+            bucket, key, meta['etag']))
+    return offset
@@ -0,0 +1,799 @@
+'''A local stand-in for S3 and Swift, for benchmarks and tests.
+
+Speaks just enough of both APIs for s3po's backends: objects (GET with
+ranges, HEAD, PUT, DELETE), listings and multipart uploads for S3 (with
+path-style buckets), and auth, containers, objects and (dynamic and static)
+large object manifests for Swift. Everything is kept in memory, and buckets
+spring into being when first written to.
+
+Faults can be injected to see how clients cope: a fixed latency before each
+response, a bandwidth cap on bodies in each direction, a fraction of requests
+that fail with a 500 or a 503 SlowDown, and a fraction of GETs whose bodies
+are cut off partway through. Use it from code:
+
+    with Server(latency=0.01, error_rate=0.05) as server:
+        conn = Connection.s3(**server.s3_kwargs())
+
+or from the command line with `python -m s3po.stub --help`.'''
+
+from __future__ import print_function
+
+import argparse
+import collections
+import binascii
+import base64
+import email.utils
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import parse_qs, quote, unquote, urlparse
+
+from .util import logger
+
+
+# The account that Swift clients are handed when they authenticate
+ACCOUNT = 'AUTH_s3po'
+TOKEN = 'AUTH_tk_s3po'
+S3_NAMESPACE = 'http://s3.amazonaws.com/doc/2006-03-01/'
+# Request headers that are stored with an object and returned with it
+STORED_HEADERS = re.compile(
+    r'^(content-type|content-encoding|content-disposition|cache-control|'
+    r'content-language|x-amz-meta-.*|x-object-meta-.*|x-object-manifest)$')
+# How much of a body to send or receive between bandwidth checks
+BLOCK_SIZE = 64 * 1024
+
+
+class StubError(Exception):
+    '''An error response'''
+    def __init__(self, status, code, message=''):
+        Exception.__init__(self, '%i %s %s' % (status, code, message))
+        self.status = status
+        self.code = code
+        self.message = message
+
+
+class Object(object):
+    '''A stored object, and the manifest of its segments if it's a Swift
+    static large object'''
+    def __init__(self, data, headers=None, etag=None, manifest=None):
+        self.data = data
+        self.headers = headers or {}
+        self.etag = etag or hashlib.md5(data).hexdigest()
+        self.manifest = manifest
+        self.modified = time.time()
+
+
+class Store(object):
+    '''The buckets, objects and in-progress uploads behind a Server'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = collections.defaultdict(dict)
+        self.uploads = {}
+
+    def get(self, bucket, key):
+        '''Get an object, or raise a 404'''
+        obj = self.buckets.get(bucket, {}).get(key)
+        if obj is None:
+            raise StubError(404, 'NoSuchKey', '%s/%s' % (bucket, key))
+        return obj
+
+    def put(self, bucket, key, obj):
+        '''Store an object'''
+        with self.lock:
+            self.buckets[bucket][key] = obj
+        return obj
+
+    def delete(self, bucket, key):
+        '''Delete an object, returning whether it existed'''
+        with self.lock:
+            return self.buckets.get(bucket, {}).pop(key, None) is not None
+
+    def keys(self, bucket, prefix='', marker=''):
+        '''The sorted keys of bucket after marker with prefix'''
+        if bucket not in self.buckets:
+            raise StubError(404, 'NoSuchBucket', bucket)
+        with self.lock:
+            keys = list(self.buckets[bucket])
+        return sorted(
+            key for key in keys if key.startswith(prefix) and key > marker)
+
+    def upload(self, upload_id):
+        '''Get an in-progress multipart upload, or raise a 404'''
+        upload = self.uploads.get(upload_id)
+        if upload is None:
+            raise StubError(404, 'NoSuchUpload', upload_id)
+        return upload
+
+
+def listing(keys, prefix, delimiter, limit, marker=''):
+    '''Roll keys up by delimiter, returning up to limit (kind, name) entries
+    where kind is 'key' or 'prefix', and whether the results were cut short.
+    Common prefixes up to the marker were returned on an earlier page.'''
+    results = []
+    seen = set()
+    for key in keys:
+        if delimiter and delimiter in key[len(prefix):]:
+            common = key[:key.index(delimiter, len(prefix)) + len(delimiter)]
+            if common in seen or common <= marker:
+                continue
+            seen.add(common)
+            entry = ('prefix', common)
+        else:
+            entry = ('key', key)
+        if len(results) == limit:
+            return results, True
+        results.append(entry)
+    return results, False
+
+
+def parse_range(header, size):
+    '''The (start, end) inclusive byte range of a Range header'''
+    match = re.match(r'^bytes=(\d*)-(\d*)$', header or '')
+    if not match or match.groups() == ('', ''):
+        raise StubError(416, 'InvalidRange', header)
+    start, end = match.groups()
+    if not start:
+        return max(size - int(end), 0), size - 1
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise StubError(416, 'InvalidRange', header)
+    return start, end
+
+
+def decode_chunked(data):
+    '''Decode a chunked body, either transfer-encoded or aws-chunked (where
+    each chunk size may carry a signature, and trailers may follow).'''
+    result = []
+    position = 0
+    while True:
+        end = data.index(b'\r\n', position)
+        size = int(data[position:end].split(b';')[0], 16)
+        position = end + 2
+        if not size:
+            return b''.join(result)
+        result.append(data[position:position + size])
+        position += size + 2
+
+
+def md5_header(value):
+    '''The hex md5 from a base64 Content-MD5 header'''
+    try:
+        return binascii.hexlify(base64.b64decode(value)).decode('ascii')
+    except (TypeError, ValueError, binascii.Error):
+        raise StubError(400, 'InvalidDigest', value)
+
+
+def http_date(timestamp):
+    '''Format a timestamp for a header'''
+    return email.utils.formatdate(timestamp, usegmt=True)
+
+
+def iso_date(timestamp, suffix='.000Z'):
+    '''Format a timestamp for a listing'''
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(timestamp)) + suffix
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Dispatches requests to the S3 or Swift API'''
+    # Keep-alive, which clients' connection pools rely on
+    protocol_version = 'HTTP/1.1'
+    server_version = 's3po-stub'
+    # Headers and bodies are written separately, which Nagle would delay
+    disable_nagle_algorithm = True
+
+    def log_message(self, fmt, *args):
+        logger.debug('stub: ' + fmt, *args)
+
+    @property
+    def store(self):
+        return self.server.store
+
+    @property
+    def faults(self):
+        return self.server.faults
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_HEAD(self):
+        self.handle_request('HEAD')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+    def handle_request(self, method):
+        '''Route a request, injecting faults along the way'''
+        url = urlparse(self.path)
+        self.query = dict(
+            (name, values[-1]) for name, values in
+            parse_qs(url.query, keep_blank_values=True).items())
+        parts = [unquote(part) for part in url.path.lstrip('/').split('/', 1)]
+        self.swift = parts[0] in ('auth', 'v1')
+        body = self.read_body()
+        self.server.count(method)
+        if self.faults.latency:
+            time.sleep(self.faults.latency)
+        try:
+            # Authentication is spared, so that faults hit the requests we measure
+            fault = None if parts[0] == 'auth' else self.faults.pick()
+            if fault == 'error':
+                self.server.count('error')
+                raise StubError(500, 'InternalError', 'Injected error')
+            if fault == 'slowdown':
+                self.server.count('slowdown')
+                raise StubError(503, 'SlowDown', 'Please reduce your request rate.')
+            if self.swift:
+                self.handle_swift(method, url.path, body)
+            else:
+                bucket = parts[0]
+                key = parts[1] if len(parts) > 1 else ''
+                self.handle_s3(method, bucket, key, body)
+        except StubError as exc:
+            self.send_error_response(exc)
+
+    def read_body(self):
+        '''Read (and decode) the request body'''
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            data = []
+            while True:
+                line = self.rfile.readline()
+                size = int(line.split(b';')[0], 16)
+                if not size:
+                    # Any trailers, up to the blank line
+                    while self.rfile.readline().strip():
+                        pass
+                    break
+                data.append(self.receive(size))
+                self.rfile.readline()
+            body = b''.join(data)
+        else:
+            body = self.receive(int(self.headers.get('Content-Length') or 0))
+        if ('aws-chunked' in self.headers.get('Content-Encoding', '') or
+                self.headers.get('x-amz-content-sha256', '').startswith('STREAMING-')):
+            body = decode_chunked(body)
+        return body
+
+    def receive(self, size):
+        '''Read size bytes of the request, subject to our bandwidth'''
+        data = []
+        while size > 0:
+            block = self.rfile.read(min(size, BLOCK_SIZE))
+            if not block:
+                break
+            self.faults.throttle(len(block))
+            data.append(block)
+            size -= len(block)
+        return b''.join(data)
+
+    def respond(self, status, headers=None, body=b'', length=None, method='GET'):
+        '''Send a response. The body may be cut short by our faults.'''
+        self.send_response(status)
+        headers = dict(headers or {})
+        headers.setdefault('Content-Length', str(len(body) if length is None else length))
+        if self.swift:
+            headers.setdefault('X-Trans-Id', uuid.uuid4().hex)
+        else:
+            headers.setdefault('x-amz-request-id', uuid.uuid4().hex)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if method == 'HEAD' or not body:
+            return
+        if status in (200, 206) and self.faults.truncate():
+            self.server.count('truncated')
+            body = body[:len(body) // 2]
+            self.close_connection = True
+        for start in range(0, len(body), BLOCK_SIZE):
+            block = body[start:start + BLOCK_SIZE]
+            self.faults.throttle(len(block))
+            self.wfile.write(block)
+        self.wfile.flush()
+
+    def send_error_response(self, exc):
+        '''Respond with an error, in the flavor of the API'''
+        if self.swift:
+            body = ('<html><h1>%s</h1><p>%s</p></html>' % (
+                exc.code, escape(exc.message))).encode('utf-8')
+            headers = {'Content-Type': 'text/html; charset=UTF-8'}
+        else:
+            body = (
+                '<?xml version="1.0" encoding="UTF-8"?>\n<Error><Code>%s</Code>'
+                '<Message>%s</Message></Error>' % (
+                    exc.code, escape(exc.message))).encode('utf-8')
+            headers = {'Content-Type': 'application/xml'}
+        self.respond(exc.status, headers, body, method=self.command)
+
+    def send_object(self, method, obj, data, etag, extra=None):
+        '''Respond with an object's data, honoring any Range'''
+        headers = dict(obj.headers)
+        headers.update(extra or {})
+        headers.update({
+            'ETag': etag,
+            'Last-Modified': http_date(obj.modified),
+            'Accept-Ranges': 'bytes',
+        })
+        if 'content-type' not in obj.headers:
+            headers['Content-Type'] = 'application/octet-stream'
+        status = 200
+        if method == 'GET' and self.headers.get('Range'):
+            start, end = parse_range(self.headers['Range'], len(data))
+            headers['Content-Range'] = 'bytes %i-%i/%i' % (start, end, len(data))
+            data = data[start:end + 1]
+            status = 206
+        self.respond(status, headers, data, length=len(data), method=method)
+
+    @staticmethod
+    def stored_headers(headers):
+        '''The headers of a request to keep with an object'''
+        result = {}
+        for name, value in headers.items():
+            name = name.lower()
+            if name == 'content-encoding':
+                value = ','.join(
+                    part for part in value.split(',') if part.strip() != 'aws-chunked')
+                if not value:
+                    continue
+            if STORED_HEADERS.match(name):
+                result[name] = value
+        return result
+
+    # S3
+
+    def xml(self, status, root, children):
+        '''Respond with an S3 XML document'''
+        body = '<?xml version="1.0" encoding="UTF-8"?>\n<%s xmlns="%s">%s</%s>' % (
+            root, S3_NAMESPACE, ''.join(children), root)
+        self.respond(status, {'Content-Type': 'application/xml'}, body.encode('utf-8'))
+
+    @staticmethod
+    def element(name, value):
+        '''An XML element'''
+        return '<%s>%s</%s>' % (name, escape(str(value)), name)
+
+    def handle_s3(self, method, bucket, key, body):
+        '''Handle a path-style S3 request'''
+        if not bucket:
+            raise StubError(501, 'NotImplemented', 'Listing buckets')
+        if not key:
+            if method == 'PUT':
+                with self.store.lock:
+                    self.store.buckets[bucket]
+                return self.respond(200)
+            if method == 'HEAD':
+                if bucket not in self.store.buckets:
+                    raise StubError(404, 'NoSuchBucket', bucket)
+                return self.respond(200)
+            if method == 'GET' and 'uploads' in self.query:
+                return self.s3_list_uploads(bucket)
+            if method == 'GET':
+                return self.s3_list(bucket)
+            raise StubError(501, 'NotImplemented', '%s on a bucket' % method)
+
+        if method == 'POST' and 'uploads' in self.query:
+            upload_id = uuid.uuid4().hex
+            self.store.uploads[upload_id] = {
+                'bucket': bucket, 'key': key, 'initiated': time.time(),
+                'headers': self.stored_headers(self.headers), 'parts': {}}
+            return self.xml(200, 'InitiateMultipartUploadResult', [
+                self.element('Bucket', bucket), self.element('Key', key),
+                self.element('UploadId', upload_id)])
+        if method == 'POST' and 'uploadId' in self.query:
+            return self.s3_complete(bucket, key, body)
+        if method == 'PUT' and 'uploadId' in self.query:
+            upload = self.store.upload(self.query['uploadId'])
+            etag = self.check_md5(body)
+            upload['parts'][int(self.query['partNumber'])] = (body, etag)
+            return self.respond(200, {'ETag': '"%s"' % etag})
+        if method == 'DELETE' and 'uploadId' in self.query:
+            self.store.upload(self.query['uploadId'])
+            del self.store.uploads[self.query['uploadId']]
+            return self.respond(204)
+        if method == 'PUT':
+            etag = self.check_md5(body)
+            self.store.put(bucket, key, Object(
+                body, self.stored_headers(self.headers), etag))
+            return self.respond(200, {'ETag': '"%s"' % etag})
+        if method in ('GET', 'HEAD'):
+            obj = self.store.get(bucket, key)
+            return self.send_object(method, obj, obj.data, '"%s"' % obj.etag)
+        if method == 'DELETE':
+            self.store.delete(bucket, key)
+            return self.respond(204)
+        raise StubError(501, 'NotImplemented', '%s on an object' % method)
+
+    def check_md5(self, body):
+        '''The md5 of body, checked against any Content-MD5'''
+        etag = hashlib.md5(body).hexdigest()
+        if self.headers.get('Content-MD5'):
+            if md5_header(self.headers['Content-MD5']) != etag:
+                raise StubError(400, 'BadDigest', 'Content-MD5 mismatch')
+        return etag
+
+    def s3_list(self, bucket):
+        '''ListObjects, or ListObjectsV2 with list-type=2'''
+        prefix = self.query.get('prefix', '')
+        delimiter = self.query.get('delimiter', '')
+        limit = int(self.query.get('max-keys') or 1000)
+        version2 = self.query.get('list-type') == '2'
+        if version2:
+            marker = self.query.get('continuation-token') or self.query.get('start-after', '')
+        else:
+            marker = self.query.get('marker', '')
+        encode = self.query.get('encoding-type') == 'url'
+
+        def name(value):
+            '''Keys as the client asked for them'''
+            return quote(value.encode('utf-8'), safe='/') if encode else value
+
+        entries, truncated = listing(
+            self.store.keys(bucket, prefix, marker), prefix, delimiter, limit, marker)
+        children = [
+            self.element('Name', bucket),
+            self.element('Prefix', name(prefix)),
+            self.element('MaxKeys', limit),
+            self.element('IsTruncated', 'true' if truncated else 'false')]
+        if delimiter:
+            children.append(self.element('Delimiter', name(delimiter)))
+        if encode:
+            children.append(self.element('EncodingType', 'url'))
+        for kind, value in entries:
+            if kind == 'prefix':
+                children.append('<CommonPrefixes>%s</CommonPrefixes>' % (
+                    self.element('Prefix', name(value))))
+                continue
+            obj = self.store.get(bucket, value)
+            children.append('<Contents>%s</Contents>' % ''.join([
+                self.element('Key', name(value)),
+                self.element('LastModified', iso_date(obj.modified)),
+                self.element('ETag', '"%s"' % obj.etag),
+                self.element('Size', len(obj.data)),
+                self.element('StorageClass', 'STANDARD')]))
+        if version2:
+            children.append(self.element('KeyCount', len(entries)))
+            if truncated:
+                children.append(self.element('NextContinuationToken', entries[-1][1]))
+        elif truncated:
+            children.append(self.element('NextMarker', name(entries[-1][1])))
+        self.xml(200, 'ListBucketResult', children)
+
+    def s3_list_uploads(self, bucket):
+        '''ListMultipartUploads'''
+        prefix = self.query.get('prefix', '')
+        children = [
+            self.element('Bucket', bucket),
+            self.element('IsTruncated', 'false')]
+        for upload_id, upload in sorted(self.store.uploads.items()):
+            if upload['bucket'] == bucket and upload['key'].startswith(prefix):
+                children.append('<Upload>%s</Upload>' % ''.join([
+                    self.element('Key', upload['key']),
+                    self.element('UploadId', upload_id),
+                    self.element('Initiated', iso_date(upload['initiated']))]))
+        self.xml(200, 'ListMultipartUploadsResult', children)
+
+    def s3_complete(self, bucket, key, body):
+        '''CompleteMultipartUpload'''
+        upload = self.store.upload(self.query['uploadId'])
+        parts = []
+        for part in ElementTree.fromstring(body).iter():
+            if part.tag.split('}')[-1] != 'Part':
+                continue
+            fields = dict((child.tag.split('}')[-1], child.text) for child in part)
+            number = int(fields['PartNumber'])
+            if number not in upload['parts']:
+                raise StubError(400, 'InvalidPart', 'Missing part %i' % number)
+            data, etag = upload['parts'][number]
+            if fields.get('ETag', '').strip('"') != etag:
+                raise StubError(400, 'InvalidPart', 'Wrong etag for part %i' % number)
+            parts.append((data, etag))
+        digests = b''.join(binascii.unhexlify(etag) for _, etag in parts)
+        etag = '%s-%i' % (hashlib.md5(digests).hexdigest(), len(parts))
+        self.store.put(bucket, key, Object(
+            b''.join(data for data, _ in parts), upload['headers'], etag))
+        del self.store.uploads[self.query['uploadId']]
+        self.xml(200, 'CompleteMultipartUploadResult', [
+            self.element('Bucket', bucket), self.element('Key', key),
+            self.element('ETag', '"%s"' % etag)])
+
+    # Swift
+
+    def handle_swift(self, method, path, body):
+        '''Handle a Swift request'''
+        if path.startswith('/auth/'):
+            storage = 'http://%s:%i/v1/%s' % (
+                self.server.server_address[0], self.server.server_address[1], ACCOUNT)
+            return self.respond(200, {
+                'X-Storage-Url': storage,
+                'X-Auth-Token': TOKEN,
+                'X-Storage-Token': TOKEN})
+        if self.headers.get('X-Auth-Token') != TOKEN:
+            raise StubError(401, 'Unauthorized')
+        parts = [unquote(part) for part in path.split('/', 4)[3:]]
+        container = parts[0] if parts else ''
+        key = parts[1] if len(parts) > 1 else ''
+        if not container:
+            raise StubError(501, 'NotImplemented', 'Account requests')
+        if not key:
+            return self.swift_container(method, container)
+
+        if method == 'PUT' and self.query.get('multipart-manifest') == 'put':
+            obj = self.store.put(container, key, self.swift_static(body))
+            return self.respond(201, {'ETag': '"%s"' % obj.etag})
+        if method == 'PUT':
+            etag = hashlib.md5(body).hexdigest()
+            expected = self.headers.get('ETag', '').strip('"')
+            if expected and expected != etag:
+                raise StubError(422, 'Unprocessable Entity', 'ETag mismatch')
+            self.store.put(container, key, Object(
+                body, self.stored_headers(self.headers), etag))
+            return self.respond(201, {'ETag': etag})
+        if method in ('GET', 'HEAD'):
+            try:
+                obj = self.store.get(container, key)
+            except StubError:
+                raise StubError(404, 'Not Found', '%s/%s' % (container, key))
+            if obj.manifest is not None and self.query.get('multipart-manifest') == 'get':
+                return self.respond(200, {
+                        'Content-Type': 'application/json',
+                        'X-Static-Large-Object': 'True'},
+                    json.dumps(obj.manifest).encode('utf-8'), method=method)
+            data, etag = obj.data, obj.etag
+            manifest = obj.headers.get('x-object-manifest')
+            if manifest:
+                data, etag = self.swift_segments(manifest)
+            if manifest or obj.manifest is not None:
+                etag = '"%s"' % etag
+            return self.send_object(method, obj, data, etag, {
+                'X-Timestamp': '%.5f' % obj.modified})
+        if method == 'DELETE':
+            if not self.store.delete(container, key):
+                raise StubError(404, 'Not Found', '%s/%s' % (container, key))
+            return self.respond(204)
+        raise StubError(405, 'Method Not Allowed', method)
+
+    def swift_segments(self, manifest):
+        '''The data and etag of a dynamic large object's segments'''
+        container, prefix = manifest.split('/', 1)
+        try:
+            keys = self.store.keys(container, prefix)
+        except StubError:
+            keys = []
+        segments = [self.store.get(container, key) for key in keys]
+        etags = ''.join(segment.etag for segment in segments)
+        return (
+            b''.join(segment.data for segment in segments),
+            hashlib.md5(etags.encode('ascii')).hexdigest())
+
+    def swift_static(self, body):
+        '''A static large object made of the segments in a manifest, checking
+        that they're there with the expected etags and sizes'''
+        segments = []
+        manifest = []
+        for entry in json.loads(body.decode('utf-8')):
+            container, name = entry['path'].lstrip('/').split('/', 1)
+            try:
+                segment = self.store.get(container, name)
+            except StubError:
+                raise StubError(400, 'Bad Request', 'Missing %s' % entry['path'])
+            if entry.get('etag') not in (None, segment.etag):
+                raise StubError(400, 'Bad Request', 'Etag of %s' % entry['path'])
+            if entry.get('size_bytes') not in (None, len(segment.data)):
+                raise StubError(400, 'Bad Request', 'Size of %s' % entry['path'])
+            segments.append(segment)
+            manifest.append({
+                'name': entry['path'], 'hash': segment.etag,
+                'bytes': len(segment.data)})
+        etags = ''.join(segment.etag for segment in segments)
+        headers = self.stored_headers(self.headers)
+        headers['x-static-large-object'] = 'True'
+        return Object(
+            b''.join(segment.data for segment in segments), headers,
+            hashlib.md5(etags.encode('ascii')).hexdigest(), manifest)
+
+    def swift_container(self, method, container):
+        '''Create, check or list a container'''
+        if method == 'PUT':
+            with self.store.lock:
+                created = container not in self.store.buckets
+                self.store.buckets[container]
+            return self.respond(201 if created else 202)
+        if container not in self.store.buckets:
+            raise StubError(404, 'Not Found', container)
+        if method == 'HEAD':
+            return self.respond(204, {
+                'X-Container-Object-Count': str(len(self.store.buckets[container]))})
+        if method != 'GET':
+            raise StubError(405, 'Method Not Allowed', method)
+        prefix = self.query.get('prefix', '')
+        delimiter = self.query.get('delimiter', '')
+        limit = int(self.query.get('limit') or 10000)
+        marker = self.query.get('marker', '')
+        entries, _ = listing(
+            self.store.keys(container, prefix, marker), prefix, delimiter, limit, marker)
+        results = []
+        for kind, value in entries:
+            if kind == 'prefix':
+                results.append({'subdir': value})
+                continue
+            obj = self.store.get(container, value)
+            results.append({
+                'name': value,
+                'bytes': len(obj.data),
+                'hash': obj.etag,
+                'last_modified': iso_date(obj.modified, '.000000'),
+                'content_type': obj.headers.get('content-type', 'application/octet-stream')})
+            if obj.manifest is not None:
+                # As Swift marks static large objects in listings
+                results[-1]['slo_etag'] = '"%s"' % obj.etag
+        if not results:
+            return self.respond(204)
+        self.respond(200, {'Content-Type': 'application/json; charset=utf-8'},
+            json.dumps(results).encode('utf-8'))
+
+
+class Faults(object):
+    '''What can go wrong, and how slowly. Latency is in seconds and bandwidth
+    in bytes per second; rates are the fraction of requests affected.'''
+
+    def __init__(self, latency=0, bandwidth=None, error_rate=0, slowdown_rate=0,
+                 truncate_rate=0, seed=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.slowdown_rate = slowdown_rate
+        self.truncate_rate = truncate_rate
+        self.random = random.Random(seed)
+
+    def pick(self):
+        '''Which fault, if any, to inject for a request'''
+        roll = self.random.random()
+        if roll < self.error_rate:
+            return 'error'
+        if roll < self.error_rate + self.slowdown_rate:
+            return 'slowdown'
+        return None
+
+    def truncate(self):
+        '''Whether to cut a response body short'''
+        return self.truncate_rate and self.random.random() < self.truncate_rate
+
+    def throttle(self, size):
+        '''Wait long enough to move size bytes at our bandwidth'''
+        if self.bandwidth:
+            time.sleep(float(size) / self.bandwidth)
+
+
+class HTTPServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    '''Serves each connection in its own thread'''
+    daemon_threads = True
+    allow_reuse_address = True
+    # Batches open lots of connections at once
+    request_queue_size = 1024
+
+    def __init__(self, address, store, faults):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.store = store
+        self.faults = faults
+        self.stats = collections.Counter()
+
+    def count(self, what):
+        '''Count a request or a fault'''
+        self.stats[what] += 1
+
+
+class Server(object):
+    '''A stand-in S3 and Swift server on host:port. A port of 0 picks a free
+    one. Runs in a background thread once started, and can be used as a
+    ContextManager. See Faults for the fault injection options.'''
+
+    def __init__(self, host='127.0.0.1', port=0, **faults):
+        self.store = Store()
+        self.faults = Faults(**faults)
+        self.httpd = HTTPServer((host, port), self.store, self.faults)
+        self._thread = None
+
+    @property
+    def url(self):
+        '''The base URL of the server'''
+        host, port = self.httpd.server_address[:2]
+        return 'http://%s:%i' % (host, port)
+
+    @property
+    def stats(self):
+        '''Counts of requests by method, and of the faults injected'''
+        return self.httpd.stats
+
+    def s3_kwargs(self, **kwargs):
+        '''Arguments for Connection.s3 to talk to this server'''
+        from botocore.config import Config
+        kwargs.setdefault('config', Config(s3={'addressing_style': 'path'}))
+        kwargs.update({
+            'endpoint_url': self.url,
+            'aws_access_key_id': 'stub',
+            'aws_secret_access_key': 'stub',
+            'region_name': 'us-east-1',
+        })
+        return kwargs
+
+    def swift_kwargs(self, **kwargs):
+        '''Arguments for Connection.swift to talk to this server'''
+        kwargs.update({
+            'authurl': self.url + '/auth/v1.0',
+            'user': 'stub:stub',
+            'key': 'stub',
+        })
+        return kwargs
+
+    def start(self):
+        '''Serve in a background thread'''
+        self._thread = threading.Thread(
+            target=self.httpd.serve_forever, kwargs={'poll_interval': 0.05})
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        '''Stop serving'''
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, typ, val, trace):
+        self.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run a local stand-in for S3 and Swift.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0,
+        help='Seconds to wait before each response')
+    parser.add_argument('--bandwidth', type=float, default=None,
+        help='Bytes per second for each body, in each direction')
+    parser.add_argument('--error-rate', type=float, default=0,
+        help='Fraction of requests that fail with a 500')
+    parser.add_argument('--slowdown-rate', type=float, default=0,
+        help='Fraction of requests that fail with a 503 SlowDown')
+    parser.add_argument('--truncate-rate', type=float, default=0,
+        help='Fraction of GET bodies that are cut short')
+    parser.add_argument('--seed', type=int, default=None,
+        help='Seed for choosing which requests fail')
+    args = parser.parse_args(argv)
+
+    server = Server(
+        args.host, args.port, latency=args.latency, bandwidth=args.bandwidth,
+        error_rate=args.error_rate, slowdown_rate=args.slowdown_rate,
+        truncate_rate=args.truncate_rate, seed=args.seed)
+    print('S3 endpoint:   %s' % server.url)
+    print('Swift authurl: %s/auth/v1.0' % server.url)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,335 @@
+'''Synchronize local directory trees with buckets'''
+
+import collections
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+try:
+    from os import scandir
+except ImportError:  # pragma: no cover
+    from scandir import scandir
+
+from .util import logger, new_pool
+
+# The umask can only be read by setting it, so read it once at import rather
+# than while other threads may be creating files
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+# The result of comparing a local tree with a bucket. Each is a list of the
+# relative paths of files that are new, changed or already the same.
+Diff = collections.namedtuple('Diff', ['added', 'changed', 'unchanged'])
+
+
+class Transfer(collections.namedtuple('Transfer', ['files', 'bytes', 'seconds'])):
+    '''How much was transferred, and how long it took'''
+    __slots__ = ()
+
+    @property
+    def rate(self):
+        '''Throughput in bytes per second'''
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+
+class Manifest(object):
+    '''Remembers the size, modification time and md5 of local files, so that
+    files which haven't changed needn't be hashed again. When given a path, it
+    is loaded from and saved to that file as JSON.'''
+    # How much of a file to hash at a time
+    chunk_size = 1024 * 1024
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        if path and os.path.exists(path):
+            with open(path) as fin:
+                self.entries = json.load(fin)
+
+    def md5(self, relpath, path, stat):
+        '''Get the md5 of the file at path, hashing it only if it has changed
+        since we last looked.'''
+        entry = self.entries.get(relpath)
+        if entry and entry[:2] == [stat.st_size, stat.st_mtime]:
+            return entry[2]
+        digest = hashlib.md5()
+        with open(path, 'rb') as fin:
+            for chunk in iter(lambda: fin.read(self.chunk_size), b''):
+                digest.update(chunk)
+        self.update(relpath, stat, digest.hexdigest())
+        return digest.hexdigest()
+
+    def update(self, relpath, stat, md5):
+        '''Record the md5 of relpath as of stat.'''
+        self.entries[relpath] = [stat.st_size, stat.st_mtime, md5]
+
+    def save(self):
+        '''Persist the manifest, if it has a path.'''
+        if not self.path:
+            return
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as fout:
+            json.dump(self.entries, fout)
+        os.rename(tmp, self.path)
+
+
+def walk(local_dir, relpath=''):
+    '''Yield (relpath, path, stat) for each file beneath local_dir. Relative
+    paths always use '/' as a separator, to match keys.'''
+    directory = os.path.join(local_dir, relpath) if relpath else local_dir
+    for entry in sorted(scandir(directory), key=lambda entry: entry.name):
+        name = relpath + '/' + entry.name if relpath else entry.name
+        if entry.is_dir():
+            for result in walk(local_dir, name):
+                yield result
+        elif entry.is_file():
+            yield name, entry.path, entry.stat()
+
+
+def local_path(local_dir, relpath):
+    '''The local path for a relative path, or None if it wouldn't be safely
+    beneath local_dir: if it has empty, '.' or '..' segments, or leads out
+    through a symlink.'''
+    parts = relpath.split('/')
+    for part in parts:
+        if (part in ('', '.', '..') or os.path.isabs(part) or
+                os.path.splitdrive(part)[0] or os.sep in part or
+                (os.altsep and os.altsep in part)):
+            return None
+    path = os.path.join(local_dir, *parts)
+    root = os.path.join(os.path.realpath(local_dir), '')
+    if not os.path.realpath(path).startswith(root):
+        return None
+    return path
+
+
+def destination(local_dir, bucket, key, relpath):
+    '''The local path to download key to, or None (with a warning) if it
+    can't be written beneath local_dir'''
+    path = local_path(local_dir, relpath)
+    if path is None:
+        logger.warning('Skipping %s / %s, which would be outside %s',
+            bucket, key, local_dir)
+    return path
+
+
+def directory(prefix):
+    '''The prefix of keys beneath prefix, as a directory: with a trailing
+    slash, unless it's empty.'''
+    if prefix and not prefix.endswith('/'):
+        return prefix + '/'
+    return prefix
+
+
+def key_name(prefix, relpath):
+    '''The key for a relative path under prefix.'''
+    return directory(prefix) + relpath
+
+
+def relative(prefix, key):
+    '''The relative path of key under prefix.'''
+    return key[len(directory(prefix)):]
+
+
+def content_md5(meta):
+    '''The md5 of a listed key's content, if its etag is one. The etags of
+    multipart uploads and Swift manifests are made from those of their parts.'''
+    etag = meta['etag']
+    if etag and '-' not in etag and not meta.get('manifest'):
+        return etag
+    return None
+
+
+def differs(relpath, path, stat, meta, manifest, newer):
+    '''Whether or not a local file differs from its remote counterpart. When
+    the etag is the md5 of the content, compare against it. Otherwise (as for
+    multipart uploads) the file differs if newer(local mtime, remote mtime).'''
+    if stat.st_size != meta['size']:
+        return True
+    md5 = content_md5(meta)
+    if md5:
+        return manifest.md5(relpath, path, stat) != md5
+    # Listings only have whole seconds
+    return newer(int(stat.st_mtime), meta['modified'] or 0)
+
+
+def makedirs(directory):
+    '''Make sure that directory exists.'''
+    if directory and not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Another greenlet may have beaten us to it
+            if not os.path.isdir(directory):
+                raise
+
+
+def fetch(conn, bucket, key, path, size=None, fsync=False, retries=3):
+    '''Download bucket/key to path atomically. The data is written to a
+    temporary file alongside path (preallocated to size, if known), and only
+    renamed into place once complete, so a failure never leaves a truncated
+    file at path. Returns the number of bytes written.'''
+    path = os.path.abspath(path)
+    directory, name = os.path.split(path)
+    makedirs(directory)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.' + name + '.')
+    try:
+        with os.fdopen(fd, 'wb') as fout:
+            if size and hasattr(os, 'posix_fallocate'):
+                try:
+                    os.posix_fallocate(fout.fileno(), 0, size)
+                except OSError:  # pragma: no cover
+                    # Not every filesystem supports it, but it's only advice
+                    pass
+            conn.download(bucket, key, fout, retries=retries)
+            # In case the object is smaller than we allocated
+            fout.truncate()
+            count = fout.tell()
+            # mkstemp makes files only we can read, unlike open
+            if hasattr(os, 'fchmod'):
+                os.fchmod(fout.fileno(), 0o666 & ~UMASK)
+            if fsync:
+                fout.flush()
+                os.fsync(fout.fileno())
+        getattr(os, 'replace', os.rename)(tmp, path)
+        return count
+    except:
+        os.remove(tmp)
+        raise
+
+
+def sync_up(conn, local_dir, bucket, prefix='', manifest=None, dry_run=False,
+            poolsize=20, retries=3):
+    '''Upload the files in local_dir that are missing or differ beneath prefix
+    in bucket, returning the Diff. With dry_run, nothing is uploaded.'''
+    manifest = Manifest(manifest)
+    remote = dict(
+        (relative(prefix, meta['key']), meta)
+        for meta in conn.list_metadata(bucket, directory(prefix), retries=retries))
+
+    diff = Diff([], [], [])
+    paths = {}
+    for relpath, path, stat in walk(local_dir):
+        paths[relpath] = path
+        meta = remote.get(relpath)
+        if meta is None:
+            diff.added.append(relpath)
+        elif differs(relpath, path, stat, meta, manifest, lambda l, r: l > r):
+            diff.changed.append(relpath)
+        else:
+            diff.unchanged.append(relpath)
+
+    logger.info('Sync up %s => %s / %s: %i added, %i changed, %i unchanged',
+        local_dir, bucket, prefix, *[len(part) for part in diff])
+    if dry_run:
+        return diff
+
+    pool = new_pool(poolsize)
+    tasks = [
+        pool.spawn(
+            conn.upload_file, bucket, key_name(prefix, relpath), paths[relpath],
+            retries=retries, mode='rb')
+        for relpath in diff.added + diff.changed]
+    pool.join()
+    for task in tasks:
+        task.get()
+    manifest.save()
+    return diff
+
+
+def sync_down(conn, bucket, prefix, local_dir, manifest=None, dry_run=False,
+              poolsize=20, retries=3):
+    '''Download the keys beneath prefix in bucket that are missing or differ
+    in local_dir, returning the Diff. With dry_run, nothing is downloaded.'''
+    manifest = Manifest(manifest)
+    diff = Diff([], [], [])
+    remote = {}
+    paths = {}
+    for meta in conn.list_metadata(bucket, directory(prefix), retries=retries):
+        relpath = relative(prefix, meta['key'])
+        if not relpath or relpath.endswith('/'):
+            continue
+        path = destination(local_dir, bucket, meta['key'], relpath)
+        if path is None:
+            continue
+        remote[relpath] = meta
+        paths[relpath] = path
+        try:
+            stat = os.stat(path)
+        except OSError:
+            diff.added.append(relpath)
+            continue
+        if differs(relpath, path, stat, meta, manifest, lambda l, r: l < r):
+            diff.changed.append(relpath)
+        else:
+            diff.unchanged.append(relpath)
+
+    logger.info('Sync down %s / %s => %s: %i added, %i changed, %i unchanged',
+        bucket, prefix, local_dir, *[len(part) for part in diff])
+    if dry_run:
+        return diff
+
+    transfers = diff.added + diff.changed
+    pool = new_pool(poolsize)
+    tasks = [
+        pool.spawn(
+            fetch, conn, bucket, remote[relpath]['key'], paths[relpath],
+            remote[relpath]['size'], retries=retries)
+        for relpath in transfers]
+    pool.join()
+    for task in tasks:
+        task.get()
+
+    # Match the remote modification times, and remember any md5s we know
+    for relpath in transfers:
+        meta = remote[relpath]
+        path = paths[relpath]
+        if meta['modified']:
+            os.utime(path, (meta['modified'], meta['modified']))
+        if content_md5(meta):
+            manifest.update(relpath, os.stat(path), content_md5(meta))
+    manifest.save()
+    return diff
+
+
+def download_tree(conn, bucket, prefix, dest_dir, concurrency=20, fsync=False,
+                  retries=3):
+    '''Download every key beneath prefix in bucket into dest_dir, keeping
+    concurrency downloads in flight as the listing streams in. Each file is
+    written atomically (see fetch). Returns a Transfer.'''
+    pool = new_pool(concurrency)
+    totals = {'files': 0, 'bytes': 0}
+    errors = []
+
+    def download(meta, path):
+        '''Fetch one key, keeping count'''
+        try:
+            count = fetch(conn, bucket, meta['key'], path, meta['size'],
+                          fsync=fsync, retries=retries)
+            totals['files'] += 1
+            totals['bytes'] += count
+        except Exception as exc:
+            logger.exception('Failed to download %s / %s', bucket, meta['key'])
+            errors.append(exc)
+
+    start = time.time()
+    for meta in conn.list_metadata(bucket, directory(prefix), retries=retries):
+        relpath = relative(prefix, meta['key'])
+        if not relpath or relpath.endswith('/'):
+            continue
+        if errors:
+            break
+        path = destination(dest_dir, bucket, meta['key'], relpath)
+        if path is not None:
+            pool.spawn(download, meta, path)
+    pool.join()
+    if errors:
+        raise errors[0]
+
+    transfer = Transfer(totals['files'], totals['bytes'], time.time() - start)
+    logger.info('Downloaded %i files (%i bytes) from %s / %s in %.2fs (%.2f MB/s)',
+        transfer.files, transfer.bytes, bucket, prefix, transfer.seconds,
+        transfer.rate / (1024 * 1024))
+    return transfer
@@ -0,0 +1,238 @@
+'''Opt-in tracing of where the time in each operation goes.
+
+While a Tracer is active, spans are recorded for the phases of every
+operation: waiting in a batch's queue, each Connection operation, callbacks,
+retry sleeps, signing and time to first byte on S3 (through botocore's
+events), and auth, first byte and body on Swift. Each span is tagged with the
+greenlet (or thread) that it ran on. When no tracer is active, spans cost a
+function call.
+
+    with conn.trace() as tracer:
+        with conn.batch(50) as batch:
+            ...
+    tracer.save('trace.json')   # Open in https://ui.perfetto.dev
+    print(tracer.report())'''
+
+import collections
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+
+# The active tracer, if any
+_active = None
+
+
+def current():
+    '''The active tracer, or None'''
+    return _active
+
+
+def activate(tracer):
+    '''Make tracer the active tracer, returning the previous one'''
+    global _active
+    previous, _active = _active, tracer
+    return previous
+
+
+def clock():
+    '''The time, as spans measure it'''
+    return time.time()
+
+
+def thread_id():
+    '''An identifier for the running greenlet, or thread'''
+    # Only consult gevent if something else has already imported it
+    gevent = sys.modules.get('gevent')
+    if gevent is not None:
+        return id(gevent.getcurrent())
+    return threading.current_thread().ident
+
+
+class NullSpan(object):
+    '''What span returns when there's no active tracer'''
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, val, trace):
+        pass
+
+    def tag(self, **args):
+        '''Tags are dropped'''
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span(object):
+    '''A span being timed, as a ContextManager'''
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = clock()
+        return self
+
+    def __exit__(self, typ, val, trace):
+        if typ is not None:
+            self.args['error'] = typ.__name__
+        self.tracer.record(self.name, self.cat, self.start, clock(), **self.args)
+
+    def tag(self, **args):
+        '''Add arguments to the span'''
+        self.args.update(args)
+
+
+def span(name, cat='op', **args):
+    '''A ContextManager that records a span on the active tracer, if any'''
+    tracer = _active
+    if tracer is None:
+        return NULL_SPAN
+    return Span(tracer, name, cat, args)
+
+
+def record(name, cat, start, end, **args):
+    '''Record a span that has already happened on the active tracer, if any'''
+    tracer = _active
+    if tracer is not None:
+        tracer.record(name, cat, start, end, **args)
+
+
+def traced(name, cat='op'):
+    '''Decorate a method whose arguments begin with a bucket and key, so that
+    its calls are recorded as spans'''
+    def decorator(func):
+        '''The actual decorator'''
+        @functools.wraps(func)
+        def wrapper(self, bucket, key, *args, **kwargs):
+            '''The decorated method'''
+            if _active is None:
+                return func(self, bucket, key, *args, **kwargs)
+            with span(name, cat, bucket=bucket, key=key):
+                return func(self, bucket, key, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Tracer(object):
+    '''Collects spans, and exports them'''
+    # The fields of each recorded span
+    Record = collections.namedtuple('Record', ('name', 'cat', 'start', 'end', 'tid', 'args'))
+
+    def __init__(self):
+        self.spans = []
+        self.created = clock()
+        self.lock = threading.Lock()
+
+    def record(self, name, cat, start, end, tid=None, **args):
+        '''Record a span'''
+        record = self.Record(
+            name, cat, start, end, thread_id() if tid is None else tid, args)
+        with self.lock:
+            self.spans.append(record)
+
+    def __enter__(self):
+        self._previous = activate(self)
+        return self
+
+    def __exit__(self, typ, val, trace):
+        activate(self._previous)
+
+    def chrome(self):
+        '''The spans as a Chrome trace-event document'''
+        pid = os.getpid()
+        tids = {}
+        events = []
+        for record in sorted(self.spans, key=lambda record: record.start):
+            tid = tids.setdefault(record.tid, len(tids) + 1)
+            events.append({
+                'name': record.name,
+                'cat': record.cat,
+                'ph': 'X',
+                'ts': (record.start - self.created) * 1e6,
+                'dur': (record.end - record.start) * 1e6,
+                'pid': pid,
+                'tid': tid,
+                'args': dict((k, str(v)) for k, v in record.args.items()),
+            })
+        for tid in tids.values():
+            events.append({
+                'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                'args': {'name': 'greenlet %i' % tid}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save(self, path):
+        '''Write the Chrome trace-event JSON to path'''
+        with open(path, 'w') as fout:
+            json.dump(self.chrome(), fout)
+
+    @staticmethod
+    def covered(intervals):
+        '''How much time the union of (start, end) intervals covers'''
+        total = 0
+        last = None
+        for start, end in sorted(intervals):
+            if last is not None and start < last:
+                if end > last:
+                    total += end - last
+                    last = end
+            else:
+                total += end - start
+                last = end
+        return total
+
+    def summary(self):
+        '''Where the time went. For each span name, the count, total, mean
+        and maximum duration; and for each category, the total duration and
+        how much of the wall-clock time its spans covered.'''
+        if not self.spans:
+            return {'wall': 0, 'spans': {}, 'categories': {}}
+        wall = (
+            max(record.end for record in self.spans) -
+            min(record.start for record in self.spans))
+        durations = collections.defaultdict(list)
+        intervals = collections.defaultdict(list)
+        for record in self.spans:
+            durations[(record.cat, record.name)].append(record.end - record.start)
+            intervals[record.cat].append((record.start, record.end))
+        spans = {}
+        for (cat, name), values in durations.items():
+            spans['%s.%s' % (cat, name)] = {
+                'count': len(values),
+                'total': sum(values),
+                'mean': sum(values) / len(values),
+                'max': max(values),
+            }
+        categories = dict(
+            (cat, {
+                'total': sum(end - start for start, end in values),
+                'covered': self.covered(values),
+            }) for cat, values in intervals.items())
+        return {'wall': wall, 'spans': spans, 'categories': categories}
+
+    def report(self):
+        '''A human-readable version of the summary'''
+        summary = self.summary()
+        wall = summary['wall'] or 1
+        lines = ['Wall-clock: %.3fs' % summary['wall'], '']
+        lines.append('%-12s %10s %10s' % ('category', 'total', '% of wall'))
+        for cat, values in sorted(
+                summary['categories'].items(), key=lambda item: -item[1]['total']):
+            lines.append('%-12s %9.3fs %9.1f%%' % (
+                cat, values['total'], 100.0 * values['covered'] / wall))
+        lines.append('')
+        lines.append('%-28s %7s %10s %10s %10s' % ('span', 'count', 'total', 'mean', 'max'))
+        for name, values in sorted(
+                summary['spans'].items(), key=lambda item: -item[1]['total']):
+            lines.append('%-28s %7i %9.3fs %9.1fms %9.1fms' % (
+                name, values['count'], values['total'],
+                values['mean'] * 1000, values['max'] * 1000))
+        return '\n'.join(lines)
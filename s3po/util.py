@@ -1,8 +1,14 @@
 '''Various utilities'''
 
+import io
+import sys
+import threading
 import time
+from six import reraise
 from six.moves import xrange
 
+from . import trace
+
 # Logging
 import logging
 logger = logging.getLogger('s3po')
@@ -28,6 +34,14 @@ class CountFile(object):
         return getattr(self._fobj, attr)
 
 
+def is_text(fobj):
+    '''Whether fobj (or the file that it wraps, for wrappers like CountFile)
+    takes text rather than bytes'''
+    while '_fobj' in getattr(fobj, '__dict__', {}):
+        fobj = fobj._fobj
+    return isinstance(fobj, io.TextIOBase)
+
+
 class Backoff(object):
     '''Various backoff policies'''
     @staticmethod
@@ -57,6 +71,159 @@ def retry(count,
                     interval = policy(attempt)
                     logger.exception(
                         'Sleeping %is after attempt %i' % (interval, attempt))
-                    sleep(interval)
+                    with trace.span('sleep', 'retry', attempt=attempt):
+                        sleep(interval)
         return new_func
     return _retry
+
+
+def coalesce(spans, gap):
+    '''Group (offset, length) spans into runs that are at most gap bytes
+    apart. Returns a list of (offset, length, spans) for each run.'''
+    runs = []
+    for offset, length in sorted(spans):
+        if runs and offset - (runs[-1][0] + runs[-1][1]) <= gap:
+            start, _, members = runs[-1]
+            members.append((offset, length))
+            runs[-1] = (
+                start, max(runs[-1][1], offset + length - start), members)
+        else:
+            runs.append((offset, length, [(offset, length)]))
+    return runs
+
+
+class SingleFlight(object):
+    '''Coalesce concurrent calls that share a key into a single invocation.
+    The first caller for a key runs the function, and anyone asking for the
+    same key while it's still in flight waits for and shares its result.'''
+
+    class Call(object):
+        '''An in-flight invocation that others may wait on'''
+        def __init__(self):
+            # Resolve threading at call time, so that we pick up gevent's
+            # version if it's been monkey-patched in the meantime
+            self.event = sys.modules.get('threading', threading).Event()
+            self.value = None
+            self.error = None
+            self.waiters = 0
+
+        def result(self):
+            '''Return the value, or raise the error of this call'''
+            if self.error:
+                reraise(*self.error)
+            return self.value
+
+    def __init__(self):
+        # Only ever held for dictionary bookkeeping, never across a call
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    def do(self, key, func, *args, **kwargs):
+        '''Invoke func(*args, **kwargs), unless a call for key is already in
+        flight, in which case wait for that call's result instead.'''
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self.Call()
+            else:
+                call.waiters += 1
+        if not leader:
+            call.event.wait()
+            return call.result()
+
+        try:
+            call.value = func(*args, **kwargs)
+        except Exception:
+            call.error = sys.exc_info()
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result()
+
+
+class ThreadPool(object):
+    '''Runs functions in threads, up to size at once, with the parts of the
+    interface of gevent's Pool that we use'''
+
+    class Task(threading.Thread):
+        '''A function running in its own thread'''
+        def __init__(self, pool, func, args, kwargs):
+            threading.Thread.__init__(self)
+            self.daemon = True
+            self.pool = pool
+            self.func = func
+            self.args = args
+            self.kwargs = kwargs
+            self.value = None
+            self.error = None
+
+        def run(self):
+            try:
+                self.value = self.func(*self.args, **self.kwargs)
+            except Exception:
+                self.error = sys.exc_info()
+            finally:
+                self.pool.done(self)
+
+        def get(self):
+            '''Wait for the function, returning its value or raising its error'''
+            self.join()
+            if self.error:
+                reraise(*self.error)
+            return self.value
+
+    def __init__(self, size=None):
+        self.slots = size and threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.tasks = set()
+
+    def spawn(self, func, *args, **kwargs):
+        '''Run func(*args, **kwargs) once there's room, returning its Task'''
+        if self.slots:
+            self.slots.acquire()
+        task = self.Task(self, func, args, kwargs)
+        with self.lock:
+            self.tasks.add(task)
+        task.start()
+        return task
+
+    def done(self, task):
+        '''A task finished'''
+        with self.lock:
+            self.tasks.discard(task)
+        if self.slots:
+            self.slots.release()
+
+    def map(self, func, iterable):
+        '''The results of func on each item, in order'''
+        return [task.get() for task in [self.spawn(func, item) for item in iterable]]
+
+    def join(self):
+        '''Wait for every task, including any that those spawn'''
+        while True:
+            with self.lock:
+                tasks = list(self.tasks)
+            if not tasks:
+                return
+            for task in tasks:
+                task.join()
+
+    def kill(self):
+        '''Threads can't be killed, so running tasks are left to finish'''
+        pass
+
+
+def new_pool(size=None):
+    '''A pool to run up to size functions at once in. That's a gevent pool if
+    gevent has monkey-patched, or else a ThreadPool. gevent is never patched
+    implicitly, since that breaks callers that use threads.'''
+    monkey = sys.modules.get('gevent.monkey')
+    if monkey is not None and monkey.is_module_patched('socket'):
+        from gevent.pool import Pool
+        return Pool(size)
+    return ThreadPool(size)
@@ -45,6 +45,9 @@ setup(
         'python_swiftclient',
         'six'
     ],
+    extras_require={
+        'zstd': ['zstandard']
+    },
     classifiers=[
         'License :: OSI Approved :: MIT License',
         'Development Status :: 4 - Beta',
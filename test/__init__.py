@@ -0,0 +1,3 @@
+# gevent has to monkey-patch before anything (like boto) imports ssl, or it
+# can't patch it properly. Importing batch is what does the patching.
+import s3po.batch
@@ -0,0 +1,233 @@
+'''Replicate across several backends'''
+
+import hashlib
+import os
+
+import gevent
+import mock
+from six import BytesIO
+
+from test.base import BaseTest
+
+from s3po import Connection
+from s3po.backends.memory import Memory
+from s3po.backends.replicated import Replicated
+from s3po.exceptions import DeleteException, DownloadException, UploadException
+from s3po.resumable import Checkpoint
+
+
+class Flaky(Memory):
+    '''A Memory backend that fails some number of calls to some methods, and
+    that can be slow'''
+    def __init__(self, failures=None, delay=0):
+        Memory.__init__(self)
+        self.failures = dict(failures or {})
+        self.delay = delay
+        self.calls = []
+
+    def __getattribute__(self, attr):
+        failures = object.__getattribute__(self, 'failures')
+        method = object.__getattribute__(self, attr)
+        if attr not in ('upload', 'download', 'head', 'read_range', 'list', 'delete'):
+            return method
+
+        def wrapper(*args, **kwargs):
+            '''Maybe sleep, and maybe fail'''
+            self.calls.append(attr)
+            gevent.sleep(self.delay)
+            if failures.get(attr):
+                failures[attr] -= 1
+                if attr == 'download':
+                    args[2].write(b'partial')
+                raise {'upload': UploadException, 'delete': DeleteException}.get(
+                    attr, DownloadException)('%s failed' % attr)
+            return method(*args, **kwargs)
+        return wrapper
+
+
+class ReplicatedTest(BaseTest):
+    '''We can replicate across backends'''
+
+    def connect(self, *backends, **kwargs):
+        '''A connection replicating across the backends'''
+        self.conn = Connection.replicated(backends, **kwargs)
+        return self.conn.backend
+
+    def download(self, key):
+        '''Download key as bytes'''
+        result = BytesIO()
+        self.conn.download('bucket', key, result)
+        return result.getvalue()
+
+    def test_round_trip(self):
+        '''Writes go to every replica'''
+        one, two = Memory(), Connection.memory()
+        self.connect(one, two)
+        self.conn.upload('bucket', 'key', BytesIO(b'content'))
+        self.assertEqual(self.download('key'), b'content')
+        self.assertEqual(one.buckets['bucket']['key'], b'content')
+        self.assertEqual(two.backend.buckets['bucket']['key'], b'content')
+        self.conn.delete('bucket', 'key')
+        self.assertEqual(one.buckets['bucket'], {})
+        self.assertEqual(two.backend.buckets['bucket'], {})
+
+    def test_upload_spooled(self):
+        '''Uploads are spooled in chunks, and each replica reads its own copy'''
+        one, two = Memory(), Flaky(delay=0.01)
+        backend = self.connect(one, two, write_quorum=1)
+        backend.chunk_size = 3
+        backend.spool_size = 4
+        source = BytesIO(b'0123456789')
+        with mock.patch.object(source, 'read', wraps=source.read) as read:
+            self.conn.upload('bucket', 'key', source)
+        self.assertEqual(
+            [call[0] for call in read.call_args_list], [(3,)] * 5)
+        backend.wait()
+        self.assertEqual(one.buckets['bucket']['key'], b'0123456789')
+        self.assertEqual(two.buckets['bucket']['key'], b'0123456789')
+        self.conn.upload('bucket', 'text', u'content')
+        backend.wait()
+        self.assertEqual(two.buckets['bucket']['text'], u'content')
+
+    def test_quorum(self):
+        '''Writes succeed once quorum replicas have them'''
+        self.assertEqual(self.connect(Memory(), Memory(), Memory()).write_quorum, 2)
+        self.assertRaises(ValueError, Replicated, [Memory()], write_quorum=2)
+        self.assertRaises(ValueError, Replicated, [])
+
+        self.connect(Flaky({'upload': 1}), Flaky({'upload': 1}), Memory())
+        self.assertRaises(
+            UploadException, self.conn.upload, 'bucket', 'key', BytesIO(b'content'))
+
+    def test_repair_write(self):
+        '''Replicas that miss a write are repaired in the background'''
+        flaky = Flaky({'upload': 1})
+        backend = self.connect(Memory(), flaky, write_quorum=1)
+        self.conn.upload('bucket', 'key', BytesIO(b'content'),
+            headers={'Content-Type': 'text/plain'})
+        backend.wait()
+        self.assertEqual(flaky.buckets['bucket']['key'], b'content')
+        self.assertEqual(
+            flaky.metadata['bucket']['key']['headers'], {'content-type': 'text/plain'})
+
+        flaky.failures['delete'] = 1
+        self.conn.delete('bucket', 'key')
+        backend.wait()
+        self.assertEqual(flaky.buckets['bucket'], {})
+
+    def test_stragglers(self):
+        '''Writes return without waiting for slow replicas past quorum'''
+        slow = Flaky(delay=0.5)
+        backend = self.connect(Memory(), slow, write_quorum=1)
+        self.conn.upload('bucket', 'key', BytesIO(b'content'))
+        self.assertNotIn('key', slow.buckets['bucket'])
+        backend.wait()
+        self.assertEqual(slow.buckets['bucket']['key'], b'content')
+
+    def test_fastest(self):
+        '''Reads go to the replica with the lowest recent latency'''
+        one, two = Flaky(), Flaky()
+        backend = self.connect(one, two)
+        self.conn.upload('bucket', 'key', BytesIO(b'content'))
+        # Replicas that haven't been measured go first
+        self.assertEqual(backend.order(), [0, 1])
+        backend.observe(0, 0.5)
+        self.assertEqual(backend.order(), [1, 0])
+        backend.observe(1, 1.0)
+        self.assertEqual(backend.order(), [0, 1])
+        backend.observe(1, 0)
+        self.assertAlmostEqual(backend.latency[1], 0.8)
+
+        backend.latency = [0.5, 0.1]
+        self.assertEqual(self.download('key'), b'content')
+        self.assertIn('download', two.calls)
+        self.assertNotIn('download', one.calls)
+
+    def test_failover(self):
+        '''Reads fail over to other replicas, repairing the ones that failed'''
+        lagging = Flaky()
+        backend = self.connect(lagging, Memory(), write_quorum=1)
+        self.conn.upload('bucket', 'key', BytesIO(b'content'))
+        backend.wait()
+        del lagging.buckets['bucket']['key']
+        lagging.failures['download'] = 1
+
+        self.assertEqual(self.download('key'), b'content')
+        # The failure counts against its latency
+        self.assertGreater(backend.latency[0], backend.latency[1])
+        backend.wait()
+        self.assertEqual(lagging.buckets['bucket']['key'], b'content')
+
+        backend.latency = [0, 1]
+        lagging.failures['read_range'] = 1
+        self.assertEqual(backend.read_range('bucket', 'key', 1, 3), b'ont')
+        lagging.failures['head'] = 1
+        self.assertEqual(backend.head('bucket', 'key')['size'], 7)
+
+        backend.latency = [0, 1]
+        lagging.failures['download'] = 2
+        self.assertRaises(DownloadException, self.download, 'missing')
+
+    def test_list(self):
+        '''Listings fail over if they can't be started'''
+        flaky = Flaky({'list': 1})
+        backend = self.connect(flaky, Memory())
+        self.conn.upload('bucket', 'key', BytesIO(b'content'))
+        backend.latency = [0, 1]
+        self.assertEqual(list(self.conn.list('bucket')), ['key'])
+        self.assertEqual(
+            [meta['key'] for meta in self.conn.list_metadata('bucket')], ['key'])
+
+    def test_multipart(self):
+        '''Multipart uploads go to every replica'''
+        one, two = Memory(), Memory()
+        self.connect(one, two)
+        path = self.tmpfile('file')
+        with open(path, 'wb') as fout:
+            fout.write(b'content')
+        self.conn.upload_file(
+            'bucket', 'key', path, checkpoint=self.tmpfile('checkpoint'))
+        self.assertEqual(one.buckets['bucket']['key'], b'content')
+        self.assertEqual(two.buckets['bucket']['key'], b'content')
+        self.assertEqual(self.conn.backend.multipart_list('bucket', 'key'), [])
+
+        upload_id = self.conn.backend.multipart_start('bucket', 'other')
+        self.assertEqual(
+            [upload for upload, _ in self.conn.backend.multipart_list('bucket', 'other')],
+            self.conn.backend.multipart_ids(upload_id))
+        self.conn.backend.multipart_abort('bucket', 'other', upload_id)
+        self.assertEqual(one.multipart_list('bucket', 'other'), [])
+        self.assertEqual(two.multipart_list('bucket', 'other'), [])
+
+    def test_resume_multipart(self):
+        '''Uploads are listed from the replicas, so they resume afresh'''
+        one, two = Memory(), Memory()
+        backend = self.connect(one, two)
+        upload_id = backend.multipart_start('bucket', 'key')
+        backend.multipart_part('bucket', 'key', upload_id, 1, b'01234')
+        stale = two.multipart_start('bucket', 'key')
+        two.uploads[('bucket', 'key')][stale]['initiated'] -= 2 * 24 * 60 * 60
+        path = self.tmpfile('file')
+        with open(path, 'wb') as fout:
+            fout.write(b'0123456789')
+        checkpoint = Checkpoint(self.tmpfile('checkpoint'))
+        stat = os.stat(path)
+        checkpoint.save({
+            'source': {
+                'bucket': 'bucket', 'key': 'key',
+                'size': stat.st_size, 'mtime': stat.st_mtime},
+            'upload_id': upload_id,
+            'part_size': 5,
+            'parts': {'1': hashlib.md5(b'01234').hexdigest()}
+        })
+
+        # A new connection resumes the upload, and aborts the stale one
+        backend = self.connect(one, two)
+        with mock.patch.object(
+                backend, 'multipart_part', wraps=backend.multipart_part) as part:
+            self.conn.upload_file(
+                'bucket', 'key', path, checkpoint=checkpoint.path)
+        self.assertEqual([call[0][3] for call in part.call_args_list], [2])
+        self.assertEqual(self.download('key'), b'0123456789')
+        self.assertEqual(one.multipart_list('bucket', 'key'), [])
+        self.assertEqual(two.multipart_list('bucket', 'key'), [])
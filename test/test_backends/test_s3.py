@@ -1,5 +1,7 @@
 '''Talk to S3'''
 
+import datetime
+
 from six import StringIO
 from botocore.exceptions import BotoCoreError, ClientError
 
@@ -7,7 +9,7 @@ import mock
 
 from test.base import BaseTest
 
-from s3po.backends.s3 import S3
+from s3po.backends.s3 import S3, header_args
 from s3po.exceptions import UploadException, DownloadException, DeleteException
 
 
@@ -66,6 +68,15 @@ class S3BackendTest(BaseTest):
         self.backend.download('bucket', 'key', result, 1)
         self.assertEqual(result.getvalue(), data)
 
+    def test_header_args(self):
+        '''Translates headers into ExtraArgs'''
+        self.assertEqual(
+            header_args({'Content-Encoding': 'gzip', 'X-Amz-Meta-Foo': 'bar'},
+                        {'ACL': 'private'}),
+            {'ContentEncoding': 'gzip', 'Metadata': {'foo': 'bar'}, 'ACL': 'private'})
+        self.assertEqual(header_args(None), None)
+        self.assertRaises(ValueError, header_args, {'X-Unknown': 'foo'})
+
     def test_list(self):
         '''Can list a bucket'''
         self.bucket.Object('abc')
@@ -78,6 +89,91 @@ class S3BackendTest(BaseTest):
         self.assertEqual(list(self.backend.list('bucket', prefix='a')),
                          ['abc'])
 
+    def test_list_metadata(self):
+        '''Can list a bucket with metadata'''
+        self.backend.upload('bucket', 'abc', StringIO('content'), 1)
+        self.assertEqual(list(self.backend.list_metadata('bucket')), [{
+            'key': 'abc', 'size': 7, 'etag': 'etag', 'modified': 1546300800}])
+
+    def test_head(self):
+        '''Can get the metadata of an object'''
+        with mock.patch.object(self.backend.conn.meta, 'client') as client:
+            client.head_object.return_value = {
+                'ContentLength': 7, 'ETag': '"etag"',
+                'LastModified': datetime.datetime(2019, 1, 1),
+                'ResponseMetadata': {'HTTPHeaders': {}}}
+            meta = self.backend.head('bucket', 'key', 1)
+            # So that any stored checksum is included
+            client.head_object.assert_called_with(
+                Bucket='bucket', Key='key', ChecksumMode='ENABLED')
+        self.assertEqual(
+            (meta['size'], meta['etag'], meta['modified']), (7, 'etag', 1546300800))
+
+    def test_old_botocore(self):
+        '''Checksum parameters are only sent when botocore knows of them'''
+        self.backend._parameters = {'HeadObject': set(), 'PutObject': set()}
+        with mock.patch.object(self.backend.conn.meta, 'client') as client:
+            client.head_object.return_value = {
+                'ContentLength': 7, 'ETag': '"etag"',
+                'LastModified': datetime.datetime(2019, 1, 1),
+                'ResponseMetadata': {'HTTPHeaders': {}}}
+            self.backend.head('bucket', 'key', 1)
+            client.head_object.assert_called_with(Bucket='bucket', Key='key')
+            self.assertIsNone(self.backend.part_size('bucket', 'key', 1))
+        key = self.bucket.Object('key')
+        with mock.patch('s3po.backends.s3.HAS_CRT', True):
+            with mock.patch.object(key, 'upload_fileobj') as upload_fileobj:
+                self.backend.upload('bucket', 'key', StringIO('content'), 1)
+        self.assertIsNone(upload_fileobj.call_args[1]['ExtraArgs'])
+
+    def test_on_response(self):
+        '''Downloads tell their destination about the object they got'''
+        response = {
+            'ContentLength': 3, 'ContentRange': 'bytes 4-6/7', 'ETag': '"etag"',
+            'LastModified': datetime.datetime(2019, 1, 1),
+            'ResponseMetadata': {'HTTPHeaders': {'content-encoding': 'gzip'}}}
+
+        def download_fileobj(fobj, Config, ExtraArgs=None):
+            '''Have botocore make a GetObject call'''
+            self.backend._get_object(parsed=response)
+            fobj.write('content')
+
+        destination = mock.Mock()
+        key = self.bucket.Object('key')
+        with mock.patch.object(key, 'download_fileobj', side_effect=download_fileobj):
+            self.backend.download('bucket', 'key', destination, 1)
+        meta = destination.on_response.call_args[0][0]
+        self.assertEqual(
+            (meta['size'], meta['etag'], meta['headers']),
+            (7, 'etag', {'content-encoding': 'gzip'}))
+        destination.write.assert_called_with('content')
+        # Nothing's told once the download is done
+        self.backend._get_object(parsed=response)
+        self.assertEqual(destination.on_response.call_count, 1)
+
+    def test_read_range(self):
+        '''Reads ranges with a Range header'''
+        with mock.patch.object(self.backend.conn.meta, 'client') as client:
+            client.get_object.return_value['Body'].read.return_value = b'ten'
+            self.assertEqual(
+                self.backend.read_range('bucket', 'key', 10, 3, 1), b'ten')
+            client.get_object.assert_called_with(
+                Bucket='bucket', Key='key', Range='bytes=10-12')
+
+    def test_multipart(self):
+        '''Can drive the parts of a multipart upload'''
+        with mock.patch.object(self.backend.conn.meta, 'client') as client:
+            client.create_multipart_upload.return_value = {'UploadId': 'id'}
+            client.upload_part.return_value = {'ETag': '"etag"'}
+            upload_id = self.backend.multipart_start('bucket', 'key', 1)
+            self.assertEqual(self.backend.multipart_part(
+                'bucket', 'key', upload_id, 1, b'data', 1), 'etag')
+            self.backend.multipart_complete(
+                'bucket', 'key', upload_id, [(1, 'etag')], 1)
+            client.complete_multipart_upload.assert_called_with(
+                Bucket='bucket', Key='key', UploadId='id',
+                MultipartUpload={'Parts': [{'PartNumber': 1, 'ETag': '"etag"'}]})
+
     def test_delete(self):
         '''Can delete a key'''
         self.bucket.Object('abc')
@@ -113,6 +209,9 @@ class Bucket(object):
                     def __init__(self, bucket, key):
                         self.bucket = bucket
                         self.key = key
+                        self.size = len(bucket.keys[key].data)
+                        self.e_tag = '"etag"'
+                        self.last_modified = datetime.datetime(2019, 1, 1)
 
                     def Object(self):
                         return self.bucket.Object(key)
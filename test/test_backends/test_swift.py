@@ -1,5 +1,7 @@
 '''Talk to Swift'''
 
+import json
+
 from six import StringIO
 from swiftclient.exceptions import ClientException
 
@@ -70,6 +72,87 @@ class SwiftBackendTest(BaseTest):
         self.assertEqual(list(self.backend.list('bucket')),
                          ['key'])
 
+    def test_list_metadata(self):
+        '''Can list a container with metadata'''
+        self.conn.get_container.side_effect = [
+            (None, [{'name': 'key', 'bytes': 7, 'hash': 'etag',
+                     'last_modified': '2019-01-01T00:00:00.000000'}]),
+            (None, [])]
+        self.assertEqual(list(self.backend.list_metadata('bucket')), [{
+            'key': 'key', 'size': 7, 'etag': 'etag', 'modified': 1546300800}])
+
+    def test_head(self):
+        '''Can get the metadata of an object.'''
+        self.conn.head_object.return_value = {
+            'Content-Length': '7', 'ETag': '"etag"',
+            'Last-Modified': 'Tue, 01 Jan 2019 00:00:00 GMT'}
+        meta = self.backend.head('bucket', 'key', 1)
+        self.assertEqual(
+            (meta['size'], meta['etag'], meta['modified']), (7, 'etag', 1546300800))
+
+    def test_read_range(self):
+        '''Reads ranges with a Range header.'''
+        self.conn.get_object.return_value = ({}, b'ten')
+        self.assertEqual(self.backend.read_range('bucket', 'key', 10, 3, 1), b'ten')
+        self.conn.get_object.assert_called_with(
+            'bucket', 'key', headers={'Range': 'bytes=10-12'})
+        self.backend.read_range('bucket', 'key', None, 3, 1)
+        self.conn.get_object.assert_called_with(
+            'bucket', 'key', headers={'Range': 'bytes=-3'})
+
+    def test_multipart(self):
+        '''Uploads segments, and completes with a manifest.'''
+        upload_id = self.backend.multipart_start('bucket', 'key', 1)
+        self.conn.put_container.assert_called_with('bucket_segments')
+        self.conn.put_object.return_value = 'etag'
+        self.assertEqual(self.backend.multipart_part(
+            'bucket', 'key', upload_id, 1, b'data', 1), 'etag')
+        self.conn.put_object.assert_called_with(
+            'bucket_segments', 'key/%s/00000001' % upload_id, b'data')
+        self.conn.get_container.side_effect = [
+            (None, [{'name': 'key/%s/00000001' % upload_id, 'bytes': 4}]),
+            (None, [])]
+        self.backend.multipart_complete(
+            'bucket', 'key', upload_id, [(1, 'etag')], 1,
+            headers={'Content-Type': 'text/plain'})
+        self.conn.put_object.assert_called_with(
+            'bucket', 'key', json.dumps([{
+                'path': '/bucket_segments/key/%s/00000001' % upload_id,
+                'etag': 'etag', 'size_bytes': 4}]),
+            headers={'Content-Type': 'text/plain'},
+            query_string='multipart-manifest=put')
+
+    def test_multipart_missing(self):
+        '''Can't complete an upload with a missing segment.'''
+        self.conn.get_container.return_value = (None, [])
+        self.assertRaises(
+            UploadException, self.backend.multipart_complete,
+            'bucket', 'key', '1.aa', [(1, 'etag')], 1)
+
+    def test_multipart_list(self):
+        '''Lists uploads other than the one the object refers to.'''
+        self.conn.head_object.return_value = {'x-static-large-object': 'True'}
+        self.conn.get_object.return_value = (None, json.dumps([
+            {'name': '/bucket_segments/key/1.aa/00000001'}]))
+        self.conn.get_container.side_effect = [
+            (None, [
+                {'subdir': 'key/1.aa/'}, {'subdir': 'key/2.bb/'},
+                # The segments of key/other
+                {'subdir': 'key/other/'}]),
+            (None, [])]
+        self.assertEqual(
+            self.backend.multipart_list('bucket', 'key', 1), [('2.bb', 2)])
+
+    def test_multipart_list_dynamic(self):
+        '''Uploads referred to by dynamic large objects are in use too.'''
+        self.conn.head_object.return_value = {
+            'x-object-manifest': 'bucket_segments/key/1.aa/'}
+        self.conn.get_container.side_effect = [
+            (None, [{'subdir': 'key/1.aa/'}, {'subdir': 'key/2.bb/'}]),
+            (None, [])]
+        self.assertEqual(
+            self.backend.multipart_list('bucket', 'key', 1), [('2.bb', 2)])
+
     def test_delete(self):
         '''Raises DeleteException when Swift raises.'''
         self.conn.delete_object.side_effect = ClientException('Failed to delete')
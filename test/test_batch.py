@@ -2,10 +2,25 @@
 
 import unittest
 
+import gevent
+
+from s3po.backends.memory import Memory
 from s3po.connection import Connection
 from s3po.exceptions import DownloadException
 
 
+class SlowMemory(Memory):
+    '''An in-memory backend that takes a while, and counts its downloads'''
+    def __init__(self):
+        Memory.__init__(self)
+        self.downloads = 0
+
+    def download(self, *args, **kwargs):
+        self.downloads += 1
+        gevent.sleep(0.01)
+        return Memory.download(self, *args, **kwargs)
+
+
 class BatchTest(unittest.TestCase):
     '''We should be able to batch some requests out'''
     def setUp(self):
@@ -65,3 +80,114 @@ class BatchTest(unittest.TestCase):
                 batch.download('bucket', key)
 
         self.assertFalse(batch.success())
+
+    def test_coalesced_downloads(self):
+        '''Concurrent downloads of the same key share one fetch'''
+        backend = SlowMemory()
+        conn = Connection(backend)
+        conn.upload('bucket', 'key', 'content')
+        with conn.batch() as batch:
+            for _ in range(10):
+                batch.download('bucket', 'key')
+        self.assertEqual(batch.results(), ['content'] * 10)
+        self.assertEqual(backend.downloads, 1)
+
+    def test_uncoalesced_downloads(self):
+        '''Coalescing can be turned off'''
+        backend = SlowMemory()
+        conn = Connection(backend, coalesce=False)
+        conn.upload('bucket', 'key', 'content')
+        with conn.batch() as batch:
+            for _ in range(10):
+                batch.download('bucket', 'key')
+        self.assertEqual(batch.results(), ['content'] * 10)
+        self.assertEqual(backend.downloads, 10)
+
+
+class SchedulingTest(unittest.TestCase):
+    '''Batches can prioritize, limit and take turns'''
+    def setUp(self):
+        self.backend = SlowMemory()
+        self.conn = Connection(self.backend)
+        self.order = []
+
+    def download(self, batch, bucket, key, **kwargs):
+        '''Download bucket/key, recording the order that downloads finish'''
+        self.conn.upload(bucket, key, key)
+        batch.download(bucket, key, callback=self.finished, **kwargs)
+
+    def finished(self, value):
+        '''Record that a download finished'''
+        self.order.append(value)
+        return value
+
+    def test_default(self):
+        '''By default, requests start in order'''
+        with self.conn.batch(1) as batch:
+            for i in range(5):
+                self.download(batch, 'bucket', 'key-%i' % i)
+        self.assertIsNone(batch.scheduler)
+        self.assertEqual(self.order, ['key-%i' % i for i in range(5)])
+        self.assertEqual(batch.queue_waits()['default']['count'], 5)
+        self.assertRaises(ValueError, batch.download, 'bucket', 'key', priority='bulk')
+        self.assertTrue(batch.success())
+
+    def test_priorities(self):
+        '''Requests of more important classes jump the queue'''
+        with self.conn.batch(1, priorities=['interactive', 'bulk']) as batch:
+            for i in range(3):
+                self.download(batch, 'bucket', 'bulk-%i' % i, priority='bulk')
+            for i in range(2):
+                self.download(batch, 'bucket', 'interactive-%i' % i, priority='interactive')
+        self.assertEqual(self.order, [
+            'bulk-0', 'interactive-0', 'interactive-1', 'bulk-1', 'bulk-2'])
+        self.assertTrue(batch.success())
+        self.assertEqual(batch.results(), [
+            'bulk-0', 'bulk-1', 'bulk-2', 'interactive-0', 'interactive-1'])
+
+        waits = batch.queue_waits()
+        self.assertEqual(waits['bulk']['count'], 3)
+        self.assertEqual(waits['interactive']['count'], 2)
+        self.assertGreater(waits['bulk']['max'], waits['interactive']['max'])
+        self.assertEqual(waits['default']['mean'], 0)
+
+    def test_limits(self):
+        '''Classes can be limited in how many of their requests run at once'''
+        running = []
+        peak = []
+        download = self.backend.download
+
+        def counted(*args, **kwargs):
+            '''Track how many downloads are running at once'''
+            running.append(1)
+            peak.append(len(running))
+            try:
+                return download(*args, **kwargs)
+            finally:
+                running.pop()
+        self.backend.download = counted
+
+        with self.conn.batch(10, limits={'default': 2}) as batch:
+            for i in range(6):
+                self.download(batch, 'bucket', 'key-%i' % i)
+        self.assertEqual(max(peak), 2)
+        self.assertEqual(len(self.order), 6)
+
+    def test_fair(self):
+        '''Requests take turns by bucket'''
+        with self.conn.batch(1, fair='bucket') as batch:
+            for i in range(3):
+                self.download(batch, 'busy', 'key-%i' % i)
+            for i in range(2):
+                self.download(batch, 'quiet', 'other-%i' % i)
+        self.assertEqual(
+            self.order, ['key-0', 'key-1', 'other-0', 'key-2', 'other-1'])
+
+    def test_flow(self):
+        '''Flows can be by bucket, prefix, or anything else'''
+        batch = self.conn.batch(fair='prefix')
+        self.assertEqual(batch.flow('bucket', 'a/b/c'), ('bucket', 'a'))
+        self.assertEqual(batch.flow('bucket', 'key'), 'bucket')
+        batch = self.conn.batch(fair=lambda bucket, key, *args, **kwargs: key[0])
+        self.assertEqual(batch.flow('bucket', 'key'), 'k')
+        self.assertIsNone(self.conn.batch().flow('bucket', 'key'))
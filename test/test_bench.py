@@ -0,0 +1,57 @@
+'''Test our benchmark harness'''
+
+import json
+
+from test.base import BaseTest
+
+from bench.run import Bench, compare, main
+
+
+class BenchTest(BaseTest):
+    '''The benchmarks run, and can be compared'''
+    args = [
+        '--small-count', '5', '--large-size', '1024', '--list-count', '5',
+        '--poolsizes', '1,2', '--repeat', '1',
+        '--import-runs', '0']
+
+    def test_run(self):
+        '''Produces a result for each benchmark'''
+        results = Bench(
+            self.conn, small_count=5, large_size=1024, list_count=5,
+            poolsizes=(1, 2), repeat=1, import_runs=1).run()
+        self.assertTrue(set([
+            'small_upload', 'small_download', 'large_upload', 'large_download',
+            'list', 'batch_download_1', 'batch_download_2', 'import']) <= set(results))
+        self.assertEqual(results['large_upload']['unit'], 'MB/s')
+
+    def test_compare(self):
+        '''Finds results that got worse by more than the tolerance'''
+        baseline = {
+            'ops': {'value': 100, 'unit': 'ops/s', 'higher_is_better': True},
+            'memory': {'value': 10, 'unit': 'KB', 'higher_is_better': False},
+            'new': {'value': 0, 'unit': 'ops/s', 'higher_is_better': True},
+        }
+        results = {
+            'ops': {'value': 95, 'unit': 'ops/s', 'higher_is_better': True},
+            'memory': {'value': 12, 'unit': 'KB', 'higher_is_better': False},
+            'new': {'value': 1, 'unit': 'ops/s', 'higher_is_better': True},
+        }
+        self.assertEqual(
+            [name for name, _, _, _ in compare(results, baseline, 0.1)], ['memory'])
+        self.assertEqual(compare(results, baseline, 0.5), [])
+
+    def test_baseline(self):
+        '''Writes results that can be used as a baseline'''
+        path = self.tmpfile('results.json')
+        self.assertEqual(main(self.args + ['--output', path]), 0)
+        with open(path) as fin:
+            output = json.load(fin)
+        self.assertEqual(output['meta']['backend'], 'memory')
+
+        # Make the baseline impossibly good
+        for result in output['results'].values():
+            result['value'] *= 1000 if result['higher_is_better'] else 0.001
+        with open(path, 'w') as fout:
+            json.dump(output, fout)
+        self.assertEqual(main(self.args + [
+            '--output', self.tmpfile('new.json'), '--baseline', path]), 1)
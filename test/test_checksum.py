@@ -0,0 +1,257 @@
+'''Test our integrity checksums'''
+
+import hashlib
+import unittest
+
+import mock
+from six import BytesIO
+
+from test.base import BaseTest
+
+from s3po.backends.memory import Memory
+from s3po.checksum import (
+    Checksum, HashingWriter, crc32c, matches, multipart_etags)
+from s3po.exceptions import ChecksumException, UploadException
+
+
+class ChecksumTest(unittest.TestCase):
+    '''We can checksum streams in one pass'''
+
+    def test_crc32c(self):
+        '''Computes the standard CRC32C check value, incrementally'''
+        self.assertEqual(crc32c(b'123456789'), 0xE3069283)
+        self.assertEqual(crc32c(b'6789', crc32c(b'12345')), 0xE3069283)
+
+    def test_parts(self):
+        '''Computes the md5 of each part, across chunk boundaries'''
+        checksum = Checksum(part_size=4, crc=True)
+        for chunk in (b'01', b'2345678', b'9'):
+            checksum.update(chunk)
+        self.assertEqual(checksum.md5, hashlib.md5(b'0123456789').hexdigest())
+        self.assertEqual(checksum.parts, [
+            hashlib.md5(part).hexdigest() for part in (b'0123', b'4567', b'89')])
+        self.assertEqual(checksum.crc32c, 'KAwGng==')
+        self.assertEqual(checksum.size, 10)
+
+    def test_matches(self):
+        '''Matches plain, multipart and manifest etags'''
+        checksum = Checksum(part_size=4)
+        checksum.update(b'0123456789')
+        s3, swift = multipart_etags(checksum.parts)
+        self.assertTrue(checksum.matches(checksum.md5))
+        self.assertTrue(checksum.matches('"%s"' % checksum.md5))
+        self.assertTrue(checksum.matches(s3))
+        self.assertTrue(checksum.matches(swift))
+        self.assertFalse(checksum.matches('0' * 32))
+        # Multipart etags can only be checked knowing the object's part size
+        self.assertIsNone(checksum.matches('0' * 32 + '-3'))
+        self.assertIsNone(checksum.matches('0' * 32 + '-3', part_size=5))
+        self.assertFalse(checksum.matches('0' * 32 + '-3', part_size=4))
+        self.assertIsNone(checksum.matches('0' * 32 + '-2', part_size=5))
+        # As can Swift manifests
+        headers = {'x-static-large-object': 'True'}
+        self.assertIsNone(checksum.matches('0' * 32, headers))
+        self.assertFalse(checksum.matches('0' * 32, headers, part_size=4))
+
+    def test_matches_part_size(self):
+        '''Multipart etags are checked against the object's own part size'''
+        backend = Memory()
+        upload_id = backend.multipart_start('bucket', 'key')
+        parts = [
+            (number, backend.multipart_part('bucket', 'key', upload_id, number, data))
+            for number, data in enumerate((b'0123', b'4567', b'89ab'), 1)]
+        backend.multipart_complete('bucket', 'key', upload_id, parts)
+        meta = backend.head('bucket', 'key')
+        # The same number of parts, but of a different size
+        checksum = Checksum(part_size=5)
+        checksum.update(b'0123456789ab')
+        self.assertIsNone(matches(backend, 'bucket', 'key', checksum, meta))
+        # When the part sizes are the same, a mismatch is a mismatch
+        checksum = Checksum(part_size=4)
+        checksum.update(b'0123456789aX')
+        self.assertIsNone(checksum.matches(meta['etag'], meta['headers']))
+        self.assertFalse(matches(backend, 'bucket', 'key', checksum, meta))
+        checksum = Checksum(part_size=4)
+        checksum.update(b'0123456789ab')
+        self.assertTrue(matches(backend, 'bucket', 'key', checksum, meta))
+
+    def test_crc_header(self):
+        '''Checks against CRC32C checksum headers when computed'''
+        checksum = Checksum(crc=True)
+        checksum.update(b'content')
+        headers = {'x-amz-checksum-crc32c': checksum.crc32c}
+        self.assertTrue(checksum.matches(checksum.md5, headers))
+        self.assertTrue(checksum.matches('0' * 32 + '-2', headers))
+        headers = {'x-amz-checksum-crc32c': 'AAAAAA=='}
+        self.assertFalse(checksum.matches(checksum.md5, headers))
+
+    def test_encrypted(self):
+        '''The etags of objects encrypted with KMS or customer keys aren't md5s'''
+        checksum = Checksum(crc=True)
+        checksum.update(b'content')
+        headers = {'x-amz-server-side-encryption': 'aws:kms'}
+        self.assertIsNone(checksum.matches('0' * 32, headers))
+        headers['x-amz-checksum-crc32c'] = checksum.crc32c
+        self.assertTrue(checksum.matches('0' * 32, headers))
+        headers = {'x-amz-server-side-encryption-customer-algorithm': 'AES256'}
+        self.assertIsNone(checksum.matches('0' * 32, headers))
+        headers = {'x-amz-server-side-encryption': 'AES256'}
+        self.assertFalse(checksum.matches('0' * 32, headers))
+
+    def test_writer_restarts(self):
+        '''Seeking a writer back to its start restarts its checksum'''
+        writer = HashingWriter(BytesIO(), Checksum)
+        writer.write(b'garbage')
+        writer.seek(0)
+        writer.write(b'content')
+        self.assertEqual(writer.checksum.md5, hashlib.md5(b'content').hexdigest())
+        self.assertRaises(IOError, writer.seek, 3)
+
+
+class VerifyTest(BaseTest):
+    '''Connections can verify what they upload and download'''
+
+    def setUp(self):
+        BaseTest.setUp(self)
+        self.sleep = mock.patch('time.sleep')
+        self.sleep.start()
+
+    def tearDown(self):
+        self.sleep.stop()
+        BaseTest.tearDown(self)
+
+    def corrupt_head(self, times, method='head'):
+        '''Make head (or the metadata that downloads report) give a bad etag
+        the first few times'''
+        original = getattr(self.conn.backend, method)
+        calls = []
+
+        def func(*args, **kwargs):
+            '''Maybe corrupt the etag'''
+            calls.append(args)
+            meta = original(*args, **kwargs)
+            if len(calls) <= times:
+                meta['etag'] = '0' * 32
+            return meta
+        return mock.patch.object(self.conn.backend, method, side_effect=func)
+
+    def test_round_trip(self):
+        '''Verified uploads and downloads succeed'''
+        self.conn.upload('bucket', 'key', BytesIO(b'content'), verify=True)
+        result = BytesIO()
+        self.conn.download('bucket', 'key', result, verify=True)
+        self.assertEqual(result.getvalue(), b'content')
+        self.conn.upload('bucket', 'string', 'content', verify=True)
+        self.assertEqual(self.conn.download('bucket', 'string', verify=True), 'content')
+
+    def test_compressed(self):
+        '''Verification is of the data as stored'''
+        self.conn.upload(
+            'bucket', 'key', BytesIO(b'content'), encoding='gzip', verify=True)
+        self.assertEqual(
+            self.conn.download('bucket', 'key', decompress=True, verify=True),
+            b'content')
+
+    def test_download_retry(self):
+        '''A mismatched download is retried, checking each attempt against the
+        object that it actually got'''
+        self.conn.upload('bucket', 'key', BytesIO(b'content'))
+        with mock.patch.object(
+                self.conn.backend, 'download', wraps=self.conn.backend.download) as download:
+            with self.corrupt_head(1, '_meta'):
+                result = BytesIO()
+                self.conn.download('bucket', 'key', result, retries=2, verify=True)
+                self.assertEqual(download.call_count, 2)
+                self.assertEqual(result.getvalue(), b'content')
+
+            download.reset_mock()
+            with self.corrupt_head(10, '_meta'):
+                result = BytesIO()
+                self.assertRaises(
+                    ChecksumException,
+                    self.conn.download, 'bucket', 'key', result, retries=2, verify=True)
+                self.assertEqual(download.call_count, 3)
+        # Nothing unverified is left behind
+        self.assertEqual(result.getvalue(), b'')
+
+    def test_response_etag(self):
+        '''Downloads are checked against the etag of the response, not a head
+        that may have been made of an older version'''
+        self.conn.upload('bucket', 'key', BytesIO(b'content'))
+        with self.corrupt_head(10):
+            result = BytesIO()
+            self.conn.download('bucket', 'key', result, verify=True)
+        self.assertEqual(result.getvalue(), b'content')
+
+    def test_upload_retry(self):
+        '''A mismatched upload is retried'''
+        with self.corrupt_head(1):
+            self.conn.upload('bucket', 'key', BytesIO(b'content'), verify=True)
+        with self.corrupt_head(10):
+            self.assertRaises(
+                ChecksumException, self.conn.upload, 'bucket', 'key',
+                BytesIO(b'content'), retries=1, verify=True)
+
+    def test_part_retry(self):
+        '''Only the part that was corrupted is uploaded again'''
+        backend = self.conn.backend
+        backend.multipart_chunk_size = 4
+        path = self.tmpfile('data')
+        with open(path, 'wb') as fout:
+            fout.write(b'0123456789')
+        calls = []
+
+        def func(bucket, key, upload_id, number, data, retries, md5=None):
+            '''Report a bad etag for the first attempt at part 2'''
+            calls.append(number)
+            etag = Memory.multipart_part(
+                backend, bucket, key, upload_id, number, data, retries, md5)
+            return '0' * 32 if calls == [1, 2] else etag
+
+        with mock.patch.object(backend, 'multipart_part', side_effect=func):
+            self.conn.upload_file(
+                'bucket', 'key', path, checkpoint=self.tmpfile('checkpoint'),
+                verify=True)
+        self.assertEqual(calls, [1, 2, 2, 3])
+
+    def test_encrypted_parts(self):
+        '''Part etags that aren't md5s (as with SSE-KMS) aren't checked'''
+        backend = self.conn.backend
+        backend.multipart_chunk_size = 4
+        path = self.tmpfile('data')
+        with open(path, 'wb') as fout:
+            fout.write(b'0123456789')
+
+        def func(bucket, key, upload_id, number, data, retries, md5=None):
+            '''Report an etag that isn't an md5'''
+            Memory.multipart_part(
+                backend, bucket, key, upload_id, number, data, retries, md5)
+            return 'kms-%i' % number
+
+        for verify in (False, True):
+            with mock.patch.object(backend, 'multipart_part', side_effect=func):
+                self.conn.upload_file(
+                    'bucket', 'key', path, checkpoint=self.tmpfile('checkpoint'),
+                    verify=verify)
+            self.assertEqual(backend.buckets['bucket']['key'], b'0123456789')
+
+    def test_resumable_download(self):
+        '''Resumable downloads can be verified'''
+        self.conn.upload('bucket', 'key', BytesIO(b'0123456789'))
+        self.conn.backend.multipart_chunk_size = 4
+        path = self.tmpfile('data')
+        self.conn.download_file(
+            'bucket', 'key', path, checkpoint=self.tmpfile('checkpoint'),
+            verify=True)
+        with self.corrupt_head(1):
+            self.assertRaises(
+                ChecksumException, self.conn.download_file, 'bucket', 'key', path,
+                checkpoint=self.tmpfile('checkpoint'), verify=True)
+
+    def test_bad_digest(self):
+        '''The backend rejects parts that don't match their md5'''
+        backend = self.conn.backend
+        upload_id = backend.multipart_start('bucket', 'key')
+        self.assertRaises(
+            UploadException, backend.multipart_part,
+            'bucket', 'key', upload_id, 1, b'data', 1, md5='0' * 32)
@@ -0,0 +1,127 @@
+'''Test our streaming compression'''
+
+import gzip
+import unittest
+
+import mock
+from six import BytesIO
+
+from test.base import BaseTest
+
+from s3po import compression
+from s3po.compression import CompressingReader, DecompressingWriter
+
+
+class SerialPool(object):
+    '''Anything with a map method will do as a pool'''
+    def __init__(self):
+        self.calls = 0
+
+    def map(self, func, iterable):
+        self.calls += 1
+        return [func(item) for item in iterable]
+
+
+class CompressionTest(BaseTest):
+    '''We can compress uploads and decompress downloads as they stream'''
+    data = b'{"key": "value", "list": [1, 2, 3]}\n' * 100000
+
+    def round_trip(self, encoding, pool=None):
+        '''Upload compressed, and download decompressed'''
+        self.conn.upload(
+            'bucket', 'key', BytesIO(self.data), encoding=encoding, pool=pool)
+        stored = self.conn.backend.buckets['bucket']['key']
+        self.assertLess(len(stored), len(self.data) / 5)
+        self.assertEqual(
+            self.conn.backend.head('bucket', 'key')['headers']['content-encoding'],
+            encoding)
+        self.assertEqual(self.conn.download('bucket', 'key', decompress=True), self.data)
+        return stored
+
+    def test_gzip(self):
+        '''Can round-trip gzip, and it's gzip that anyone can read'''
+        stored = self.round_trip('gzip')
+        self.assertEqual(gzip.GzipFile(fileobj=BytesIO(stored)).read(), self.data)
+
+    @unittest.skipIf(compression.zstandard is None, 'zstandard is not installed')
+    def test_zstd(self):
+        '''Can round-trip zstd'''
+        self.round_trip('zstd')
+
+    def test_pool(self):
+        '''Blocks can be compressed independently through a pool'''
+        pool = SerialPool()
+        stored = self.round_trip('gzip', pool=pool)
+        # Several gzip members, which any gzip reader can handle
+        self.assertGreater(pool.calls, 0)
+        self.assertEqual(gzip.GzipFile(fileobj=BytesIO(stored)).read(), self.data)
+
+    @unittest.skipIf(compression.zstandard is None, 'zstandard is not installed')
+    def test_zstd_pool(self):
+        '''Concatenated zstd frames are decompressed too'''
+        self.round_trip('zstd', pool=SerialPool())
+
+    def test_string(self):
+        '''Strings are compressed as UTF-8'''
+        self.conn.upload('bucket', 'key', 'content', encoding='gzip')
+        self.assertEqual(self.conn.download('bucket', 'key', decompress=True), b'content')
+
+    def test_empty(self):
+        '''Empty sources make for valid streams'''
+        for pool in (None, SerialPool()):
+            reader = CompressingReader(BytesIO(), 'gzip', pool=pool)
+            self.assertEqual(gzip.GzipFile(fileobj=BytesIO(reader.read())).read(), b'')
+
+    def test_uncompressed(self):
+        '''Objects without a Content-Encoding are left alone'''
+        self.conn.upload('bucket', 'key', BytesIO(b'content'))
+        self.assertEqual(self.conn.download('bucket', 'key', decompress=True), b'content')
+        self.conn.upload('bucket', 'string', 'content')
+        self.assertEqual(
+            self.conn.download('bucket', 'string', decompress=True), b'content')
+
+    def test_response_encoding(self):
+        '''The Content-Encoding comes from the response, without a head'''
+        self.conn.upload('bucket', 'key', BytesIO(self.data), encoding='gzip')
+        with mock.patch.object(self.conn.backend, 'head') as head:
+            self.assertEqual(
+                self.conn.download('bucket', 'key', decompress=True), self.data)
+        self.assertFalse(head.called)
+
+    def test_download_file(self):
+        '''Can decompress into a file'''
+        path = self.tmpfile('download')
+        self.conn.upload('bucket', 'key', BytesIO(self.data), encoding='gzip')
+        self.conn.download_file('bucket', 'key', path, mode='wb', decompress=True)
+        with open(path, 'rb') as fin:
+            self.assertEqual(fin.read(), self.data)
+        # Decompressed data is always bytes
+        self.conn.download_file('bucket', 'key', path, decompress=True)
+        with open(path, 'rb') as fin:
+            self.assertEqual(fin.read(), self.data)
+
+    def test_small_reads(self):
+        '''Reading in small pieces gets the same stream'''
+        reader = CompressingReader(BytesIO(self.data), 'gzip')
+        chunks = list(iter(lambda: reader.read(1000), b''))
+        self.assertEqual(gzip.GzipFile(fileobj=BytesIO(b''.join(chunks))).read(), self.data)
+        self.assertEqual(reader.raw, len(self.data))
+        self.assertEqual(reader.compressed, sum(len(chunk) for chunk in chunks))
+
+    def test_writer_position(self):
+        '''The writer counts compressed bytes, and can start over'''
+        compressed = compression.compress_block('gzip', self.data)
+        result = BytesIO()
+        writer = DecompressingWriter(result, 'gzip')
+        writer.write(compressed[:100])
+        self.assertEqual(writer.tell(), 100)
+        writer.seek(0)
+        writer.write(compressed)
+        self.assertEqual(writer.tell(), len(compressed))
+        self.assertEqual(result.getvalue(), self.data)
+        self.assertRaises(IOError, writer.seek, 10)
+
+    def test_unsupported(self):
+        '''Unknown encodings are rejected'''
+        self.assertRaises(
+            ValueError, self.conn.upload, 'bucket', 'key', 'content', encoding='lz4')
@@ -1,11 +1,41 @@
 '''Test our Connection'''
 
+import json
+import subprocess
+import sys
+import unittest
+
 from test.base import BaseTest
-from six import StringIO
+from six import BytesIO, StringIO
+
+import gevent
+import mock
 
+from s3po import trace
+from s3po.backends.memory import Memory
+from s3po.connection import Connection
 from s3po.exceptions import DownloadException, DeleteException
 
 
+class ConcurrentMemory(Memory):
+    '''An in-memory backend that records how many downloads overlap'''
+    def __init__(self):
+        Memory.__init__(self)
+        self.active = 0
+        self.peak = 0
+        self.started = []
+
+    def download(self, bucket, key, fobj, retries, headers=None):
+        self.started.append(key)
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        try:
+            gevent.sleep(0.001)
+            return Memory.download(self, bucket, key, fobj, retries, headers)
+        finally:
+            self.active -= 1
+
+
 class ConnectionTest(BaseTest):
     '''Test our connection's functionality'''
 
@@ -86,3 +116,197 @@ class ConnectionTest(BaseTest):
         '''Delete raises when key not found.'''
         with self.assertRaises(DeleteException):
             self.conn.delete('bucket', 'key')
+
+    def test_prefetch(self):
+        '''Prefetching yields data in order, downloading ahead'''
+        backend = ConcurrentMemory()
+        conn = Connection(backend)
+        keys = ['key.%i' % i for i in range(20)]
+        for key in keys:
+            conn.upload('bucket', key, key)
+        results = list(conn.prefetch('bucket', keys, depth=4))
+        self.assertEqual(results, [(key, key) for key in keys])
+        self.assertEqual(backend.peak, 4)
+
+    def test_prefetch_max_bytes(self):
+        '''Prefetching stops reading ahead once the byte budget is held,
+        counting downloads that are still in flight'''
+        backend = ConcurrentMemory()
+        conn = Connection(backend)
+        keys = ['key.%i' % i for i in range(10)]
+        for key in keys:
+            conn.upload('bucket', key, 'x' * 10)
+
+        results = conn.prefetch('bucket', keys, depth=10, max_bytes=25)
+        self.assertEqual(next(results), ('key.0', 'x' * 10))
+        gevent.sleep(0.01)
+        # The next would go over the budget, however long we wait
+        self.assertEqual(backend.started, keys[:2])
+        self.assertEqual(len(list(results)), 9)
+        self.assertEqual(backend.started, keys)
+        self.assertEqual(backend.peak, 2)
+
+        # Objects bigger than the budget are still downloaded, one at a time
+        backend.peak = 0
+        self.assertEqual(
+            len(list(conn.prefetch('bucket', keys, depth=10, max_bytes=5))), 10)
+        self.assertEqual(backend.peak, 1)
+
+    def test_prefetch_metadata(self):
+        '''Prefetching metadata uses its sizes rather than heading each key'''
+        self.conn.upload('bucket', 'key', 'content')
+        listing = list(self.conn.list_metadata('bucket'))
+        with mock.patch.object(self.conn.backend, 'head') as head:
+            results = list(self.conn.prefetch('bucket', listing, max_bytes=10))
+        self.assertEqual(results, [('key', 'content')])
+        self.assertFalse(head.called)
+
+    def test_prefetch_heads(self):
+        '''Keys are headed for their sizes along with their downloads, rather
+        than by the consumer'''
+        keys = ['key.%i' % i for i in range(5)]
+        for key in keys:
+            self.conn.upload('bucket', key, 'x' * 10)
+        head = self.conn.backend.head
+        callers = []
+
+        def heading(*args, **kwargs):
+            '''Note who's heading'''
+            callers.append(trace.thread_id())
+            return head(*args, **kwargs)
+
+        with mock.patch.object(self.conn.backend, 'head', side_effect=heading):
+            results = list(self.conn.prefetch('bucket', keys, max_bytes=25))
+        self.assertEqual(results, [(key, 'x' * 10) for key in keys])
+        self.assertEqual(len(callers), 5)
+        self.assertNotIn(trace.thread_id(), callers)
+
+    def test_prefetch_close(self):
+        '''Abandoning a prefetch stops reading ahead'''
+        backend = ConcurrentMemory()
+        conn = Connection(backend)
+        keys = ['key.%i' % i for i in range(10)]
+        for key in keys:
+            conn.upload('bucket', key, key)
+        results = conn.prefetch('bucket', keys, depth=2)
+        next(results)
+        results.close()
+        gevent.sleep(0.01)
+        self.assertEqual(backend.started, keys[:2])
+
+    def test_prefetch_missing(self):
+        '''Prefetching a missing key raises when it is reached'''
+        self.conn.upload('bucket', 'key', 'content')
+        results = self.conn.prefetch('bucket', ['key', 'missing'])
+        self.assertEqual(next(results), ('key', 'content'))
+        self.assertRaises(DownloadException, next, results)
+
+
+class RangeTest(BaseTest):
+    '''We can read several ranges of an object at once'''
+
+    def setUp(self):
+        BaseTest.setUp(self)
+        self.data = bytes(bytearray(range(256))) * 4
+        self.conn.upload('bucket', 'key', BytesIO(self.data))
+
+    def read_ranges(self, ranges, **kwargs):
+        '''Read ranges, returning the results and the reads made'''
+        backend = self.conn.backend
+        with mock.patch.object(backend, 'read_range', wraps=backend.read_range) as read:
+            results = self.conn.read_ranges('bucket', 'key', ranges, **kwargs)
+        return results, sorted(call[0][2:4] for call in read.call_args_list)
+
+    def test_merged(self):
+        '''Nearby ranges are merged, and returned in the original order'''
+        ranges = [(500, 10), (0, 4), (8, 4), (1000, 24)]
+        results, reads = self.read_ranges(ranges, gap=4)
+        self.assertEqual(reads, [(0, 12), (500, 10), (1000, 24)])
+        for (offset, length), result in zip(ranges, results):
+            self.assertIsInstance(result, memoryview)
+            self.assertEqual(result.tobytes(), self.data[offset:offset + length])
+
+    def test_gap(self):
+        '''A larger gap merges more ranges'''
+        _, reads = self.read_ranges([(0, 4), (500, 10)], gap=1024)
+        self.assertEqual(reads, [(0, 510)])
+
+    def test_overlapping(self):
+        '''Overlapping, repeated and empty ranges are fine'''
+        ranges = [(0, 100), (50, 10), (0, 100), (200, 0)]
+        results, reads = self.read_ranges(ranges, gap=0)
+        self.assertEqual(reads, [(0, 100)])
+        self.assertEqual(
+            [result.tobytes() for result in results],
+            [self.data[:100], self.data[50:60], self.data[:100], b''])
+
+    def test_past_end(self):
+        '''Ranges past the end of the object are cut short, but ones that
+        start beyond it can't be read'''
+        results, _ = self.read_ranges([(1020, 10)])
+        self.assertEqual(results[0].tobytes(), self.data[1020:])
+        self.assertRaises(DownloadException, self.read_ranges, [(1024, 10)])
+
+    def test_lists(self):
+        '''Ranges can be lists, as they come from JSON'''
+        results, _ = self.read_ranges([[0, 2], [4, 2]])
+        self.assertEqual(
+            [result.tobytes() for result in results], [self.data[0:2], self.data[4:6]])
+
+    def test_concurrent(self):
+        '''Merged ranges are fetched concurrently'''
+        backend = self.conn.backend
+        active = []
+        peak = []
+
+        def read_range(*args):
+            '''Track how many reads are in flight'''
+            active.append(1)
+            peak.append(len(active))
+            gevent.sleep(0.001)
+            active.pop()
+            return Memory.read_range(backend, *args)
+
+        with mock.patch.object(backend, 'read_range', side_effect=read_range):
+            self.conn.read_ranges(
+                'bucket', 'key', [(0, 1), (100, 1), (200, 1)], gap=0, concurrency=2)
+        self.assertEqual(max(peak), 2)
+
+
+class ImportTest(unittest.TestCase):
+    '''Importing s3po stays cheap'''
+
+    def modules(self, code):
+        '''The top-level packages loaded after running code in a fresh interpreter'''
+        script = code + '''
+import json, sys
+print(json.dumps(sorted(set(name.split('.')[0] for name in sys.modules))))
+'''
+        output = subprocess.check_output([sys.executable, '-c', script])
+        return set(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+
+    def test_lazy_backends(self):
+        '''Backend dependencies aren't loaded until they're used'''
+        modules = self.modules('import s3po; s3po.Connection.memory()')
+        for name in ('boto3', 'botocore', 'swiftclient', 'gevent'):
+            self.assertNotIn(name, modules)
+
+    def test_no_monkey_patching(self):
+        '''Parallel helpers use threads, rather than patching gevent in'''
+        modules = self.modules('''
+import threading, s3po
+conn = s3po.Connection.memory()
+conn.upload('bucket', 'a', 'a')
+conn.upload('bucket', 'b', 'bb')
+assert [key for key, _ in conn.prefetch('bucket', ['a', 'b'], max_bytes=1)] == ['a', 'b']
+assert len(conn.read_ranges('bucket', 'b', [(0, 1), (1, 1)], gap=0)) == 2
+s3po.Connection.replicated([s3po.Connection.memory()]).upload('bucket', 'c', 'c')
+''')
+        self.assertNotIn('gevent', modules)
+
+    def test_loaded_on_use(self):
+        '''Creating an S3 connection loads boto3'''
+        modules = self.modules(
+            'import s3po; s3po.Connection.s3(region_name="us-east-1")')
+        self.assertIn('boto3', modules)
+        self.assertNotIn('swiftclient', modules)
@@ -0,0 +1,95 @@
+'''Test packing small objects'''
+
+import mock
+
+from test.base import BaseTest
+
+from s3po.exceptions import DownloadException
+from s3po.pack import PackReader
+
+
+class PackTest(BaseTest):
+    '''We can pack many small values into one object'''
+
+    def setUp(self):
+        BaseTest.setUp(self)
+        self.values = dict(('key-%03i' % i, b'value-%i' % i) for i in range(100))
+        with self.conn.pack_writer('bucket', 'pack') as writer:
+            for key in sorted(self.values):
+                writer.add(key, self.values[key])
+
+    def reads(self):
+        '''Count the backend's ranged reads'''
+        return mock.patch.object(
+            self.conn.backend, 'read_range', wraps=self.conn.backend.read_range)
+
+    def test_round_trip(self):
+        '''Can read back each value'''
+        reader = self.conn.pack_reader('bucket', 'pack')
+        self.assertEqual(len(reader), 100)
+        self.assertEqual(reader.keys(), sorted(self.values))
+        for key, value in self.values.items():
+            self.assertEqual(reader.get(key), value)
+
+    def test_index_once(self):
+        '''The index is fetched once, in a single read'''
+        reader = self.conn.pack_reader('bucket', 'pack')
+        with self.reads() as read_range:
+            reader.get('key-001')
+            reader.get('key-002')
+        self.assertEqual(read_range.call_count, 3)
+
+    def test_small_guess(self):
+        '''Indexes bigger than our guess take a second read'''
+        reader = self.conn.pack_reader('bucket', 'pack', index_guess=20)
+        with self.reads() as read_range:
+            self.assertIn('key-050', reader)
+        self.assertEqual(read_range.call_count, 2)
+
+    def test_coalesced(self):
+        '''Nearby values are fetched together'''
+        reader = self.conn.pack_reader('bucket', 'pack', gap=0)
+        reader.index
+        with self.reads() as read_range:
+            result = reader.get_many(['key-001', 'key-002', 'key-003', 'key-050'])
+        self.assertEqual(read_range.call_count, 2)
+        self.assertEqual(result['key-050'], b'value-50')
+        self.assertEqual(result['key-002'], b'value-2')
+
+    def test_empty_values(self):
+        '''Empty values don't need any reads'''
+        with self.conn.pack_writer('bucket', 'empty') as writer:
+            writer.add('empty', b'')
+            writer.add('text', u'text')
+        reader = self.conn.pack_reader('bucket', 'empty')
+        self.assertEqual(reader.get_many(['empty', 'text']), {
+            'empty': b'', 'text': b'text'})
+        self.assertEqual(reader.get('empty'), b'')
+
+    def test_missing(self):
+        '''Asking for a missing key raises'''
+        reader = self.conn.pack_reader('bucket', 'pack')
+        self.assertNotIn('missing', reader)
+        self.assertRaises(DownloadException, reader.get, 'missing')
+
+    def test_not_a_pack(self):
+        '''Objects that aren't packs are rejected'''
+        self.conn.upload('bucket', 'key', 'content')
+        self.assertRaises(
+            DownloadException, lambda: PackReader(self.conn, 'bucket', 'key').index)
+
+    def test_duplicate(self):
+        '''Keys can only be added once'''
+        writer = self.conn.pack_writer('bucket', 'other')
+        writer.add('key', b'value')
+        self.assertRaises(ValueError, writer.add, 'key', b'value')
+
+    def test_failed_writer(self):
+        '''Nothing is uploaded if the writer's block fails'''
+        try:
+            with self.conn.pack_writer('bucket', 'failed') as writer:
+                writer.add('key', b'value')
+                raise ValueError('failed')
+        except ValueError:
+            pass
+        self.assertNotIn('failed', self.conn.backend.buckets['bucket'])
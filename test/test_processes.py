@@ -0,0 +1,140 @@
+'''Test batching across processes'''
+
+import functools
+import os
+import subprocess
+import sys
+
+import mock
+from six import BytesIO
+
+from test.base import BaseTest
+
+from s3po import Connection
+from s3po.exceptions import DownloadException
+from s3po.processes import ProcessBatch, WorkerException
+from s3po.stub import Server
+
+
+def populated():
+    '''A connection with a few objects in it'''
+    conn = Connection.memory()
+    for i in range(10):
+        conn.upload('bucket', 'key-%i' % i, 'value-%i' % i)
+    return conn
+
+
+def upper(value):
+    '''A callback that runs in the worker'''
+    return (os.getpid(), value.upper())
+
+
+def tobytes(views):
+    '''Memoryviews can't be pickled, but bytes can'''
+    return b''.join(view.tobytes() for view in views)
+
+
+def crash(value):
+    '''A callback that takes its worker down'''
+    os._exit(3)
+
+
+class Picky(Exception):
+    '''An exception that can be pickled, but not unpickled'''
+    def __init__(self, message, detail):
+        Exception.__init__(self, message)
+        self.detail = detail
+
+
+def picky(value):
+    '''A callback that raises what can't be sent back'''
+    raise Picky(value, 'detail')
+
+
+class ProcessBatchTest(BaseTest):
+    '''We can batch across processes'''
+
+    def test_results(self):
+        '''Callbacks run in the workers, and results come back in order'''
+        with ProcessBatch(populated, processes=2, poolsize=5) as batch:
+            for i in range(10):
+                batch.download('bucket', 'key-%i' % i, callback=upper)
+        self.assertTrue(batch.success())
+        results = batch.results()
+        self.assertEqual(
+            [value for _, value in results], ['VALUE-%i' % i for i in range(10)])
+        pids = set(pid for pid, _ in results)
+        self.assertEqual(len(pids), 2)
+        self.assertNotIn(os.getpid(), pids)
+
+    def test_errors(self):
+        '''Failed calls fail their results'''
+        with ProcessBatch(populated, processes=1) as batch:
+            found = batch.download('bucket', 'key-0')
+            missing = batch.download('bucket', 'missing')
+            # Things that can't be pickled can't be sent
+            self.assertRaises(Exception, batch.download, 'bucket', 'key-1',
+                callback=lambda value: value)
+        self.assertEqual(found.get(), 'value-0')
+        self.assertRaises(DownloadException, missing.get)
+        self.assertFalse(batch.success())
+        self.assertEqual(batch.results(), ['value-0', None])
+
+    def test_crash(self):
+        '''Calls on a worker that exits fail'''
+        with ProcessBatch(populated, processes=1) as batch:
+            result = batch.download('bucket', 'key-0', callback=crash)
+        self.assertRaises(WorkerException, result.get)
+
+    def test_unpicklable(self):
+        '''Outcomes that can't be unpickled fail just their own call'''
+        with ProcessBatch(populated, processes=1) as batch:
+            bad = batch.download('bucket', 'key-0', callback=picky)
+            good = batch.download('bucket', 'key-1')
+        self.assertRaises(WorkerException, bad.get)
+        self.assertEqual(good.get(), 'value-1')
+
+    def test_exited(self):
+        '''Calls to workers that have exited fail rather than hang'''
+        with ProcessBatch(populated, processes=1) as batch:
+            self.assertRaises(
+                WorkerException, batch.download('bucket', 'key-0', callback=crash).get)
+            worker = batch.workers[0]
+            worker.process.wait()
+            self.assertRaises(WorkerException, batch.download('bucket', 'key-1').get)
+            # Even if it exits between our checking and sending
+            with mock.patch.object(worker, 'alive', return_value=True):
+                result = batch.download('bucket', 'key-2')
+            self.assertRaises(WorkerException, result.get)
+            self.assertEqual(worker.pending, {})
+
+    def test_main(self):
+        '''Callbacks can be defined in the main script'''
+        path = self.tmpfile('script.py')
+        with open(path, 'w') as fout:
+            fout.write('\n'.join([
+                'from s3po.processes import ProcessBatch',
+                'from test.test_processes import populated',
+                'def shout(value):',
+                '    return value.upper()',
+                'if __name__ == "__main__":',
+                '    with ProcessBatch(populated, processes=1) as batch:',
+                '        batch.download("bucket", "key-0", callback=shout)',
+                '    print(batch.results())',
+            ]))
+        output = subprocess.check_output(
+            [sys.executable, path], env=dict(os.environ, PYTHONPATH=os.getcwd()))
+        self.assertEqual(output.strip(), b"['VALUE-0']")
+
+    def test_shared(self):
+        '''Workers each connect to the same store'''
+        with Server() as server:
+            conn = Connection.s3(**server.s3_kwargs())
+            for i in range(4):
+                conn.upload('bucket', 'key-%i' % i, BytesIO(b'value-%i' % i))
+            factory = functools.partial(Connection.s3, **server.s3_kwargs())
+            with ProcessBatch(factory, processes=2) as batch:
+                for i in range(4):
+                    batch.read_ranges(
+                        'bucket', 'key-%i' % i, [(0, 5)], callback=tobytes)
+            self.assertEqual(batch.results(), [b'value'] * 4)
@@ -0,0 +1,184 @@
+'''Test resumable transfers'''
+
+import os
+import time
+
+import mock
+from six import BytesIO
+
+from test.base import BaseTest
+
+from s3po.backends.memory import Memory
+from s3po.exceptions import DownloadException, UploadException
+from s3po.resumable import Checkpoint
+
+
+class Crash(Exception):
+    '''Simulates a worker dying partway through a transfer'''
+    pass
+
+
+class ResumableTest(BaseTest):
+    '''We can resume interrupted uploads and downloads'''
+
+    def setUp(self):
+        BaseTest.setUp(self)
+        self.conn.backend.multipart_chunk_size = 4
+        self.path = self.tmpfile('data')
+        self.checkpoint = self.tmpfile('checkpoint')
+
+    def write(self, content):
+        '''Write content to our file'''
+        with open(self.path, 'wb') as fout:
+            fout.write(content)
+
+    def read(self):
+        '''Read the content of our file'''
+        with open(self.path, 'rb') as fin:
+            return fin.read()
+
+    def stored(self):
+        '''The content of bucket/key'''
+        fobj = BytesIO()
+        self.conn.download('bucket', 'key', fobj)
+        return fobj.getvalue()
+
+    def crash_after(self, method, count):
+        '''Make the backend's method fail after count calls'''
+        original = getattr(Memory, method)
+        calls = []
+
+        def func(*args, **kwargs):
+            '''Count the call, and maybe crash'''
+            calls.append(args)
+            if len(calls) > count:
+                raise Crash('crash')
+            return original(self.conn.backend, *args, **kwargs)
+        return mock.patch.object(self.conn.backend, method, side_effect=func), calls
+
+    def test_upload(self):
+        '''Uploads in parts, and cleans up its checkpoint'''
+        self.write(b'0123456789')
+        self.conn.upload_file('bucket', 'key', self.path, checkpoint=self.checkpoint)
+        self.assertEqual(self.stored(), b'0123456789')
+        self.assertFalse(os.path.exists(self.checkpoint))
+        self.assertEqual(self.conn.backend.multipart_list('bucket', 'key'), [])
+
+    def test_upload_headers(self):
+        '''The object gets the headers of the upload'''
+        self.write(b'0123456789')
+        self.conn.upload_file('bucket', 'key', self.path, checkpoint=self.checkpoint,
+            headers={'Content-Type': 'text/plain'})
+        self.assertEqual(
+            self.conn.backend.head('bucket', 'key')['headers'],
+            {'content-type': 'text/plain'})
+
+    def test_unsupported(self):
+        '''Resumable transfers can't be compressed, or of text'''
+        self.write(b'0123456789')
+        self.assertRaises(
+            ValueError, self.conn.upload_file, 'bucket', 'key', self.path,
+            checkpoint=self.checkpoint, encoding='gzip')
+        self.assertRaises(
+            ValueError, self.conn.download_file, 'bucket', 'key', self.path,
+            checkpoint=self.checkpoint, decompress=True)
+        self.assertRaises(
+            ValueError, self.conn.download_file, 'bucket', 'key', self.path,
+            checkpoint=self.checkpoint, mode='a')
+
+    def test_resume_upload(self):
+        '''Resuming an upload only uploads the remaining parts'''
+        self.write(b'0123456789')
+        patcher, calls = self.crash_after('multipart_part', 2)
+        with patcher:
+            self.assertRaises(
+                Crash, self.conn.upload_file, 'bucket', 'key', self.path,
+                checkpoint=self.checkpoint)
+        self.assertEqual(len(Checkpoint(self.checkpoint).state['parts']), 2)
+
+        patcher, calls = self.crash_after('multipart_part', 10)
+        with patcher:
+            self.conn.upload_file(
+                'bucket', 'key', self.path, checkpoint=self.checkpoint)
+        self.assertEqual([call[3] for call in calls], [3])
+        self.assertEqual(self.stored(), b'0123456789')
+
+    def test_changed_upload(self):
+        '''A checkpoint for a file that has since changed is discarded'''
+        self.write(b'0123456789')
+        patcher, _ = self.crash_after('multipart_part', 1)
+        with patcher:
+            self.assertRaises(
+                Crash, self.conn.upload_file, 'bucket', 'key', self.path,
+                checkpoint=self.checkpoint)
+        self.write(b'abcdefghijkl')
+        os.utime(self.path, (time.time() + 10, time.time() + 10))
+        self.conn.upload_file('bucket', 'key', self.path, checkpoint=self.checkpoint)
+        self.assertEqual(self.stored(), b'abcdefghijkl')
+        self.assertEqual(self.conn.backend.multipart_list('bucket', 'key'), [])
+
+    def test_stale_uploads(self):
+        '''Old abandoned uploads to the same key are aborted'''
+        backend = self.conn.backend
+        stale = backend.multipart_start('bucket', 'key')
+        backend.uploads[('bucket', 'key')][stale]['initiated'] -= 2 * 24 * 60 * 60
+        recent = backend.multipart_start('bucket', 'key')
+        self.write(b'0123456789')
+        self.conn.upload_file('bucket', 'key', self.path, checkpoint=self.checkpoint)
+        self.assertEqual(
+            [upload_id for upload_id, _ in backend.multipart_list('bucket', 'key')],
+            [recent])
+
+    def test_missing_part(self):
+        '''Completing an upload with a missing part fails'''
+        backend = self.conn.backend
+        upload_id = backend.multipart_start('bucket', 'key')
+        self.assertRaises(
+            UploadException, backend.multipart_complete,
+            'bucket', 'key', upload_id, [(1, 'etag')])
+
+    def test_download(self):
+        '''Downloads in ranges, and cleans up its checkpoint'''
+        self.conn.upload('bucket', 'key', BytesIO(b'0123456789'))
+        self.conn.download_file(
+            'bucket', 'key', self.path, checkpoint=self.checkpoint)
+        self.assertEqual(self.read(), b'0123456789')
+        self.assertFalse(os.path.exists(self.checkpoint))
+
+    def test_resume_download(self):
+        '''Resuming a download only fetches the remaining ranges'''
+        self.conn.upload('bucket', 'key', BytesIO(b'0123456789'))
+        patcher, _ = self.crash_after('read_range', 1)
+        with patcher:
+            self.assertRaises(
+                Crash, self.conn.download_file, 'bucket', 'key', self.path,
+                checkpoint=self.checkpoint)
+        self.assertEqual(Checkpoint(self.checkpoint).state['offset'], 4)
+
+        patcher, calls = self.crash_after('read_range', 10)
+        with patcher:
+            self.conn.download_file(
+                'bucket', 'key', self.path, checkpoint=self.checkpoint)
+        self.assertEqual([call[2] for call in calls], [4, 8])
+        self.assertEqual(self.read(), b'0123456789')
+
+    def test_changed_download(self):
+        '''A checkpoint for an object that has since changed is discarded'''
+        self.conn.upload('bucket', 'key', BytesIO(b'0123456789'))
+        patcher, _ = self.crash_after('read_range', 1)
+        with patcher:
+            self.assertRaises(
+                Crash, self.conn.download_file, 'bucket', 'key', self.path,
+                checkpoint=self.checkpoint)
+        self.conn.upload('bucket', 'key', BytesIO(b'abcdefghij'))
+        self.conn.download_file(
+            'bucket', 'key', self.path, checkpoint=self.checkpoint)
+        self.assertEqual(self.read(), b'abcdefghij')
+
+    def test_truncated_download(self):
+        '''Raises if the object comes up short'''
+        self.conn.upload('bucket', 'key', BytesIO(b'0123456789'))
+        with mock.patch.object(self.conn.backend, 'read_range', return_value=b''):
+            self.assertRaises(
+                DownloadException, self.conn.download_file, 'bucket', 'key',
+                self.path, checkpoint=self.checkpoint)
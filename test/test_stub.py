@@ -0,0 +1,234 @@
+'''Test our stand-in S3 and Swift server'''
+
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from botocore.config import Config
+from six import BytesIO
+
+from s3po import Connection
+from s3po.exceptions import DownloadException, UploadException
+from s3po.stub import Server, decode_chunked, listing, parse_range
+from s3po.sync import Diff
+
+
+class HelperTest(unittest.TestCase):
+    '''The pieces of the server work on their own'''
+
+    def test_listing(self):
+        '''Rolls keys up by delimiter, and pages'''
+        keys = ['a/1', 'a/2', 'b', 'c/1', 'd']
+        self.assertEqual(listing(keys, '', '/', 10), ([
+            ('prefix', 'a/'), ('key', 'b'), ('prefix', 'c/'), ('key', 'd')], False))
+        self.assertEqual(listing(keys, '', '/', 2), ([
+            ('prefix', 'a/'), ('key', 'b')], True))
+        # Prefixes up to the marker were already returned
+        self.assertEqual(listing(keys[1:], '', '/', 10, 'a/')[0], [
+            ('key', 'b'), ('prefix', 'c/'), ('key', 'd')])
+
+    def test_parse_range(self):
+        '''Understands the ranges clients send'''
+        self.assertEqual(parse_range('bytes=2-5', 10), (2, 5))
+        self.assertEqual(parse_range('bytes=2-', 10), (2, 9))
+        self.assertEqual(parse_range('bytes=-3', 10), (7, 9))
+        self.assertEqual(parse_range('bytes=-30', 10), (0, 9))
+        self.assertEqual(parse_range('bytes=8-20', 10), (8, 9))
+
+    def test_decode_chunked(self):
+        '''Decodes aws-chunked bodies, with signatures and trailers'''
+        body = (
+            b'5;chunk-signature=abc\r\nhello\r\n'
+            b'6;chunk-signature=def\r\n world\r\n'
+            b'0;chunk-signature=ghi\r\nx-amz-checksum-crc32:AAAAAA==\r\n\r\n')
+        self.assertEqual(decode_chunked(body), b'hello world')
+
+
+class StubTest(unittest.TestCase):
+    '''Our backends work against the server'''
+    faults = {}
+
+    def setUp(self):
+        self.server = Server(**self.faults).start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def s3(self, **kwargs):
+        '''An S3 connection to the server, without boto's own retries'''
+        return Connection.s3(**self.server.s3_kwargs(config=Config(
+            s3={'addressing_style': 'path'}, retries={'total_max_attempts': 1}), **kwargs))
+
+    def swift(self):
+        '''A Swift connection to the server'''
+        return Connection.swift(**self.server.swift_kwargs())
+
+    def download(self, conn, key, retries=3):
+        '''Download key as bytes'''
+        result = BytesIO()
+        conn.download('bucket', key, result, retries=retries)
+        return result.getvalue()
+
+
+class ApiTest(StubTest):
+    '''The server speaks enough S3 and Swift'''
+
+    def check(self, conn):
+        '''Run through what the backends do'''
+        backend = conn.backend
+        conn.upload('bucket', 'a/1', BytesIO(b'0123456789'),
+            headers={'Content-Type': 'text/plain'})
+        conn.upload('bucket', 'a/2', BytesIO(b'two'))
+        conn.upload('bucket', 'b', BytesIO(b'b'))
+        self.assertEqual(self.download(conn, 'a/1'), b'0123456789')
+        self.assertEqual(sorted(conn.list('bucket')), ['a/1', 'a/2', 'b'])
+        self.assertEqual(sorted(conn.list('bucket', 'a/')), ['a/1', 'a/2'])
+        self.assertEqual(
+            [meta['size'] for meta in conn.list_metadata('bucket')], [10, 3, 1])
+
+        meta = backend.head('bucket', 'a/1')
+        self.assertEqual(meta['etag'], hashlib.md5(b'0123456789').hexdigest())
+        self.assertEqual(meta['headers']['content-type'], 'text/plain')
+        self.assertEqual(backend.read_range('bucket', 'a/1', 2, 3), b'234')
+        self.assertEqual(backend.read_range('bucket', 'a/1', None, 3), b'789')
+
+        upload_id = backend.multipart_start('bucket', 'big')
+        parts = [
+            (number, backend.multipart_part(
+                'bucket', 'big', upload_id, number, data,
+                md5=hashlib.md5(data).hexdigest()))
+            for number, data in ((1, b'x' * 10), (2, b'y' * 5))]
+        self.assertEqual([upload[0] for upload in backend.multipart_list(
+            'bucket', 'big')], [upload_id])
+        backend.multipart_complete('bucket', 'big', upload_id, parts)
+        self.assertIsNone(backend.part_size('bucket', 'a/1'))
+        self.assertEqual(self.download(conn, 'big'), b'x' * 10 + b'y' * 5)
+        self.assertEqual(backend.multipart_list('bucket', 'big'), [])
+        # Listings have the real size and etag, so that syncs can compare them
+        meta = dict((meta['key'], meta) for meta in conn.list_metadata('bucket'))
+        self.assertEqual(meta['big']['size'], 15)
+        self.assertEqual(
+            meta['big']['etag'], backend.head('bucket', 'big')['etag'].strip('"'))
+
+        conn.delete('bucket', 'b')
+        self.assertRaises(DownloadException, backend.head, 'bucket', 'b', 1)
+
+    def test_s3(self):
+        '''Works with our S3 backend'''
+        self.check(self.s3())
+
+    def test_swift(self):
+        '''Works with our Swift backend'''
+        conn = self.swift()
+        self.check(conn)
+        self.assertEqual(sorted(conn.list('bucket', delimiter='/')), ['a/', 'big'])
+        # The size of a static large object's parts is in its manifest
+        self.assertEqual(conn.backend.part_size('bucket', 'big'), 10)
+
+        # Segments of keys that another is a prefix of aren't its uploads
+        backend = conn.backend
+        upload_id = backend.multipart_start('bucket', 'big/part')
+        backend.multipart_part('bucket', 'big/part', upload_id, 1, b'data')
+        self.assertEqual(backend.multipart_list('bucket', 'big'), [])
+        self.assertEqual(
+            [upload[0] for upload in backend.multipart_list('bucket', 'big/part')],
+            [upload_id])
+
+    def test_resumable_headers(self):
+        '''Resumable uploads are stored with their headers'''
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'file')
+        with open(path, 'wb') as fout:
+            fout.write(b'content')
+        for conn in (self.s3(), self.swift()):
+            conn.upload_file('bucket', 'key', path,
+                checkpoint=os.path.join(directory, 'checkpoint'),
+                headers={'Content-Type': 'text/plain'})
+            self.assertEqual(self.download(conn, 'key'), b'content')
+            self.assertEqual(
+                conn.backend.head('bucket', 'key')['headers']['content-type'],
+                'text/plain')
+
+    def test_sync_manifest(self):
+        '''Syncs don't mistake a static large object's etag for its md5'''
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        src = os.path.join(directory, 'src')
+        os.mkdir(src)
+        with open(os.path.join(src, 'big'), 'wb') as fout:
+            fout.write(b'x' * 15)
+        conn = self.swift()
+        conn.backend.multipart_chunk_size = 10
+        conn.upload_file('bucket', 'prefix/big', os.path.join(src, 'big'),
+            checkpoint=os.path.join(directory, 'checkpoint'))
+        self.assertTrue(conn.backend.head('bucket', 'prefix/big')['headers'].get(
+            'x-static-large-object'))
+        self.assertEqual(
+            conn.sync_up(src, 'bucket', 'prefix/'), Diff([], [], ['big']))
+
+    def test_bad_digest(self):
+        '''Parts that don't match their md5 are rejected'''
+        backend = self.s3().backend
+        upload_id = backend.multipart_start('bucket', 'key')
+        self.assertRaises(
+            UploadException, backend.multipart_part,
+            'bucket', 'key', upload_id, 1, b'data', 1, '0' * 32)
+
+    def test_stats(self):
+        '''Counts requests by method'''
+        conn = self.s3()
+        conn.upload('bucket', 'key', BytesIO(b'content'))
+        self.download(conn, 'key')
+        self.assertEqual(self.server.stats['PUT'], 1)
+        self.assertGreaterEqual(self.server.stats['GET'], 1)
+
+
+class ErrorTest(StubTest):
+    '''Requests can be made to fail'''
+    faults = {'error_rate': 1}
+
+    def test_errors(self):
+        '''Every request fails with a 500'''
+        self.assertRaises(DownloadException, self.s3().backend.head, 'bucket', 'key', 1)
+        self.assertRaises(DownloadException, self.swift().backend.head, 'bucket', 'key', 1)
+        self.assertEqual(self.server.stats['error'], 2)
+
+
+class SlowDownTest(StubTest):
+    '''Requests can be throttled'''
+    faults = {'slowdown_rate': 1}
+
+    def test_slowdown(self):
+        '''Every request gets a SlowDown'''
+        self.assertRaises(
+            UploadException, self.s3().backend.multipart_start, 'bucket', 'key', 1)
+        self.assertEqual(self.server.stats['slowdown'], 1)
+
+
+class TruncateTest(StubTest):
+    '''Responses can be cut short'''
+    faults = {'truncate_rate': 1}
+
+    def test_truncated(self):
+        '''Every download comes up short'''
+        for conn in (self.s3(), self.swift()):
+            conn.upload('bucket', 'key', BytesIO(b'0123456789'))
+            self.assertRaises(Exception, self.download, conn, 'key', 1)
+        self.assertEqual(self.server.stats['truncated'], 2)
+
+
+class SlowTest(StubTest):
+    '''Responses can be slow'''
+    faults = {'latency': 0.05, 'bandwidth': 1024 * 1024}
+
+    def test_slow(self):
+        '''Takes at least the latency, and the time to move the bytes'''
+        conn = self.s3()
+        start = time.time()
+        conn.upload('bucket', 'key', BytesIO(b'x' * 100 * 1024))
+        # Latency on the one request, and the upload at the bandwidth
+        self.assertGreater(time.time() - start, 0.05 + 0.09)
@@ -0,0 +1,195 @@
+'''Test syncing directories with buckets'''
+
+import hashlib
+import os
+
+import mock
+from six import BytesIO
+
+from test.base import BaseTest
+
+from s3po.exceptions import DownloadException
+from s3po.sync import Diff, Manifest, fetch
+
+
+class SyncTest(BaseTest):
+    '''We can sync directory trees up and down'''
+
+    def write(self, relpath, content):
+        '''Write content to a file in our source directory'''
+        with open(self.tmpfile('src', *relpath.split('/')), 'wb') as fout:
+            fout.write(content)
+
+    def read(self, relpath):
+        '''Read the content of a file in our destination directory'''
+        with open(os.path.join(self.tmpdir, 'dest', *relpath.split('/')), 'rb') as fin:
+            return fin.read()
+
+    def test_sync_up(self):
+        '''Uploads only new and changed files'''
+        self.write('a', b'a')
+        self.write('dir/b', b'b')
+        self.write('dir/c', b'c')
+        src = os.path.join(self.tmpdir, 'src')
+        self.assertEqual(
+            self.conn.sync_up(src, 'bucket', 'prefix/'),
+            Diff(['a', 'dir/b', 'dir/c'], [], []))
+        self.assertEqual(self.conn.download_file(
+            'bucket', 'prefix/dir/b', self.tmpfile('b'), mode='wb'), None)
+        with open(self.tmpfile('b'), 'rb') as fin:
+            self.assertEqual(fin.read(), b'b')
+
+        self.write('a', b'A')
+        self.write('dir/d', b'd')
+        diff = self.conn.sync_up(src, 'bucket', 'prefix/')
+        self.assertEqual(diff.added, ['dir/d'])
+        self.assertEqual(diff.changed, ['a'])
+        self.assertEqual(sorted(diff.unchanged), ['dir/b', 'dir/c'])
+
+    def test_bare_prefix(self):
+        '''Prefixes without a trailing slash are directories too'''
+        self.write('a.txt', b'a')
+        src = os.path.join(self.tmpdir, 'src')
+        self.conn.sync_up(src, 'bucket', 'data')
+        self.assertEqual(list(self.conn.list('bucket')), ['data/a.txt'])
+        self.assertEqual(
+            self.conn.sync_up(src, 'bucket', 'data'), Diff([], [], ['a.txt']))
+
+        # Keys that merely start with the prefix aren't beneath it
+        self.conn.upload('bucket', 'database', BytesIO(b'other'))
+        dest = os.path.join(self.tmpdir, 'dest')
+        self.assertEqual(
+            self.conn.sync_down('bucket', 'data', dest), Diff(['a.txt'], [], []))
+        self.assertEqual(self.read('a.txt'), b'a')
+        self.assertEqual(os.listdir(dest), ['a.txt'])
+
+    def test_sync_up_dry_run(self):
+        '''A dry run reports the differences, but doesn't upload'''
+        self.write('a', b'a')
+        src = os.path.join(self.tmpdir, 'src')
+        self.assertEqual(
+            self.conn.sync_up(src, 'bucket', dry_run=True), Diff(['a'], [], []))
+        self.assertEqual(list(self.conn.list('bucket')), [])
+
+    def test_sync_down(self):
+        '''Downloads only new and changed keys'''
+        self.conn.upload('bucket', 'prefix/a', BytesIO(b'a'))
+        self.conn.upload('bucket', 'prefix/dir/b', BytesIO(b'b'))
+        dest = os.path.join(self.tmpdir, 'dest')
+        self.assertEqual(
+            self.conn.sync_down('bucket', 'prefix/', dest),
+            Diff(['a', 'dir/b'], [], []))
+        self.assertEqual(self.read('dir/b'), b'b')
+
+        self.conn.upload('bucket', 'prefix/a', BytesIO(b'A'))
+        diff = self.conn.sync_down('bucket', 'prefix/', dest, dry_run=True)
+        self.assertEqual(diff, Diff([], ['a'], ['dir/b']))
+        self.assertEqual(self.read('a'), b'a')
+        self.conn.sync_down('bucket', 'prefix/', dest)
+        self.assertEqual(self.read('a'), b'A')
+
+    def test_manifest(self):
+        '''A persisted manifest saves rehashing unchanged files'''
+        self.write('a', b'a')
+        src = os.path.join(self.tmpdir, 'src')
+        path = self.tmpfile('manifest.json')
+        self.conn.sync_up(src, 'bucket', manifest=path)
+        # The first comparison has to hash the file, but not later ones
+        with mock.patch('s3po.sync.hashlib') as hashes:
+            hashes.md5.side_effect = hashlib.md5
+            self.conn.sync_up(src, 'bucket', manifest=path)
+            self.assertEqual(hashes.md5.call_count, 1)
+            self.assertEqual(
+                self.conn.sync_up(src, 'bucket', manifest=path),
+                Diff([], [], ['a']))
+            self.assertEqual(hashes.md5.call_count, 1)
+        self.assertIn('a', Manifest(path).entries)
+
+    def test_multipart_etag(self):
+        '''Falls back to modification times without a plain md5 etag'''
+        self.write('a', b'a')
+        src = os.path.join(self.tmpdir, 'src')
+        mtime = os.stat(os.path.join(src, 'a')).st_mtime
+        listing = [{'key': 'a', 'size': 1, 'etag': 'abc-2', 'modified': mtime + 10}]
+        with mock.patch.object(self.conn, 'list_metadata', return_value=listing):
+            self.assertEqual(
+                self.conn.sync_up(src, 'bucket', dry_run=True), Diff([], [], ['a']))
+        listing[0]['modified'] = mtime - 10
+        with mock.patch.object(self.conn, 'list_metadata', return_value=listing):
+            self.assertEqual(
+                self.conn.sync_up(src, 'bucket', dry_run=True), Diff([], ['a'], []))
+
+    def test_download_tree(self):
+        '''Downloads everything beneath a prefix'''
+        self.conn.upload('bucket', 'prefix/a', BytesIO(b'a'))
+        self.conn.upload('bucket', 'prefix/dir/b', BytesIO(b'bb'))
+        self.conn.upload('bucket', 'other', BytesIO(b'c'))
+        dest = os.path.join(self.tmpdir, 'dest')
+        transfer = self.conn.download_tree(
+            'bucket', 'prefix/', dest, concurrency=2, fsync=True)
+        self.assertEqual((transfer.files, transfer.bytes), (2, 3))
+        self.assertGreaterEqual(transfer.rate, 0)
+        self.assertEqual(self.read('a'), b'a')
+        self.assertEqual(self.read('dir/b'), b'bb')
+        self.assertEqual(sorted(os.listdir(dest)), ['a', 'dir'])
+
+    def test_download_strings(self):
+        '''Objects uploaded as strings are downloaded as their bytes'''
+        self.conn.upload('bucket', 'prefix/a', u'caf\xe9')
+        dest = os.path.join(self.tmpdir, 'dest')
+        self.conn.download_tree('bucket', 'prefix/', dest)
+        self.assertEqual(self.read('a'), u'caf\xe9'.encode('utf-8'))
+        os.remove(os.path.join(dest, 'a'))
+        self.assertEqual(
+            self.conn.sync_down('bucket', 'prefix/', dest), Diff(['a'], [], []))
+        self.assertEqual(self.read('a'), u'caf\xe9'.encode('utf-8'))
+
+    def test_escaping_keys(self):
+        '''Keys that would be written outside the destination are skipped'''
+        for key in ('p/../../escaped/x', 'p//x', 'p/./x', 'p/a/../x', 'p/ok'):
+            self.conn.upload('bucket', key, BytesIO(b'data'))
+        dest = os.path.join(self.tmpdir, 'out', 'dest')
+        # Nor can a symlink lead out of it
+        os.makedirs(dest)
+        os.symlink(os.path.abspath(self.tmpdir), os.path.join(dest, 'link'))
+        self.conn.upload('bucket', 'p/link/linked', BytesIO(b'data'))
+
+        transfer = self.conn.download_tree('bucket', 'p', dest)
+        self.assertEqual(transfer.files, 1)
+        self.assertEqual(sorted(os.listdir(dest)), ['link', 'ok'])
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ['out'])
+        self.assertEqual(
+            self.conn.sync_down('bucket', 'p', dest), Diff([], [], ['ok']))
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ['out'])
+
+    def test_download_tree_failure(self):
+        '''Failed downloads raise, and leave nothing behind'''
+        self.conn.upload('bucket', 'prefix/a', BytesIO(b'a'))
+        dest = os.path.join(self.tmpdir, 'dest')
+        with mock.patch.object(
+                self.conn.backend, 'download', side_effect=DownloadException('x')):
+            self.assertRaises(
+                DownloadException, self.conn.download_tree, 'bucket', 'prefix/', dest)
+        self.assertEqual(os.listdir(dest), [])
+
+    def test_fetch_atomic(self):
+        '''A failed fetch leaves any existing file untouched'''
+        path = self.tmpfile('dest', 'a')
+        with open(path, 'wb') as fout:
+            fout.write(b'original')
+        self.assertRaises(
+            DownloadException, fetch, self.conn, 'bucket', 'missing', path, 10)
+        self.assertEqual(self.read('a'), b'original')
+        self.assertEqual(os.listdir(os.path.dirname(path)), ['a'])
+
+        self.conn.upload('bucket', 'a', BytesIO(b'new'))
+        self.assertEqual(fetch(self.conn, 'bucket', 'a', path, 10), 3)
+        self.assertEqual(self.read('a'), b'new')
+
+    def test_fetch_mode(self):
+        '''Fetched files get the permissions that open would give them'''
+        self.conn.upload('bucket', 'a', BytesIO(b'a'))
+        path = self.tmpfile('dest', 'a')
+        with mock.patch('s3po.sync.UMASK', 0o027):
+            fetch(self.conn, 'bucket', 'a', path)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o640)
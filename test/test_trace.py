@@ -0,0 +1,124 @@
+'''Test our tracing'''
+
+import json
+
+from six import BytesIO
+
+from test.base import BaseTest
+
+from s3po import Connection, trace
+from s3po.stub import Server
+from s3po.util import retry
+
+
+class TraceTest(BaseTest):
+    '''We can trace where time goes'''
+
+    def names(self, tracer):
+        '''The set of cat.name of the recorded spans'''
+        return set('%s.%s' % (record.cat, record.name) for record in tracer.spans)
+
+    def test_inactive(self):
+        '''Nothing is recorded without an active tracer'''
+        self.assertIs(trace.span('name'), trace.NULL_SPAN)
+        tracer = trace.Tracer()
+        self.conn.upload('bucket', 'key', 'content')
+        self.assertEqual(tracer.spans, [])
+
+    def test_operations(self):
+        '''Records operations, and their time in a batch's queue'''
+        with self.conn.trace() as tracer:
+            with self.conn.batch(2) as batch:
+                for i in range(5):
+                    batch.upload('bucket', 'key-%i' % i, 'content', callback=len)
+        self.assertEqual(
+            self.names(tracer), set(['op.upload', 'batch.queue', 'batch.callback']))
+        uploads = [record for record in tracer.spans if record.name == 'upload']
+        self.assertEqual(len(uploads), 5)
+        self.assertEqual(uploads[0].args, {'bucket': 'bucket', 'key': 'key-0'})
+        # Each ran on its own greenlet
+        self.assertEqual(len(set(record.tid for record in uploads)), 5)
+        self.assertIsNone(trace.current())
+
+    def test_errors(self):
+        '''Spans of operations that fail say so'''
+        with self.conn.trace() as tracer:
+            self.assertRaises(Exception, self.conn.download, 'bucket', 'missing')
+        self.assertEqual(tracer.spans[0].args['error'], 'DownloadException')
+
+    def test_retry_sleeps(self):
+        '''Sleeps between retries are recorded'''
+        calls = []
+
+        @retry(3, sleep=lambda interval: None)
+        def func():
+            '''Fail the first time'''
+            calls.append(1)
+            if len(calls) < 2:
+                raise ValueError('failed')
+
+        with trace.Tracer() as tracer:
+            func()
+        self.assertEqual(self.names(tracer), set(['retry.sleep']))
+
+    def test_chrome(self):
+        '''Exports to Chrome's trace-event format'''
+        with self.conn.trace() as tracer:
+            with self.conn.batch(2) as batch:
+                batch.upload('bucket', 'one', 'content')
+                batch.upload('bucket', 'two', 'content')
+        path = self.tmpfile('trace.json')
+        tracer.save(path)
+        with open(path) as fin:
+            events = json.load(fin)['traceEvents']
+        spans = [event for event in events if event['ph'] == 'X']
+        self.assertEqual(len(spans), 4)
+        for event in spans:
+            self.assertGreaterEqual(event['ts'], 0)
+            self.assertGreaterEqual(event['dur'], 0)
+        self.assertEqual(
+            set(event['tid'] for event in events if event['ph'] == 'M'),
+            set(event['tid'] for event in spans))
+
+    def test_summary(self):
+        '''Summarizes where the wall-clock time went'''
+        tracer = trace.Tracer()
+        tracer.record('upload', 'op', 0, 4, tid=1)
+        tracer.record('upload', 'op', 2, 6, tid=2)
+        tracer.record('queue', 'batch', 8, 10, tid=1)
+        summary = tracer.summary()
+        self.assertEqual(summary['wall'], 10)
+        self.assertEqual(summary['categories']['op'], {'total': 8, 'covered': 6})
+        self.assertEqual(summary['spans']['op.upload']['count'], 2)
+        self.assertEqual(summary['spans']['op.upload']['mean'], 4)
+        self.assertIn('op.upload', tracer.report())
+        self.assertEqual(trace.Tracer().summary()['wall'], 0)
+
+
+class BackendTraceTest(BaseTest):
+    '''The backends record their phases'''
+
+    def test_backends(self):
+        '''S3 records signing, first byte and bodies, Swift auth too'''
+        with Server() as server:
+            s3 = Connection.s3(**server.s3_kwargs())
+            with s3.trace() as tracer:
+                s3.upload('bucket', 'key', BytesIO(b'content'))
+                s3.read_ranges('bucket', 'key', [(0, 3)])
+            names = set((record.cat, record.name) for record in tracer.spans)
+            self.assertTrue(set([
+                ('s3', 'sign'), ('s3', 'first_byte'), ('s3', 'body'),
+                ('s3', 'put'), ('op', 'read_range')]) <= names)
+            with s3.trace() as tracer:
+                s3.download('bucket', 'key', BytesIO())
+            names = set((record.cat, record.name) for record in tracer.spans)
+            self.assertTrue(set([('s3', 'first_byte'), ('s3', 'body')]) <= names)
+
+            swift = Connection.swift(**server.swift_kwargs())
+            with swift.trace() as tracer:
+                swift.upload('bucket', 'key', BytesIO(b'content'))
+                swift.download('bucket', 'key', BytesIO())
+            names = set((record.cat, record.name) for record in tracer.spans)
+            self.assertTrue(set([
+                ('swift', 'auth'), ('swift', 'put'), ('swift', 'first_byte'),
+                ('swift', 'body')]) <= names)
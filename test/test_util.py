@@ -1,8 +1,13 @@
 '''Make sure our utitilies work as advertised'''
 
+import importlib
+import threading
+import time
 import unittest
 
-from s3po.util import retry
+import mock
+
+from s3po.util import coalesce, new_pool, retry, SingleFlight, ThreadPool
 
 
 class UtilTest(unittest.TestCase):
@@ -30,3 +35,88 @@ class UtilTest(unittest.TestCase):
         obj = {'count': 0}
         self.assertRaises(ValueError, func, obj)
         self.assertEqual(obj['count'], 1)
+
+    def test_single_flight(self):
+        '''Concurrent calls for the same key share one invocation'''
+        # Whichever threading is current, in case gevent has patched it
+        threading = importlib.import_module('threading')
+        flight = SingleFlight()
+        gate = threading.Event()
+        calls = []
+
+        def func():
+            '''Block until released'''
+            calls.append(1)
+            gate.wait()
+            return 'value'
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(flight.do('key', func)))
+            for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        while not flight._calls or flight._calls['key'].waiters < 4:
+            time.sleep(0.001)
+        gate.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, ['value'] * 5)
+        self.assertEqual(len(flight), 0)
+
+    def test_single_flight_error(self):
+        '''Errors propagate, and are not remembered for later calls'''
+        flight = SingleFlight()
+
+        def func():
+            '''Raise a ValueError'''
+            raise ValueError('foo')
+
+        self.assertRaises(ValueError, flight.do, 'key', func)
+        self.assertEqual(flight.do('key', lambda: 'value'), 'value')
+
+    def test_coalesce(self):
+        '''Groups spans within the gap of each other'''
+        self.assertEqual(coalesce([(10, 5), (0, 5), (20, 5)], 5), [
+            (0, 25, [(0, 5), (10, 5), (20, 5)])])
+        self.assertEqual(coalesce([(0, 5), (20, 5)], 5), [
+            (0, 5, [(0, 5)]), (20, 5, [(20, 5)])])
+        self.assertEqual(coalesce([(0, 10), (2, 3)], 0), [
+            (0, 10, [(0, 10), (2, 3)])])
+
+    def test_thread_pool(self):
+        '''Runs up to size functions at once in threads'''
+        pool = ThreadPool(2)
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def func(value):
+            '''Note how many are running'''
+            with lock:
+                running.append(value)
+                peak.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(value)
+            return value * 2
+
+        self.assertEqual(pool.map(func, range(6)), [0, 2, 4, 6, 8, 10])
+        self.assertEqual(max(peak), 2)
+        task = pool.spawn(func, 'a')
+        pool.join()
+        self.assertEqual(task.get(), 'aa')
+        self.assertRaises(ZeroDivisionError, pool.spawn(lambda: 1 / 0).get)
+
+    def test_new_pool(self):
+        '''Pools are gevent's only once gevent has monkey-patched'''
+        monkey = mock.Mock()
+        monkey.is_module_patched.return_value = False
+        with mock.patch.dict('sys.modules', {'gevent.monkey': monkey}):
+            self.assertIsInstance(new_pool(2), ThreadPool)
+        monkey.is_module_patched.return_value = True
+        with mock.patch.dict('sys.modules', {'gevent.monkey': monkey}):
+            from gevent.pool import Pool
+            self.assertIsInstance(new_pool(2), Pool)